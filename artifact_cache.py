@@ -0,0 +1,327 @@
+"""
+Content-addressed cache for artifacts, derived from osd maps and crush maps.
+
+Every artifact is stored under sha1 of the input file it's produced from, so
+repeated runs against the same base map skip osdmaptool/crushtool calls.
+Entries are evicted in LRU order when cache grows above size limit. Cache is
+kept in per-user runtime dir ($XDG_RUNTIME_DIR, usually tmpfs) when available.
+Cache dir must be private: it's created with mode 0700 and is refused, if it's
+symlink or owned by other user. Files, returned by cache, are shared and must
+never be modified in place - copy them first.
+
+Process holds shared flock of every entry it got from cache, until entry is released,
+and eviction skips locked entries, so files are never removed under readers. Use
+entry() context manager to release entry as soon as artifact is read. Helper functions
+return artifact content or private copy of artifact file and hold no locks.
+"""
+
+from __future__ import print_function
+
+import os
+import stat
+import errno
+import fcntl
+import contextlib
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from cephlib.common import run_locally, tmpnam
+
+
+logger = logging.getLogger("remap.cache")
+
+
+DEFAULT_MAX_SIZE = 512 * 1024 ** 2
+LOCK_NAME = ".lock"
+CACHE_DIR_ENV = "CEPH_TOOLS_CACHE"
+
+
+class UnsafeCacheDir(Exception):
+    pass
+
+
+def default_cache_dir():
+    if CACHE_DIR_ENV in os.environ:
+        return os.environ[CACHE_DIR_ENV]
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "ceph_tools_cache")
+
+    return os.path.expanduser("~/.cache/ceph_tools/artifacts")
+
+
+def make_private_dir(path):
+    "Create directory with mode 0700, if it doesn't exist, and check, that only current user can change it"
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+    # lstat - symlink must not be followed, it can point to directory of other user
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) or not stat.S_ISDIR(st.st_mode):
+        raise UnsafeCacheDir("Cache dir {0} is not a directory".format(path))
+    if st.st_uid != os.getuid():
+        raise UnsafeCacheDir("Cache dir {0} is owned by uid {1}, not by current user".format(path, st.st_uid))
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    def __init__(self, root=None, max_size=DEFAULT_MAX_SIZE):
+        self.root = default_cache_dir() if root is None else root
+        self.max_size = max_size
+        self.root_checked = False
+        # {key: [fd of entry lock file, number of users]}
+        self.locks = {}
+
+    def check_root(self):
+        if not self.root_checked:
+            make_private_dir(self.root)
+            self.root_checked = True
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def lock_entry(self, key):
+        """
+        Take shared lock of entry, it's held until release(key) is called for every successful
+        lock_entry, so other processes don't evict it. Returns False if entry doesn't exist
+        """
+        if key in self.locks:
+            self.locks[key][1] += 1
+            return True
+
+        lock_path = os.path.join(self.entry_dir(key), LOCK_NAME)
+        try:
+            fd = os.open(lock_path, os.O_RDONLY | os.O_CREAT, 0o600)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return False
+            raise
+        fcntl.flock(fd, fcntl.LOCK_SH)
+
+        # entry could be evicted between open and flock
+        try:
+            valid = os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+        except OSError:
+            valid = False
+        if not valid:
+            os.close(fd)
+            return False
+        self.locks[key] = [fd, 1]
+        return True
+
+    def release(self, key=None):
+        """
+        Release one use of entry or locks of all used entries, if key is None.
+        Paths of released entries may be evicted after this call
+        """
+        if key is None:
+            for fd, _ in self.locks.values():
+                os.close(fd)
+            self.locks.clear()
+            return
+
+        lock = self.locks[key]
+        lock[1] -= 1
+        if lock[1] == 0:
+            os.close(lock[0])
+            del self.locks[key]
+
+    @contextlib.contextmanager
+    def entry(self, key, name, producer=None):
+        """
+        Path to cached artifact, which is created with producer if missing, or None,
+        if it's missing and no producer is given. Entry is released on exit
+        """
+        path = self.get(key, name) if producer is None else self.get_or_create(key, name, producer)
+        try:
+            yield path
+        finally:
+            if path is not None:
+                self.release(key)
+
+    def touch(self, key):
+        # directory mtime is used as LRU timestamp
+        try:
+            os.utime(self.entry_dir(key), None)
+        except OSError:
+            pass
+
+    def get(self, key, name):
+        "Path to cached artifact or None, entry must be released, if path is returned"
+        self.check_root()
+        path = os.path.join(self.entry_dir(key), name)
+        if not os.path.exists(path) or not self.lock_entry(key):
+            return None
+        if not os.path.exists(path):
+            self.release(key)
+            return None
+        self.touch(key)
+        return path
+
+    def put(self, key, name, producer):
+        """
+        Store artifact, producer(path) must create file at path.
+        Returns path to stored artifact, entry must be released
+        """
+        self.check_root()
+        entry_dir = self.entry_dir(key)
+        # entry can be evicted by concurrent process till we lock it
+        while not self.lock_entry(key):
+            try:
+                os.mkdir(entry_dir)
+            except OSError:
+                # created by concurrent process
+                if not os.path.isdir(entry_dir):
+                    raise
+
+        # produce into temporary file and rename, so readers never see partial artifacts
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=entry_dir, prefix=".tmp-")
+        os.close(tmp_fd)
+        try:
+            producer(tmp_path)
+            path = os.path.join(entry_dir, name)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            self.release(key)
+            raise
+
+        self.touch(key)
+        self.evict(keep=key)
+        return path
+
+    def get_or_create(self, key, name, producer):
+        path = self.get(key, name)
+        if path is None:
+            path = self.put(key, name, producer)
+        else:
+            logger.debug("Use cached %s for %s", name, key)
+        return path
+
+    def remove_entry(self, key):
+        "Remove entry, unless it's locked by some process. Returns True if entry was removed"
+        entry_dir = self.entry_dir(key)
+        try:
+            fd = os.open(os.path.join(entry_dir, LOCK_NAME), os.O_RDONLY | os.O_CREAT, 0o600)
+        except OSError:
+            return False
+
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                logger.debug("Cache entry %s is in use, not evicted", key)
+                return False
+            # rename to tombstone under lock, so entry disappears at once for lockers, which wait for us
+            tombstone = tempfile.mkdtemp(dir=self.root, prefix=".evicted-")
+            os.rename(entry_dir, os.path.join(tombstone, key))
+        finally:
+            os.close(fd)
+
+        shutil.rmtree(tombstone, ignore_errors=True)
+        return True
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            entry_dir = self.entry_dir(key)
+            # tombstones of concurrent eviction
+            if key.startswith("."):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+                mtime = os.path.getmtime(entry_dir)
+            except OSError:
+                continue
+            total += size
+            if key != keep:
+                entries.append((mtime, size, key))
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            if self.remove_entry(key):
+                logger.debug("Evicted %s from cache", key)
+                total -= size
+
+
+_default_cache = None
+
+
+def get_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ArtifactCache()
+    return _default_cache
+
+
+def _run_to(cmd_templ, **params):
+    def producer(dst):
+        run_locally(cmd_templ.format(dst=dst, **params))
+    return producer
+
+
+def _copy_of(cache, key, name, producer):
+    "Private copy of artifact, so entry is locked only while it's copied"
+    with cache.entry(key, name, producer) as path:
+        copy_f = tmpnam()
+        shutil.copy(path, copy_f)
+    return copy_f
+
+
+def _content_of(cache, key, name, producer):
+    with cache.entry(key, name, producer) as path:
+        with open(path) as fd:
+            return fd.read()
+
+
+def export_crush(osd_map_f, cache=None):
+    "Binary crush map from osd map"
+    cache = get_cache() if cache is None else cache
+    return _copy_of(cache, file_hash(osd_map_f), "crush.bin",
+                    _run_to("osdmaptool --export-crush {dst} {src}", src=osd_map_f))
+
+
+def decompile_crush(crush_bin_f, cache=None):
+    "Text crush map from binary"
+    cache = get_cache() if cache is None else cache
+    return _copy_of(cache, file_hash(crush_bin_f), "crush.txt",
+                    _run_to("crushtool -d {src} -o {dst}", src=crush_bin_f))
+
+
+def compile_crush(crush_txt_f, cache=None):
+    "Binary crush map from text"
+    cache = get_cache() if cache is None else cache
+    return _copy_of(cache, file_hash(crush_txt_f), "crush.bin",
+                    _run_to("crushtool -c {src} -o {dst}", src=crush_txt_f))
+
+
+def dump_crush(crush_bin_f, cache=None):
+    "'crushtool --dump' json for binary crush map"
+    cache = get_cache() if cache is None else cache
+    return _content_of(cache, file_hash(crush_bin_f), "crush.json",
+                       _run_to("crushtool -i {src} --dump > {dst}", src=crush_bin_f))
+
+
+def dump_osdmap(osd_map_f, cache=None):
+    "'osdmaptool --dump json' output for osd map"
+    cache = get_cache() if cache is None else cache
+    return _content_of(cache, file_hash(osd_map_f), "osdmap.json",
+                       _run_to("osdmaptool {src} --dump json > {dst}", src=osd_map_f))
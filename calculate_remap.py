@@ -1,20 +1,35 @@
 from __future__ import print_function
 
+import os
 import re
 import sys
 import json
+import hashlib
 import shutil
 import logging
 import argparse
 import tempfile
+import subprocess
+import multiprocessing
 import collections
 
+import numpy
+
 from cephlib.common import run_locally, setup_loggers, tmpnam
-from cephlib.units import b2ssize
+from cephlib.units import b2ssize, ssize2b
 from cephlib.common import logger as clogger
 
+import crush_mapper
+import artifact_cache
+import cluster_snapshot
+import weight_optimizer
+
+
 logger = logging.getLogger("remap")
 
+# part of cached mapping key, bump on any change of mapping engine results or cached mapping format
+MAPPING_VERSION = 2
+
 
 class PGInfo(object):
     def __init__(self, pgid, acting, size):
@@ -24,17 +39,36 @@ class PGInfo(object):
 
 
 class Pool(object):
-    def __init__(self, name, pid, pg_count):
+    """
+    PG => OSD mapping for pool, stored as int32 array (pg_count, size).
+    Unused slots are filled with crush_mapper.NO_OSD.
+    primary - int32 array of PG primaries, if known
+    """
+    def __init__(self, name, pid, pg_count, mapping=None, primary=None):
         self.name = name
         self.pid = pid
         self.pg_count = pg_count
-        self.pg_map = {}
+        if mapping is None:
+            mapping = numpy.full((pg_count, 0), crush_mapper.NO_OSD, dtype=numpy.int32)
+        self.mapping = mapping
+        self.primary = primary
+
+    def set_pg(self, pg_num, osd_ids):
+        if len(osd_ids) > self.mapping.shape[1]:
+            extra = numpy.full((self.pg_count, len(osd_ids) - self.mapping.shape[1]), crush_mapper.NO_OSD,
+                               dtype=numpy.int32)
+            self.mapping = numpy.concatenate([self.mapping, extra], axis=1)
+        self.mapping[pg_num, :len(osd_ids)] = osd_ids
+
+    def pg_osds(self, pg_num):
+        return set(self.mapping[pg_num].tolist()) - {crush_mapper.NO_OSD}
 
     def __str__(self):
-        res = "pid = {0}\n".format(self.pid)
-        for num, mapping in sorted(self.pg_map.items()):
-            res += "    {0} => {1}\n".format(num, ",".join(mapping))
-        return res
+        res = ["pid = {0}\n".format(self.pid)]
+        for num, osd_ids in enumerate(self.mapping.tolist()):
+            res.append("    {0} => {1}\n".format(num, ",".join(str(osd_id) for osd_id in osd_ids
+                                                             if osd_id != crush_mapper.NO_OSD)))
+        return "".join(res)
 
 
 class OSDChanges(object):
@@ -51,42 +85,58 @@ class OSDData(object):
         self.bytes = bytes
 
 
-def get_pg_dump(pg_dump_js=None):
-    if pg_dump_js is None:
-        pg_dump_js = run_locally("ceph pg dump --format=json").decode("utf8")
+def get_osd_curr(pg_dump_f=None):
+    "pg_dump_f - pg dump file, ClusterSnapshot or None for live cluster"
+    res = collections.defaultdict(OSDData)
+    pg_count, osd_bytes = cluster_snapshot.pgs_of(pg_dump_f).osd_usage()
 
-    if isinstance(pg_dump_js, str):
-        return json.loads(pg_dump_js)
-    else:
-        assert isinstance(pg_dump_js, dict)
-        return pg_dump_js
+    for osd_id in numpy.nonzero(pg_count)[0].tolist():
+        res[osd_id].pg = int(pg_count[osd_id])
+        res[osd_id].bytes = int(osd_bytes[osd_id])
+    return res
 
 
-def get_osd_curr(pg_dump_js=None):
-    res = collections.defaultdict(OSDData)
-    pg_dump = get_pg_dump(pg_dump_js)['pg_stats']
+def _padded(mapping, width):
+    if mapping.shape[1] == width:
+        return mapping
+    extra = numpy.full((mapping.shape[0], width - mapping.shape[1]), crush_mapper.NO_OSD, dtype=mapping.dtype)
+    return numpy.concatenate([mapping, extra], axis=1)
 
-    for pg_info in pg_dump:
-        for osd_id in pg_info['acting']:
-            res[osd_id].pg += 1
-            res[osd_id].bytes += pg_info['stat_sum']['num_bytes']
-    return res
+
+def pool_moves(p_old, p_new):
+    """
+    Find OSD which leave/join every PG.
+    Returns (pg_out, osd_out, pg_in, osd_in) arrays, e.g. osd_out[i] leaves pg pg_out[i]
+    """
+    assert p_old.pid == p_new.pid
+    assert p_old.pg_count == p_new.pg_count
+
+    width = max(p_old.mapping.shape[1], p_new.mapping.shape[1])
+    old = _padded(p_old.mapping, width)
+    new = _padded(p_new.mapping, width)
+
+    # only rows which differ at all can have moves, usually it's a small part of all PGs
+    changed = numpy.nonzero((old != new).any(axis=1))[0]
+    old = old[changed]
+    new = new[changed]
+
+    out_mask = (old[:, :, None] != new[:, None, :]).all(axis=2) & (old != crush_mapper.NO_OSD)
+    in_mask = (new[:, :, None] != old[:, None, :]).all(axis=2) & (new != crush_mapper.NO_OSD)
+
+    return changed[numpy.nonzero(out_mask)[0]], old[out_mask], changed[numpy.nonzero(in_mask)[0]], new[in_mask]
 
 
 def calc_diff(p_old, p_new):
-    assert p_old.pid == p_new.pid
-    assert len(p_old.pg_map[0]) == len(p_new.pg_map[0])
+    pg_out, osd_out, pg_in, osd_in = pool_moves(p_old, p_new)
 
     moved_to = collections.defaultdict(list)
     moved_from = collections.defaultdict(list)
 
-    for pg_id, v1 in p_old.pg_map.items():
-        v2 = p_new.pg_map[pg_id]
-        if v1 != v2:
-            for osd_id in v1 - v2:
-                moved_from[osd_id].append(pg_id)
-            for osd_id in v2 - v1:
-                moved_to[osd_id].append(pg_id)
+    for osd_id, pg_id in zip(osd_out.tolist(), pg_out.tolist()):
+        moved_from[osd_id].append(pg_id)
+
+    for osd_id, pg_id in zip(osd_in.tolist(), pg_in.tolist()):
+        moved_to[osd_id].append(pg_id)
 
     return dict(moved_from.items()), dict(moved_to.items())
 
@@ -94,12 +144,16 @@ def calc_diff(p_old, p_new):
 pool_start_line = re.compile(r"pool\s+(?P<pid>\d+)\s+pg_num\s+(?P<pg_num>\d+)\s*$")
 pg_map_line = re.compile(r"(?P<pid>\d+)\." +
                          r"(?P<pg_id>[0-9a-f]+)\s+" +
-                         r"\[(?P<osd_ids>[0-9a-f,]+)\]\s+\d+\s*$")
+                         r"\[(?P<osd_ids>[0-9,]*)\]\s+(?P<primary>-?\d+)\s*$")
 
 
-def parse(map_data):
+def parse(map_lines):
+    """
+    Parse 'osdmaptool --test-map-pgs-dump' output, line by line.
+    map_lines - any iterable of lines, e.g. opened file or process stdout
+    """
     curr_pool = None
-    for line in map_data.split("\n"):
+    for line in map_lines:
         if curr_pool is not None:
             mline = pg_map_line.match(line)
             if mline is None:
@@ -107,49 +161,287 @@ def parse(map_data):
                 curr_pool = None
             else:
                 pg_num = int(mline.group('pg_id'), 16)
-                osd_ids = {int(x) for x in mline.group('osd_ids').split(",")}
-                curr_pool.pg_map[pg_num] = set(osd_ids)
+                osd_ids_s = mline.group('osd_ids')
+                osd_ids = [int(x) for x in osd_ids_s.split(",")] if osd_ids_s else []
+                curr_pool.set_pg(pg_num, [crush_mapper.NO_OSD if osd_id == crush_mapper.CRUSH_ITEM_NONE else osd_id
+                                          for osd_id in osd_ids])
+                curr_pool.primary[pg_num] = int(mline.group('primary'))
                 continue
 
         pline = pool_start_line.match(line)
         if pline:
+            pg_count = int(pline.group('pg_num'))
             curr_pool = Pool(None,
                              int(pline.group('pid')),
-                             int(pline.group('pg_num')))
+                             pg_count,
+                             primary=numpy.full(pg_count, crush_mapper.NO_OSD, dtype=numpy.int32))
 
     if curr_pool is not None:
         yield curr_pool
 
 
-def get_pg_sizes(pg_dump_js=None):
-    pg_dump = get_pg_dump(pg_dump_js)['pg_stats']
-    res = {}
-
-    for pg_dict in pg_dump:
-        pool_id, pg_id = pg_dict['pgid'].split(".")  # type: str, str
-        full_pg_id = (int(pool_id), int(pg_id, 16))
-        res[full_pg_id] = pg_dict['stat_sum']['num_bytes']
+def pool_from_mapping(pool_info, mapping):
+    return Pool(pool_info.name, pool_info.pid, pool_info.pg_num, mapping)
+
+
+def osdmaptool_map_pgs(osd_map_f, pool_id=None):
+    "Run 'osdmaptool --test-map-pgs-dump' and parse its output as it goes"
+    cmd = ["osdmaptool", "--test-map-pgs-dump", osd_map_f]
+    if pool_id is not None:
+        cmd.extend(["--pool", str(pool_id)])
+    logger.debug("CMD: %s", " ".join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        pools = {pool.pid: pool for pool in parse(line.decode("utf8") for line in proc.stdout)}
+    finally:
+        proc.stdout.close()
+        retcode = proc.wait()
+
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, " ".join(cmd))
+    return pools
+
+
+def _engine_task(crush, osdmap, pool_info):
+    return [pool_from_mapping(pool_info, crush_mapper.map_pool(crush, osdmap, pool_info))]
+
+
+def _osdmaptool_task(osd_map_f, pool_id):
+    return list(osdmaptool_map_pgs(osd_map_f, pool_id).values())
+
+
+def _run_mapping_task(task):
+    func, args = task
+    return func(*args)
+
+
+def mapping_tasks(osd_map_f, use_osdmaptool=False, per_pool=False, reweights=None):
+    """
+    Split PG mapping calculation for osd map into independent tasks, each task returns list of Pool.
+    In-process engine always works per pool, osdmaptool is run per pool only if per_pool is set.
+    Big pools goes first to keep process pool loaded evenly.
+    reweights - {osd_id: reweight} to apply to osd map before mapping, requires in-process engine.
+    UnsupportedMap is raised if map with reweights can't be mapped in-process, as osdmaptool would
+    silently give mapping without them
+    Returns (mapper name, tasks)
+    """
+    if reweights and use_osdmaptool:
+        logger.warning("osdmaptool can't apply reweights, use in-process engine for %s", osd_map_f)
+
+    if reweights or not use_osdmaptool:
+        try:
+            crush, osdmap = crush_mapper.load_osdmap_file(osd_map_f)
+            if reweights:
+                crush_mapper.apply_reweights(osdmap, reweights)
+            return "engine", [(_engine_task, (crush, osdmap, pool_info))
+                              for pool_info in sorted(osdmap.pools, key=lambda pool_info: -pool_info.pg_num)]
+        except crush_mapper.UnsupportedMap as exc:
+            if reweights:
+                raise crush_mapper.UnsupportedMap("Can't map {0} with reweights applied: {1}".format(osd_map_f, exc))
+            logger.warning("Can't map PGs in-process: %s. Fall back to osdmaptool", exc)
+
+    if per_pool:
+        osdmap = crush_mapper.load_osdmap(artifact_cache.dump_osdmap(osd_map_f))
+        return "osdmaptool", [(_osdmaptool_task, (osd_map_f, pool_info.pid))
+                              for pool_info in sorted(osdmap.pools, key=lambda pool_info: -pool_info.pg_num)]
+
+    return "osdmaptool", [(_osdmaptool_task, (osd_map_f, None))]
+
+
+def mapping_key(osd_map_f, reweights=None):
+    "Artifact cache key for mapping of osd map file with reweights applied, by current mapping code"
+    map_hash = artifact_cache.file_hash(osd_map_f)
+    reweights_s = json.dumps(sorted((int(osd_id), float(reweight)) for osd_id, reweight in (reweights or {}).items()))
+    key_s = "v{0}:{1}:{2}".format(MAPPING_VERSION, map_hash, reweights_s)
+    return hashlib.sha1(key_s.encode("utf8")).hexdigest()
+
+
+def _mapping_cache_name(mapper):
+    return "pgs-{0}.npz".format(mapper)
+
+
+def load_cached_mapping(map_hash, use_osdmaptool=False):
+    "Pools mapping, stored in artifact cache for osd map with map_hash, or None"
+    cache = artifact_cache.get_cache()
+    for mapper in (("osdmaptool",) if use_osdmaptool else ("engine", "osdmaptool")):
+        with cache.entry(map_hash, _mapping_cache_name(mapper)) as path:
+            if path is not None:
+                with numpy.load(path) as data:
+                    return {pid: Pool(name or None, pid, len(data["pool_{0}".format(pid)]),
+                                      data["pool_{0}".format(pid)])
+                            for pid, name in zip(data["pids"].tolist(), data["names"].tolist())}
+    return None
+
+
+def store_mapping(map_hash, mapper, pools):
+    def producer(dst):
+        arrays = {"pool_{0}".format(pool.pid): pool.mapping for pool in pools.values()}
+        arrays["pids"] = numpy.array(list(pools.keys()), dtype=numpy.int64)
+        arrays["names"] = numpy.array([pool.name or "" for pool in pools.values()])
+        with open(dst, "wb") as fd:
+            numpy.savez(fd, **arrays)
+
+    cache = artifact_cache.get_cache()
+    cache.put(map_hash, _mapping_cache_name(mapper), producer)
+    cache.release(map_hash)
+
+
+def map_pgs(osd_map_files, use_osdmaptool=False, per_pool=False, jobs=None, background=None, reweights=None):
+    """
+    Calculate PG => OSD mapping for all pools of every binary osd map in parallel.
+    Returns list of {pool_id: Pool}, one per map file, and result of background() call,
+    which is executed in this process, while mapping is calculated
+    jobs - process pool size, cpu count by default
+    reweights - list of {osd_id: reweight} or None, one per map file, to be applied before mapping
+    Mappings are taken from artifact cache, if it has them for the same osd map
+    """
+    maps = []
+    mappers = {}
+    tasks = []
+    owners = []
+    if reweights is None:
+        reweights = [None] * len(osd_map_files)
+    map_hashes = [mapping_key(osd_map_f, map_reweights)
+                  for osd_map_f, map_reweights in zip(osd_map_files, reweights)]
+    for idx, (osd_map_f, map_hash) in enumerate(zip(osd_map_files, map_hashes)):
+        pools = load_cached_mapping(map_hash, use_osdmaptool and not reweights[idx])
+        maps.append({} if pools is None else pools)
+        if pools is None:
+            mappers[idx], map_tasks = mapping_tasks(osd_map_f, use_osdmaptool, per_pool, reweights[idx])
+            tasks.extend(map_tasks)
+            owners.extend([idx] * len(map_tasks))
+        else:
+            logger.debug("Use cached PG mapping for %s", osd_map_f)
 
-    return res
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs <= 1:
+        results = [_run_mapping_task(task) for task in tasks]
+        bg_result = None if background is None else background()
+    else:
+        logger.debug("Calculate PG mapping with %s tasks in %s processes", len(tasks), jobs)
+        proc_pool = multiprocessing.Pool(jobs)
+        try:
+            async_results = proc_pool.map_async(_run_mapping_task, tasks, chunksize=1)
+            bg_result = None if background is None else background()
+            results = async_results.get()
+        finally:
+            proc_pool.terminate()
+            proc_pool.join()
+
+    for idx, pools in zip(owners, results):
+        maps[idx].update((pool.pid, pool) for pool in pools)
+
+    for idx, mapper in mappers.items():
+        store_mapping(map_hashes[idx], mapper, maps[idx])
+
+    return maps, bg_result
+
+
+def compare_mapping(crush, osdmap, expected):
+    """
+    Compare in-process mapping with parsed 'osdmaptool --test-map-pgs-dump' output, which shows acting sets.
+    Sets are compared in order, including empty EC slots, with primaries.
+    Returns number of mismatched PGs
+    """
+    failed = 0
+    for pool_info in osdmap.pools:
+        up, up_primary = crush_mapper.map_pool_up(crush, osdmap, pool_info)
+        acting, acting_primary = crush_mapper.pool_acting(osdmap, pool_info, up, up_primary)
+        temp = (_padded(up, acting.shape[1]) != acting).any(axis=1) | (up_primary != acting_primary)
+        if temp.any():
+            logger.debug("Pool %s: %s PGs has acting set, which differs from up", pool_info.pid, int(temp.sum()))
+
+        exp_pool = expected.get(pool_info.pid)
+        if exp_pool is None:
+            logger.error("osdmaptool has no pool %s", pool_info.pid)
+            failed += pool_info.pg_num
+            continue
+
+        width = max(acting.shape[1], exp_pool.mapping.shape[1])
+        got = _padded(acting, width)
+        exp = _padded(exp_pool.mapping, width)
+        bad = (got != exp).any(axis=1) | (acting_primary != exp_pool.primary)
+        for pg_num in numpy.nonzero(bad)[0].tolist():
+            logger.error("%s.%x mapped to %s primary %s, osdmaptool maps it to %s primary %s",
+                         pool_info.pid, pg_num, got[pg_num].tolist(), acting_primary[pg_num],
+                         exp[pg_num].tolist(), exp_pool.primary[pg_num])
+        failed += int(bad.sum())
+    return failed
+
+
+def verify_mapping(osd_map_f):
+    "Compare in-process mapping with osdmaptool output, returns number of mismatched PGs"
+    crush, osdmap = crush_mapper.load_osdmap_file(osd_map_f)
+    return compare_mapping(crush, osdmap, osdmaptool_map_pgs(osd_map_f))
+
+
+def record_mapping(osd_map_f, out_dir):
+    """
+    Store osd map as test case for in-process mapping engine: NAME.osdmap - binary map,
+    NAME.json - crush and osd map dumps, NAME.pgs_dump.txt - 'osdmaptool --test-map-pgs-dump' output.
+    Returns NAME
+    """
+    name = os.path.splitext(os.path.basename(osd_map_f))[0]
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    shutil.copy(osd_map_f, os.path.join(out_dir, name + ".osdmap"))
+    dumps = {'crush': json.loads(artifact_cache.dump_crush(artifact_cache.export_crush(osd_map_f))),
+             'osd_dump': json.loads(artifact_cache.dump_osdmap(osd_map_f))}
+    with open(os.path.join(out_dir, name + ".json"), "w") as fd:
+        json.dump(dumps, fd, indent=1, sort_keys=True)
+    with open(os.path.join(out_dir, name + ".pgs_dump.txt"), "wb") as fd:
+        fd.write(run_locally("osdmaptool --test-map-pgs-dump {0}".format(osd_map_f)))
+    return name
+
+
+def get_pg_sizes(pg_dump_f=None):
+    """
+    Returns {pool_id: int64 array of PG sizes, indexed by pg number}
+    pg_dump_f - pg dump file, ClusterSnapshot or None for live cluster
+    """
+    return cluster_snapshot.pg_sizes_of(pg_dump_f)
+
+
+def _pool_sizes(pg_sizes, pool_id, pg_count):
+    sizes = pg_sizes.get(pool_id, numpy.zeros(0, dtype=numpy.int64))
+    if len(sizes) < pg_count:
+        sizes = numpy.concatenate([sizes, numpy.zeros(pg_count - len(sizes), dtype=numpy.int64)])
+    return sizes
 
 
 def get_osd_diff(pool_pairs, pg_sizes):
+    osd_out = []
+    bytes_out = []
+    osd_in = []
+    bytes_in = []
 
-    osd_changes = collections.defaultdict(OSDChanges)
     for pool_id, (old_pool, new_pool) in pool_pairs.items():
-        frm, to = calc_diff(old_pool, new_pool)
-
-        for osd_id, out_pgs in frm.items():
-            osd_ch = osd_changes[osd_id]
-            osd_ch.pg_out += len(out_pgs)
-            for pg_id in out_pgs:
-                osd_ch.bytes_out += pg_sizes[(pool_id, pg_id)]
+        sizes = _pool_sizes(pg_sizes, pool_id, old_pool.pg_count)
+        pool_pg_out, pool_osd_out, pool_pg_in, pool_osd_in = pool_moves(old_pool, new_pool)
+        osd_out.append(pool_osd_out)
+        bytes_out.append(sizes[pool_pg_out])
+        osd_in.append(pool_osd_in)
+        bytes_in.append(sizes[pool_pg_in])
+
+    osd_out = numpy.concatenate(osd_out + [numpy.zeros(0, dtype=numpy.int32)])
+    osd_in = numpy.concatenate(osd_in + [numpy.zeros(0, dtype=numpy.int32)])
+    bytes_out = numpy.concatenate(bytes_out + [numpy.zeros(0, dtype=numpy.int64)])
+    bytes_in = numpy.concatenate(bytes_in + [numpy.zeros(0, dtype=numpy.int64)])
+
+    max_osd = max(osd_out.max(initial=-1), osd_in.max(initial=-1)) + 1
+    pg_out_per_osd = numpy.bincount(osd_out, minlength=max_osd)
+    pg_in_per_osd = numpy.bincount(osd_in, minlength=max_osd)
+    # float64 sums are exact up to 8PiB per OSD
+    bytes_out_per_osd = numpy.bincount(osd_out, weights=bytes_out, minlength=max_osd).round().astype(numpy.int64)
+    bytes_in_per_osd = numpy.bincount(osd_in, weights=bytes_in, minlength=max_osd).round().astype(numpy.int64)
 
-        for osd_id, in_pgs in to.items():
-            osd_ch = osd_changes[osd_id]
-            osd_ch.pg_in += len(in_pgs)
-            for pg_id in in_pgs:
-                osd_ch.bytes_in += pg_sizes[(pool_id, pg_id)]
+    osd_changes = collections.defaultdict(OSDChanges)
+    for osd_id in numpy.nonzero(pg_out_per_osd + pg_in_per_osd)[0].tolist():
+        osd_ch = osd_changes[osd_id]
+        osd_ch.pg_out = int(pg_out_per_osd[osd_id])
+        osd_ch.pg_in = int(pg_in_per_osd[osd_id])
+        osd_ch.bytes_out = int(bytes_out_per_osd[osd_id])
+        osd_ch.bytes_in = int(bytes_in_per_osd[osd_id])
 
     return osd_changes
 
@@ -163,6 +455,12 @@ def parse_args(argv):
     dump_parser.add_argument("-o", "--osd-map", default=None, help="Use dumped OSD map")
     dump_parser.add_argument("out_file", help="File to store dump")
 
+    verify_parser = subparsers.add_parser('verify', help="Check in-process PG mapping against osdmaptool")
+    verify_parser.add_argument("-r", "--record", metavar="DIR", default=None,
+                               help="Also store maps and osdmaptool output into DIR as test cases, " +
+                                    "tests/data/osdmaptool is checked by test suite")
+    verify_parser.add_argument("osd_maps", nargs="+", help="Dumped OSD map files")
+
     apply_parser = subparsers.add_parser('apply', help="Apply new crush and calculate difference")
     apply_parser.add_argument("crush_file", help="File to load crush from")
 
@@ -171,12 +469,55 @@ def parse_args(argv):
                                                     "and calculate diff")
     interactive_parser.add_argument("-e", "--editor", default="subl", help="Editor name")
 
+    optimize_parser = subparsers.add_parser('optimize',
+                                            help="Search for weights/reweights, which make PG or data " +
+                                                 "distribution even, and store them as rebalance.py config")
+    optimize_parser.add_argument("-o", "--osd-map", default=None, help="Use dumped OSD map")
+    optimize_parser.add_argument("-g", "--pg-dump", default=None,
+                                 help="Use dumped PG info (must be in json format)")
+    optimize_parser.add_argument("-m", "--mode", choices=weight_optimizer.MODES + ('both',), default='both',
+                                 help="Change crush weights, reweights or both")
+    optimize_parser.add_argument("-k", "--metric", choices=weight_optimizer.METRICS, default='pgs',
+                                 help="Make even PG count or data size per OSD weight unit")
+    optimize_parser.add_argument("-b", "--max-move", default=None,
+                                 help="Max data to be moved, like 100G")
+    optimize_parser.add_argument("-s", "--step", type=float, default=0.05,
+                                 help="Max relative weight change in one search iteration")
+    optimize_parser.add_argument("--allow-increase", action="store_true",
+                                 help="Also raise weights/reweights (reweight up to 1.0) of least loaded OSDs. " +
+                                      "Without it weights are only lowered. Every raise candidate remaps " +
+                                      "all PGs of pools, so search is much slower")
+    optimize_parser.add_argument("-i", "--iterations", type=int, default=100, help="Max search iterations")
+    optimize_parser.add_argument("--min-weight-diff", type=float, default=0.01,
+                                 help="Minimal weight change to be searched and applied")
+    optimize_parser.add_argument("--min-reweight-diff", type=float, default=0.01,
+                                 help="Minimal reweight change to be searched and applied")
+    optimize_parser.add_argument("--rebalance-step", type=float, default=0.1,
+                                 help="'step' of rebalance.py config, max weight change in one rebalance round")
+    optimize_parser.add_argument("--rebalance-restep", type=float, default=0.02,
+                                 help="'restep' of rebalance.py config, max reweight change in one rebalance round")
+    optimize_parser.add_argument("--max-updated-nodes", type=int, default=4,
+                                 help="'max_updated_nodes' of rebalance.py config, max OSD updated in one round")
+    optimize_parser.add_argument("out_file", help="File to store rebalance.py yaml config")
+
+    batch_parser = subparsers.add_parser('batch', help="Rank candidate crush maps by data movement")
+    batch_parser.add_argument("crush_files", nargs="+",
+                              help="Candidate crush files (text or compiled) or directories with them")
+
     for subparser in (apply_parser, interactive_parser):
-        subparser.add_argument("-o", "--osd-map", default=None, help="Use dumped OSD map")
         subparser.add_argument("-p", "--per-osd", action="store_true",
                                help="Report per OSD stats")
+
+    for subparser in (apply_parser, interactive_parser, batch_parser):
+        subparser.add_argument("-o", "--osd-map", default=None, help="Use dumped OSD map")
         subparser.add_argument("-g", "--pg-dump", default=None,
                                help="Use dumped PG info (must be in json format)")
+        subparser.add_argument("-t", "--osdmaptool", action="store_true",
+                               help="Calculate PG mapping with osdmaptool instead of in-process engine")
+        subparser.add_argument("-P", "--per-pool", action="store_true",
+                               help="Run separated osdmaptool --pool process for every pool")
+        subparser.add_argument("-j", "--jobs", type=int, default=None,
+                               help="Max number of mapping processes (cpu count by default)")
 
     return parser.parse_args(argv)
 
@@ -195,73 +536,176 @@ def calculate_remap_crush(new_crush_f, pg_dump_f=None, osd_map_name=None):
             return calculate_remap(osd_map_name, osd_map_new_fd.name, pg_dump_f=pg_dump_f)
 
 
-def calculate_remap(curr_map_f, new_map_f, pg_dump_f=None):
-    curr_distr = run_locally("osdmaptool --test-map-pgs-dump {0}".format(curr_map_f)).decode("utf8")
-    curr_pools = {pool.pid: pool for pool in parse(curr_distr)}
+def calculate_remap(curr_map_f, new_map_f, pg_dump_f=None, use_osdmaptool=False, per_pool=False, jobs=None,
+                    new_reweights=None):
+    "new_reweights - {osd_id: reweight}, applied to new map before mapping"
+    # pg dump is loaded, while mapping is calculated by worker processes
+    (curr_pools, new_pools), pg_sizes = map_pgs([curr_map_f, new_map_f], use_osdmaptool, per_pool, jobs,
+                                                background=lambda: get_pg_sizes(pg_dump_f),
+                                                reweights=[None, new_reweights])
+
+    return remap_diff(curr_pools, new_pools, pg_sizes)
 
-    new_distr = run_locally("osdmaptool --test-map-pgs-dump {0}".format(new_map_f)).decode("utf8")
-    new_pools = {pool.pid: pool for pool in parse(new_distr)}
 
+def remap_diff(curr_pools, new_pools, pg_sizes):
     pool_pairs = {pool.pid: (curr_pools[pool.pid], pool) for pool in new_pools.values()}
-    pg_dump_js = open(pg_dump_f).read() if pg_dump_f else None
-    pg_sizes = get_pg_sizes(pg_dump_js)
     return get_osd_diff(pool_pairs, pg_sizes)
 
 
+def calculate_remap_steps(map_files, pg_dump_f=None, use_osdmaptool=False, per_pool=False, jobs=None,
+                          reweights=None):
+    """
+    Remap for every consecutive pair of osd maps and for direct change from the first map to the last one.
+    All maps are mapped in one process pool.
+    reweights - list of {osd_id: reweight} or None, one per map file, see map_pgs
+    Returns ([osd_changes for every step], osd_changes for direct change)
+    """
+    maps, pg_sizes = map_pgs(map_files, use_osdmaptool, per_pool, jobs, background=lambda: get_pg_sizes(pg_dump_f),
+                             reweights=reweights)
+    steps = [remap_diff(curr_pools, new_pools, pg_sizes) for curr_pools, new_pools in zip(maps[:-1], maps[1:])]
+    return steps, remap_diff(maps[0], maps[-1], pg_sizes)
+
+
+def compile_if_needed(crush_map_f):
+    "Returns compiled crush map, crush_map_f may be either text or already compiled crush"
+    if b'\x00' in open(crush_map_f, 'rb').read(1024):
+        logger.debug("%s is already compiled crush map", crush_map_f)
+        return crush_map_f
+    return artifact_cache.compile_crush(crush_map_f)
+
+
+def import_crush(osd_map_f, crush_map_f):
+    "Copy of osd map with crush replaced by crush_map_f, original map file is left untouched"
+    osd_map_new_f = tmpnam()
+    shutil.copy(osd_map_f, osd_map_new_f)
+    run_locally("osdmaptool --import-crush {0} {1}".format(compile_if_needed(crush_map_f), osd_map_new_f))
+    return osd_map_new_f
+
+
+class RemapStats(object):
+    "Totals and the most loaded receiver for remap"
+    def __init__(self, name, osd_changes):
+        self.name = name
+        self.bytes_moved = sum(osd_ch.bytes_in for osd_ch in osd_changes.values())
+        self.pg_moved = sum(osd_ch.pg_in for osd_ch in osd_changes.values())
+        self.worst_osd = None
+        self.worst_inflow = 0
+        if osd_changes:
+            self.worst_osd, worst = max(osd_changes.items(), key=lambda item: (item[1].bytes_in, -item[0]))
+            self.worst_inflow = worst.bytes_in
+
+
+def evaluate_candidates(curr_map_f, crush_files, pg_dump_f=None, use_osdmaptool=False, per_pool=False, jobs=None):
+    """
+    Calculate remap for every candidate crush against the same osd map.
+    Baseline mapping and PG sizes are calculated once, candidates are mapped in parallel.
+    Returns list of RemapStats, ranked by moved data
+    """
+    new_map_files = [import_crush(curr_map_f, crush_f) for crush_f in crush_files]
+    maps, pg_sizes = map_pgs([curr_map_f] + new_map_files, use_osdmaptool, per_pool, jobs,
+                             background=lambda: get_pg_sizes(pg_dump_f))
+    curr_pools = maps[0]
+
+    res = [RemapStats(crush_f, remap_diff(curr_pools, new_pools, pg_sizes))
+           for crush_f, new_pools in zip(crush_files, maps[1:])]
+
+    res.sort(key=lambda stats: (stats.bytes_moved, stats.pg_moved, stats.worst_inflow))
+    return res
+
+
+def list_crush_files(paths):
+    "Expand directories into files they contain"
+    res = []
+    for path in paths:
+        if os.path.isdir(path):
+            res.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                              if os.path.isfile(os.path.join(path, name))))
+        else:
+            res.append(path)
+    return res
+
+
+def show_candidates(candidates):
+    name_w = max([len("Crush")] + [len(stats.name) for stats in candidates])
+    templ = "{0:>4}  {1:<{w}}  {2:>10}  {3:>9}  {4:>9}  {5:>12}"
+    print(templ.format("Rank", "Crush", "Moved", "PG moved", "Worst OSD", "Worst inflow", w=name_w))
+    for rank, stats in enumerate(candidates, 1):
+        print(templ.format(rank, stats.name, b2ssize(stats.bytes_moved) + "B", stats.pg_moved,
+                           "-" if stats.worst_osd is None else stats.worst_osd,
+                           b2ssize(stats.worst_inflow) + "B", w=name_w))
+
+
 def main(argv):
     opts = parse_args(argv[1:])
 
     default_level = logging.DEBUG if opts.verbose else logging.WARNING
     setup_loggers([clogger, logger], default_level=default_level)
 
-    if opts.subparser_name == 'dump':
-        crush_map_f = tmpnam()
-
-        if opts.osd_map:
-            run_locally("osdmaptool --export-crush {0} {1}".format(crush_map_f, opts.osd_map))
-        else:
-            run_locally("ceph osd getcrushmap -o {0}".format(crush_map_f))
+    cluster = cluster_snapshot.ClusterSnapshot.from_opts(opts)
 
-        run_locally("crushtool -d {0} -o {1}".format(crush_map_f, opts.out_file))
+    if opts.subparser_name == 'dump':
+        shutil.copy(cluster.crushmap_txt_f, opts.out_file)
         return 0
 
-    if opts.osd_map:
-        osd_map_f = opts.osd_map
-    else:
-        osd_map_f = tmpnam()
-        run_locally("ceph osd getmap -o {0}".format(osd_map_f))
+    if opts.subparser_name == 'verify':
+        failed = 0
+        for osd_map_f in opts.osd_maps:
+            if opts.record:
+                record_mapping(osd_map_f, opts.record)
+            map_failed = verify_mapping(osd_map_f)
+            print("{0}: {1} PG mapped differently".format(osd_map_f, map_failed))
+            failed += map_failed
+        return 1 if failed else 0
+
+    osd_map_f = cluster.osd_map_f
+
+    if opts.subparser_name == "optimize":
+        modes = weight_optimizer.MODES if opts.mode == 'both' else (opts.mode,)
+        max_move = None if opts.max_move is None else ssize2b(opts.max_move)
+        optimizer = weight_optimizer.optimize_weights(osd_map_f, cluster.pg_sizes, metric=opts.metric,
+                                                      modes=modes, max_move=max_move, max_step=opts.step,
+                                                      max_iterations=opts.iterations,
+                                                      min_weight_diff=opts.min_weight_diff,
+                                                      min_reweight_diff=opts.min_reweight_diff,
+                                                      allow_increase=opts.allow_increase)
+        weights, reweights = optimizer.changes()
+        config = optimizer.rebalance_config(step=opts.rebalance_step, restep=opts.rebalance_restep,
+                                            max_updated_nodes=opts.max_updated_nodes,
+                                            min_weight_diff=opts.min_weight_diff,
+                                            min_reweight_diff=opts.min_reweight_diff)
+        with open(opts.out_file, "w") as fd:
+            weight_optimizer.dump_config(config, fd)
+
+        print("Weight changes  :", len(weights))
+        print("Reweight changes:", len(reweights))
+        print("Usage spread    : {0:.2%} => {1:.2%}".format(optimizer.start_score, optimizer.score))
+        print("Total moved     :", b2ssize(optimizer.moved_bytes) + "B")
+        return 0
 
-    crush_map_f = tmpnam()
+    if opts.subparser_name == "batch":
+        crush_files = list_crush_files(opts.crush_files)
+        if not crush_files:
+            logger.error("No crush files found")
+            return 1
+        show_candidates(evaluate_candidates(osd_map_f, crush_files, cluster, use_osdmaptool=opts.osdmaptool,
+                                            per_pool=opts.per_pool, jobs=opts.jobs))
+        return 0
 
     if opts.subparser_name == "apply":
         crush_map_txt_f = opts.crush_file
     else:
         assert opts.subparser_name == "interactive"
-        run_locally("osdmaptool --export-crush {0} {1}".format(crush_map_f, osd_map_f))
         crush_map_txt_f = tmpnam()
-        run_locally("crushtool -d {0} -o {1}".format(crush_map_f, crush_map_txt_f))
+        shutil.copy(cluster.crushmap_txt_f, crush_map_txt_f)
         run_locally("{0} {1}".format(opts.editor, crush_map_txt_f))
 
         logger.info("Press enter, when done")
         sys.stdin.readline()
 
-    if b'\x00' in open(crush_map_f, 'rb').read(1024):
-        run_locally("crushtool -c {0} -o {1}".format(crush_map_txt_f, crush_map_f))
-    else:
-        print("Get already compiled crush map")
-        shutil.copy(crush_map_txt_f, crush_map_f)
-
-    if opts.osd_map:
-        # don't change original osd map file
-        osd_map_new_f = tmpnam()
-        shutil.copy(osd_map_f, osd_map_new_f)
-        logger.debug("Copy {0} => {1}".format(osd_map_f, osd_map_new_f))
-    else:
-        osd_map_new_f = osd_map_f
-
-    run_locally("osdmaptool --import-crush {0} {1}".format(crush_map_f, osd_map_new_f))
+    osd_map_new_f = import_crush(osd_map_f, crush_map_txt_f)
 
-    osd_changes = calculate_remap(osd_map_f, osd_map_new_f, opts.pg_dump)
+    osd_changes = calculate_remap(osd_map_f, osd_map_new_f, cluster, use_osdmaptool=opts.osdmaptool,
+                                  per_pool=opts.per_pool, jobs=opts.jobs)
 
     total_send = 0
     total_moved_pg = 0
@@ -1,21 +1,13 @@
 import json
-import collections
 
-from cephlib.common import run
+from cluster_topology import ClusterTopology, OsdAddrs, live_topology
 
 
-OsdAddrs = collections.namedtuple('OsdAddrs', ("public", "cluster"))
+__all__ = ['OsdAddrs', 'get_all_osds']
 
 
 def get_all_osds(osd_dump=None):
+    "{osd_id: OsdAddrs} from osd dump json or from shared live cluster topology"
     if osd_dump is None:
-        osd_dump = run("ceph osd dump --format=json")
-
-    osd_addrs = {}
-    for osd in json.loads(osd_dump)['osds']:
-        osd_addrs[int(osd['osd'])] = OsdAddrs(osd['cluster_addr'].split('/')[0],
-                                              osd['public_addr'].split('/')[0])
-
-    return osd_addrs
-
-
+        return live_topology().addrs()
+    return ClusterTopology.from_dumps(json.loads(osd_dump)).addrs()
@@ -0,0 +1,173 @@
+"""
+Cluster state, shared by estimation, update and verification phases of tools.
+
+Every artifact (osd map, crush map in binary and text form, parsed crush tree, osd tree,
+pg dump) is fetched and parsed on first access only and kept until osd map epoch of
+live cluster changes. Artifacts, passed as files, are never refetched. OSD topology
+(cluster_topology) is kept over epoch change and only updated for changed OSDs.
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+
+from cephlib.common import run_locally, tmpnam
+from cephlib.crush import load_crushmap
+
+import artifact_cache
+import pg_snapshot
+import cluster_topology
+from cluster_topology import current_epoch
+
+
+logger = logging.getLogger("ceph.snapshot")
+
+
+class MissingArtifact(Exception):
+    pass
+
+
+class ClusterSnapshot(object):
+    """
+    osd_map_f, osd_tree_f, pg_dump_f - files to use instead of live cluster data.
+    offline - never access cluster, MissingArtifact is raised for artifacts, which has no file
+    """
+    def __init__(self, osd_map_f=None, osd_tree_f=None, pg_dump_f=None, offline=False):
+        self.osd_map_file = osd_map_f
+        self.osd_tree_file = osd_tree_f
+        self.pg_dump_file = pg_dump_f
+        self.offline = offline
+        self.fields = {}
+        # kept over invalidation, to be updated incrementally
+        self.topology_cache = None
+
+    @classmethod
+    def from_opts(cls, opts):
+        "Snapshot for cli options, options, which tool doesn't have, are treated as not passed"
+        return cls(osd_map_f=getattr(opts, 'osd_map', None), osd_tree_f=getattr(opts, 'osd_tree', None),
+                   pg_dump_f=getattr(opts, 'pg_dump', None), offline=getattr(opts, 'offline', False))
+
+    def field(self, name, loader):
+        if name not in self.fields:
+            self.fields[name] = loader()
+        return self.fields[name]
+
+    def invalidate(self):
+        self.fields.clear()
+
+    def refresh(self):
+        """
+        Drop all loaded artifacts, if osd map epoch of live cluster differs from loaded one.
+        Returns True if snapshot was invalidated
+        """
+        if self.offline or self.osd_map_file is not None or 'osd_map_f' not in self.fields:
+            return False
+        epoch = current_epoch()
+        if epoch == self.epoch:
+            return False
+        logger.debug("osd map epoch changed %s => %s, drop cluster snapshot", self.epoch, epoch)
+        self.invalidate()
+        return True
+
+    def fetch(self, what, cmd):
+        if self.offline:
+            raise MissingArtifact("Can't get {0} in offline mode, pass it as file".format(what))
+        return run_locally(cmd)
+
+    def load_osd_map(self):
+        if self.osd_map_file is not None:
+            return self.osd_map_file
+        osd_map_f = tmpnam()
+        self.fetch("osd map", "ceph osd getmap -o {0}".format(osd_map_f))
+        return osd_map_f
+
+    @property
+    def osd_map_f(self):
+        "Binary osd map file, must not be changed"
+        return self.field('osd_map_f', self.load_osd_map)
+
+    @property
+    def osd_dump(self):
+        "Decoded 'osdmaptool --dump json' of osd map"
+        return self.field('osd_dump', lambda: json.loads(artifact_cache.dump_osdmap(self.osd_map_f)))
+
+    @property
+    def epoch(self):
+        return self.osd_dump['epoch']
+
+    @property
+    def crushmap_bin_f(self):
+        "Binary crush map file from cache, must not be changed"
+        return self.field('crushmap_bin_f', lambda: artifact_cache.export_crush(self.osd_map_f))
+
+    @property
+    def crushmap_txt_f(self):
+        return self.field('crushmap_txt_f', lambda: artifact_cache.decompile_crush(self.crushmap_bin_f))
+
+    @property
+    def crush(self):
+        "Crush tree, parsed by cephlib"
+        return self.field('crush', lambda: load_crushmap(self.crushmap_txt_f))
+
+    def load_osd_tree(self):
+        if self.osd_tree_file is not None:
+            with open(self.osd_tree_file) as fd:
+                return json.load(fd)
+        return json.loads(self.fetch("osd tree", "ceph osd tree --format=json").decode("utf8"))
+
+    @property
+    def osd_tree(self):
+        return self.field('osd_tree', self.load_osd_tree)
+
+    def load_topology(self):
+        osd_tree = None
+        # live osd tree doesn't match osd map from file
+        if self.osd_tree_file is not None or self.osd_map_file is None:
+            try:
+                osd_tree = self.osd_tree
+            except MissingArtifact as exc:
+                logger.debug("%s. Topology has no hosts and crush locations", exc)
+        if self.topology_cache is None:
+            self.topology_cache = cluster_topology.ClusterTopology()
+        self.topology_cache.update(self.osd_dump, osd_tree)
+        return self.topology_cache
+
+    @property
+    def topology(self):
+        "cluster_topology.ClusterTopology of osd map and osd tree"
+        return self.field('topology', self.load_topology)
+
+    @property
+    def reweights(self):
+        "{osd name: reweight} from osd map"
+        return {info.name: info.reweight for info in self.topology}
+
+    def load_pgs(self):
+        if self.pg_dump_file is None and self.offline:
+            raise MissingArtifact("Can't get pg dump in offline mode, pass it as file")
+        return pg_snapshot.load_pg_snapshot(self.pg_dump_file)
+
+    @property
+    def pgs(self):
+        "pg_snapshot.PGSnapshot of pg dump"
+        return self.field('pgs', self.load_pgs)
+
+    @property
+    def pg_sizes(self):
+        "{pool_id: int64 array of PG sizes, indexed by pg number}"
+        return self.field('pg_sizes', lambda: self.pgs.pool_pg_sizes())
+
+
+def pgs_of(pg_source=None):
+    "PGSnapshot from ClusterSnapshot, pg dump file or live cluster, if pg_source is None"
+    if isinstance(pg_source, ClusterSnapshot):
+        return pg_source.pgs
+    return pg_snapshot.load_pg_snapshot(pg_source)
+
+
+def pg_sizes_of(pg_source=None):
+    "PG sizes from ClusterSnapshot, pg dump file or live cluster, if pg_source is None"
+    if isinstance(pg_source, ClusterSnapshot):
+        return pg_source.pg_sizes
+    return pg_snapshot.load_pg_snapshot(pg_source).pool_pg_sizes()
@@ -0,0 +1,204 @@
+"""
+OSD topology of cluster: addresses, up/in state, reweight, host and crush location of every OSD,
+indexed by osd id, ip and host.
+
+Topology is built from osd dump (json of 'ceph osd dump' or 'osdmaptool --dump') and osd tree.
+On osd map epoch change only OSDs, which dump entry changed, are reindexed, and osd tree is
+reloaded only if crush version changed. Live topology is shared by all users in process,
+see live_topology().
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import collections
+
+from cephlib.common import run_locally
+
+
+logger = logging.getLogger("ceph.topology")
+
+
+OsdAddrs = collections.namedtuple('OsdAddrs', ("public", "cluster"))
+
+# addrs - OsdAddrs of 'ip:port', location - {crush type: bucket name} of all OSD ancestors,
+# host - location['host'] or None
+OsdInfo = collections.namedtuple('OsdInfo', ("id", "name", "addrs", "up", "in_", "reweight", "primary_affinity",
+                                             "host", "location"))
+
+
+def current_epoch():
+    "osd map epoch of live cluster"
+    osd_stat = json.loads(run_locally("ceph osd stat --format=json").decode("utf8"))
+    return osd_stat.get('osdmap', osd_stat).get('epoch')
+
+
+def addr_ip(addr):
+    "ip from ceph address 'ip:port/nonce' or '[ipv6]:port', None for unbound address"
+    host_port = addr.split('/')[0]
+    if host_port.startswith('['):
+        ip = host_port[1:].split(']')[0]
+    else:
+        ip = host_port.rsplit(':', 1)[0]
+    return None if ip in ('', '-', '0.0.0.0', '::') else ip
+
+
+def tree_locations(osd_tree):
+    "{osd id: {crush type: bucket name}} from 'ceph osd tree' json"
+    nodes = {node['id']: node for node in osd_tree['nodes']}
+    parents = {}
+    for node in osd_tree['nodes']:
+        for child in node.get('children', ()):
+            parents.setdefault(child, node['id'])
+
+    locations = {}
+    for node in osd_tree['nodes']:
+        if node['type'] != 'osd':
+            continue
+        location = {}
+        parent = parents.get(node['id'])
+        while parent is not None:
+            location[nodes[parent]['type']] = nodes[parent]['name']
+            parent = parents.get(parent)
+        locations[node['id']] = location
+    return locations
+
+
+class ClusterTopology(object):
+    def __init__(self):
+        self.epoch = None
+        self.crush_version = None
+        self.osds = {}
+        self.by_ip = {}
+        self.by_host = {}
+        # osd dump entries and crush locations, to find changed OSDs on update
+        self.raw = {}
+        self.locations = {}
+
+    def __len__(self):
+        return len(self.osds)
+
+    def __iter__(self):
+        return iter(self.osds.values())
+
+    def __contains__(self, osd_id):
+        return osd_id in self.osds
+
+    def osd(self, osd_id):
+        return self.osds[osd_id]
+
+    def osds_by_ip(self, ip):
+        "OsdInfo list of OSDs, which public or cluster address has ip"
+        return [self.osds[osd_id] for osd_id in sorted(self.by_ip.get(ip, ()))]
+
+    def host_osds(self, host):
+        return [self.osds[osd_id] for osd_id in sorted(self.by_host.get(host, ()))]
+
+    def hosts(self):
+        return sorted(self.by_host)
+
+    def addrs(self):
+        "{osd id: OsdAddrs}"
+        return {osd_id: info.addrs for osd_id, info in self.osds.items()}
+
+    def unindex(self, info):
+        for ip in set(map(addr_ip, info.addrs)):
+            ids = self.by_ip.get(ip)
+            if ids is not None:
+                ids.discard(info.id)
+                if not ids:
+                    del self.by_ip[ip]
+        if info.host is not None:
+            ids = self.by_host[info.host]
+            ids.discard(info.id)
+            if not ids:
+                del self.by_host[info.host]
+
+    def index(self, info):
+        self.osds[info.id] = info
+        for ip in set(map(addr_ip, info.addrs)):
+            if ip is not None:
+                self.by_ip.setdefault(ip, set()).add(info.id)
+        if info.host is not None:
+            self.by_host.setdefault(info.host, set()).add(info.id)
+
+    def make_info(self, osd):
+        osd_id = int(osd['osd'])
+        location = self.locations.get(osd_id, {})
+        addrs = OsdAddrs(osd.get('public_addr', '').split('/')[0], osd.get('cluster_addr', '').split('/')[0])
+        return OsdInfo(osd_id, "osd.{0}".format(osd_id), addrs, bool(osd.get('up')), bool(osd.get('in')),
+                       float(osd.get('weight', 1.0)), float(osd.get('primary_affinity', 1.0)),
+                       location.get('host'), location)
+
+    def update(self, osd_dump, osd_tree=None):
+        """
+        Apply osd dump and, if passed, osd tree. Returns number of reindexed OSDs.
+        Dump of the same epoch is ignored, unless new osd tree is passed
+        """
+        epoch = osd_dump.get('epoch')
+        if epoch is not None and epoch == self.epoch and osd_tree is None:
+            return 0
+
+        relocated = set()
+        if osd_tree is not None:
+            locations = tree_locations(osd_tree)
+            relocated = {osd_id for osd_id in set(locations) | set(self.locations)
+                         if locations.get(osd_id) != self.locations.get(osd_id)}
+            self.locations = locations
+
+        dump_osds = {int(osd['osd']): osd for osd in osd_dump['osds']}
+        changed = 0
+        for osd_id in set(self.osds) - set(dump_osds):
+            self.unindex(self.osds.pop(osd_id))
+            del self.raw[osd_id]
+            changed += 1
+
+        for osd_id, osd in dump_osds.items():
+            if self.raw.get(osd_id) == osd and osd_id not in relocated:
+                continue
+            if osd_id in self.osds:
+                self.unindex(self.osds[osd_id])
+            self.index(self.make_info(osd))
+            self.raw[osd_id] = osd
+            changed += 1
+
+        logger.debug("Topology epoch %s => %s, %s OSDs reindexed", self.epoch, epoch, changed)
+        self.epoch = epoch
+        self.crush_version = osd_dump.get('crush_version')
+        return changed
+
+    def refresh(self):
+        """
+        Update from live cluster, if its osd map epoch differs from loaded one.
+        osd tree is fetched only if crush version changed. Returns True if topology was updated
+        """
+        if self.epoch is not None and current_epoch() == self.epoch:
+            return False
+        osd_dump = json.loads(run_locally("ceph osd dump --format=json").decode("utf8"))
+        osd_tree = None
+        crush_version = osd_dump.get('crush_version')
+        if self.epoch is None or crush_version is None or crush_version != self.crush_version:
+            osd_tree = json.loads(run_locally("ceph osd tree --format=json").decode("utf8"))
+        self.update(osd_dump, osd_tree)
+        return True
+
+    @classmethod
+    def from_dumps(cls, osd_dump, osd_tree=None):
+        topology = cls()
+        topology.update(osd_dump, osd_tree)
+        return topology
+
+
+_live_topology = None
+
+
+def live_topology(refresh=True):
+    "Topology of live cluster, shared in process, refreshed from cluster if its epoch changed"
+    global _live_topology
+    if _live_topology is None:
+        _live_topology = ClusterTopology()
+        refresh = True
+    if refresh:
+        _live_topology.refresh()
+    return _live_topology
@@ -0,0 +1,817 @@
+"""
+In-process PG => OSD mapping, a numpy port of ceph's crush_do_rule.
+
+All PGs of a pool are mapped at once: every PG is a "lane" and the CRUSH retry
+loops are run for all lanes together, grouping lanes by the bucket they currently
+descend through. Only straw2 buckets with rjenkins1 hash and the modern
+(bobtail+) local retry tunables are supported, anything else raises
+UnsupportedMap, so callers can fall back to osdmaptool.
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+
+import numpy
+
+import artifact_cache
+from crush_ln_table import RH_LH_TBL, LL_TBL
+
+
+logger = logging.getLogger("remap.crush")
+
+
+CRUSH_HASH_SEED = 1315423911
+CRUSH_ITEM_UNDEF = 0x7ffffffe
+CRUSH_ITEM_NONE = 0x7fffffff
+POOL_FLAG_HASHPSPOOL = 1
+POOL_TYPE_ERASURE = 3
+WEIGHT_ONE = 0x10000
+MAX_PRIMARY_AFFINITY = 0x10000
+
+# marks empty slot in mapping arrays
+NO_OSD = -1
+
+
+class UnsupportedMap(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# rjenkins1 hash and crush_ln, all functions works on numpy arrays
+
+
+def _u32(val):
+    return numpy.atleast_1d(numpy.asarray(val)).astype(numpy.uint32)
+
+
+def _hashmix(a, b, c):
+    # in place, all arguments must be writable uint32 arrays of the same shape
+    for shift_a, shift_b, shift_c in ((13, 8, 13), (12, 16, 5), (3, 10, 15)):
+        a -= b
+        a -= c
+        a ^= c >> shift_a
+        b -= c
+        b -= a
+        b ^= a << shift_b
+        c -= a
+        c -= b
+        c ^= b >> shift_c
+
+
+def _hash_args(*args):
+    return [numpy.array(arr) for arr in numpy.broadcast_arrays(*[_u32(arg) for arg in args])]
+
+
+def crush_hash32_2(a, b):
+    a, b = _hash_args(a, b)
+    x = numpy.full(a.shape, 231232, dtype=numpy.uint32)
+    y = numpy.full(a.shape, 1232, dtype=numpy.uint32)
+    h = numpy.uint32(CRUSH_HASH_SEED) ^ a ^ b
+    _hashmix(a, b, h)
+    _hashmix(x, a, h)
+    _hashmix(b, y, h)
+    return h
+
+
+def crush_hash32_3(a, b, c):
+    a, b, c = _hash_args(a, b, c)
+    x = numpy.full(a.shape, 231232, dtype=numpy.uint32)
+    y = numpy.full(a.shape, 1232, dtype=numpy.uint32)
+    h = numpy.uint32(CRUSH_HASH_SEED) ^ a ^ b ^ c
+    _hashmix(a, b, h)
+    _hashmix(c, x, h)
+    _hashmix(y, a, h)
+    _hashmix(b, x, h)
+    _hashmix(y, c, h)
+    return h
+
+
+def crush_ln(xin):
+    rh_lh, ll = RH_LH_TBL, LL_TBL
+    x = xin + 1
+    iexpon = 15
+
+    if not x & 0x18000:
+        bits = 16 - x.bit_length()
+        x <<= bits
+        iexpon = 15 - bits
+
+    index1 = (x >> 8) << 1
+    rh = rh_lh[index1 - 256]
+    lh = rh_lh[index1 + 1 - 256]
+    xl64 = (x * rh) >> 48
+    lh += ll[xl64 & 0xff]
+    return (iexpon << 44) + (lh >> 4)
+
+
+_straw2_ln = None
+
+
+def straw2_ln_table():
+    "crush_ln(u) - 2^48 for all 16 bit u, as used by straw2 draw"
+    global _straw2_ln
+    if _straw2_ln is None:
+        _straw2_ln = numpy.array([crush_ln(u) - 0x1000000000000 for u in range(0x10000)],
+                                 dtype=numpy.int64)
+    return _straw2_ln
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# crush map
+
+
+class Bucket(object):
+    # max number of (lane, item) hash cells, computed at once
+    max_cells = 1 << 16
+
+    def __init__(self, bid, name, type_id, items, weights):
+        self.id = bid
+        self.name = name
+        self.type_id = type_id
+        self.items = numpy.array(items, dtype=numpy.int64)
+        self.weights = numpy.array(weights, dtype=numpy.int64)
+        self.item_keys = _u32(self.items)
+
+    def choose(self, x, r):
+        "straw2 choice for each lane"
+        res = numpy.empty(len(x), dtype=numpy.int64)
+        ln_table = straw2_ln_table()
+        zero_weight = self.weights == 0
+        weights = numpy.where(zero_weight, 1, self.weights)
+        chunk = max(1, self.max_cells // len(self.items))
+
+        for start in range(0, len(x), chunk):
+            xc = x[start: start + chunk, None]
+            rc = r[start: start + chunk, None]
+            u = crush_hash32_3(xc, self.item_keys[None, :], rc) & 0xffff
+            # ln <= 0, C div64_s64 rounds to zero
+            draw = -(-ln_table[u] // weights)
+            draw[:, zero_weight] = numpy.iinfo(numpy.int64).min
+            res[start: start + chunk] = self.items[numpy.argmax(draw, axis=1)]
+
+        return res
+
+
+class Rule(object):
+    def __init__(self, rid, name, steps, ruleset=None):
+        self.id = rid
+        self.name = name
+        self.steps = steps
+        self.ruleset = rid if ruleset is None else ruleset
+
+
+class CrushMap(object):
+    def __init__(self, buckets, rules, tunables, max_devices, type_names=None, device_names=None):
+        self.buckets = {bucket.id: bucket for bucket in buckets}
+        self.type_names = type_names or {}
+        self.device_names = device_names or {}
+        self.rules = {rule.id: rule for rule in rules}
+        self.max_devices = max_devices
+        self.choose_total_tries = tunables.get('choose_total_tries', 50)
+        self.chooseleaf_descend_once = tunables.get('chooseleaf_descend_once', 1)
+        self.chooseleaf_vary_r = tunables.get('chooseleaf_vary_r', 1)
+        self.chooseleaf_stable = tunables.get('chooseleaf_stable', 1)
+
+        if tunables.get('choose_local_tries', 0) or tunables.get('choose_local_fallback_tries', 0):
+            raise UnsupportedMap("legacy choose_local_tries/choose_local_fallback_tries tunables")
+
+        max_buckets = max([-bid for bid in self.buckets] + [0])
+        self.bucket_types = numpy.full(max_buckets, -1, dtype=numpy.int64)
+        self.bucket_sizes = numpy.zeros(max_buckets, dtype=numpy.int64)
+        for bucket in buckets:
+            self.bucket_types[-1 - bucket.id] = bucket.type_id
+            self.bucket_sizes[-1 - bucket.id] = len(bucket.items)
+
+    def parents(self, item):
+        "[(bucket, position)] for every bucket, which contains item"
+        res = []
+        for bucket in self.buckets.values():
+            for pos in numpy.nonzero(bucket.items == item)[0].tolist():
+                res.append((bucket, pos))
+        return res
+
+    def item_weight(self, item):
+        "16.16 weight of item in its first parent bucket"
+        for bucket, pos in self.parents(item):
+            return int(bucket.weights[pos])
+        return None
+
+    def set_item_weight(self, item, weight):
+        """
+        Set 16.16 weight of item in all buckets, propagating weight change to all ancestors,
+        as 'ceph osd crush reweight' does. Returns ids of all items, which weight has changed
+        """
+        changed = set()
+        for bucket, pos in self.parents(item):
+            diff = weight - int(bucket.weights[pos])
+            if diff:
+                bucket.weights[pos] = weight
+                changed.add(item)
+                changed.update(self.set_item_weight(bucket.id, int(bucket.weights.sum())))
+        return changed
+
+    def leaves(self, item):
+        "All devices under item"
+        if item >= 0:
+            return [item]
+        res = []
+        for child in self.buckets[item].items.tolist():
+            res.extend(self.leaves(child))
+        return res
+
+    def path(self, item):
+        "[(type name, bucket name)] from root to item parent, using first parent on every level"
+        res = []
+        parents = self.parents(item)
+        while parents:
+            bucket = parents[0][0]
+            res.append((self.type_names.get(bucket.type_id, str(bucket.type_id)), bucket.name))
+            parents = self.parents(bucket.id)
+        return res[::-1]
+
+    def find_rule(self, rule_id):
+        if rule_id in self.rules:
+            return self.rules[rule_id]
+        for rule in self.rules.values():
+            if rule.ruleset == rule_id:
+                return rule
+        raise UnsupportedMap("No crush rule {0}".format(rule_id))
+
+    def item_types(self, items):
+        "type id for each item, -1 for unknown items"
+        res = numpy.zeros(len(items), dtype=numpy.int64)
+        is_bucket = items < 0
+        bidx = -1 - items[is_bucket]
+        known = bidx < len(self.bucket_types)
+        res[is_bucket] = numpy.where(known, self.bucket_types[numpy.where(known, bidx, 0)], -1)
+        res[items >= self.max_devices] = -1
+        return res
+
+    def is_bucket(self, items):
+        bidx = -1 - items
+        res = (bidx >= 0) & (bidx < len(self.bucket_types))
+        res[res] = self.bucket_types[bidx[res]] != -1
+        return res
+
+    def bucket_choose(self, bucket_ids, x, r):
+        res = numpy.empty(len(x), dtype=numpy.int64)
+        for bid in numpy.unique(bucket_ids):
+            lanes = numpy.nonzero(bucket_ids == bid)[0]
+            res[lanes] = self.buckets[int(bid)].choose(x[lanes], r[lanes])
+        return res
+
+    def descend(self, x, bucket_ids, r, type_id):
+        """
+        Go down the tree from bucket_ids till item of type_id found.
+        Returns (items, status), status is 0 - found, 1 - reject (empty bucket), 2 - skip replica
+        """
+        found = numpy.full(len(x), CRUSH_ITEM_NONE, dtype=numpy.int64)
+        status = numpy.zeros(len(x), dtype=numpy.int8)
+        curr = numpy.array(bucket_ids, dtype=numpy.int64)
+        active = numpy.arange(len(x))
+
+        while active.size:
+            empty = self.bucket_sizes[-1 - curr[active]] == 0
+            status[active[empty]] = 1
+            active = active[~empty]
+            if not active.size:
+                break
+
+            items = self.bucket_choose(curr[active], x[active], r[active])
+            types = self.item_types(items)
+            hit = types == type_id
+            found[active[hit]] = items[hit]
+            deeper = ~hit & (items < 0) & (types != -1)
+            status[active[~hit & ~deeper]] = 2
+            curr[active[deeper]] = items[deeper]
+            active = active[deeper]
+
+        return found, status
+
+    @staticmethod
+    def is_out(weights, items, x):
+        item_w = numpy.zeros(len(items), dtype=numpy.int64)
+        valid = (items >= 0) & (items < len(weights))
+        item_w[valid] = weights[items[valid]]
+        out = item_w < WEIGHT_ONE
+        partial = numpy.nonzero(out & (item_w > 0))[0]
+        if partial.size:
+            hashes = crush_hash32_2(x[partial], items[partial]) & 0xffff
+            out[partial] = hashes >= item_w[partial]
+        return out
+
+    @staticmethod
+    def collides(out, outpos, items):
+        if out.shape[1] == 0:
+            return numpy.zeros(len(items), dtype=bool)
+        placed = numpy.arange(out.shape[1])[None, :] < outpos[:, None]
+        return ((out == items[:, None]) & placed).any(axis=1)
+
+    def choose_one_firstn(self, x, bucket_ids, rep, parent_r, type_id, out, outpos, tries, weights,
+                          out2=None, recurse_tries=0, vary_r=1, stable=1):
+        "one iteration of crush_choose_firstn replica loop for all lanes"
+        ok = numpy.zeros(len(x), dtype=bool)
+        items = numpy.full(len(x), CRUSH_ITEM_NONE, dtype=numpy.int64)
+        leafs = items.copy()
+        pending = numpy.arange(len(x))
+        rep = numpy.broadcast_to(rep, (len(x),))
+        ftotal = 0
+
+        while pending.size and ftotal < tries:
+            r = rep[pending] + parent_r[pending] + ftotal
+            chosen, status = self.descend(x[pending], bucket_ids[pending], r, type_id)
+            good = status == 0
+            good &= ~self.collides(out[pending], outpos[pending], chosen)
+            leaf = chosen.copy()
+
+            if out2 is not None:
+                sub = numpy.nonzero(good & (chosen < 0))[0]
+                if sub.size:
+                    lanes = pending[sub]
+                    sub_r = r[sub] >> (vary_r - 1) if vary_r else numpy.zeros(sub.size, dtype=numpy.int64)
+                    sub_rep = 0 if stable else outpos[lanes]
+                    got, leaf[sub], _ = self.choose_one_firstn(x[lanes], chosen[sub], sub_rep, sub_r, 0,
+                                                               out2[lanes], outpos[lanes], recurse_tries, weights)
+                    good[sub] = got
+
+            if type_id == 0:
+                cand = numpy.nonzero(good)[0]
+                good[cand] = ~self.is_out(weights, chosen[cand], x[pending[cand]])
+
+            done = pending[good]
+            ok[done] = True
+            items[done] = chosen[good]
+            leafs[done] = leaf[good]
+            pending = pending[~good & (status != 2)]
+            ftotal += 1
+
+        return ok, items, leafs
+
+    def choose_firstn(self, x, bucket_ids, numrep, type_id, count, tries, recurse_tries, recurse_to_leaf,
+                      weights, vary_r, stable):
+        out = numpy.full((len(x), numrep), CRUSH_ITEM_NONE, dtype=numpy.int64)
+        out2 = out.copy()
+        outpos = numpy.zeros(len(x), dtype=numpy.int64)
+        zero_r = numpy.zeros(len(x), dtype=numpy.int64)
+
+        for rep in range(numrep):
+            lanes = numpy.nonzero(outpos < count)[0]
+            if not lanes.size:
+                break
+            ok, items, leafs = self.choose_one_firstn(x[lanes], bucket_ids[lanes], rep, zero_r[lanes], type_id,
+                                                      out[lanes], outpos[lanes], tries, weights,
+                                                      out2[lanes] if recurse_to_leaf else None,
+                                                      recurse_tries, vary_r, stable)
+            sel = lanes[ok]
+            out[sel, outpos[sel]] = items[ok]
+            out2[sel, outpos[sel]] = leafs[ok]
+            outpos[sel] += 1
+
+        return out, out2, outpos
+
+    def choose_leaf_indep(self, x, bucket_ids, rep, parent_r, numrep, tries, weights):
+        "nested crush_choose_indep call for single slot with type 0"
+        res = numpy.full(len(x), CRUSH_ITEM_NONE, dtype=numpy.int64)
+        pending = numpy.arange(len(x))
+        for ftotal in range(tries):
+            if not pending.size:
+                break
+            r = rep[pending] + parent_r[pending] + numrep * ftotal
+            chosen, status = self.descend(x[pending], bucket_ids[pending], r, 0)
+            good = status == 0
+            cand = numpy.nonzero(good)[0]
+            good[cand] = ~self.is_out(weights, chosen[cand], x[pending[cand]])
+            res[pending[good]] = chosen[good]
+            pending = pending[~good & (status != 2)]
+        return res
+
+    def choose_indep(self, x, bucket_ids, numrep, type_id, out_size, tries, recurse_tries, recurse_to_leaf,
+                     weights):
+        out = numpy.full((len(x), numrep), CRUSH_ITEM_UNDEF, dtype=numpy.int64)
+        out2 = out.copy()
+        slots = numpy.arange(numrep)[None, :] < out_size[:, None]
+        out[~slots] = CRUSH_ITEM_NONE
+        out2[~slots] = CRUSH_ITEM_NONE
+
+        for ftotal in range(tries):
+            if not (out == CRUSH_ITEM_UNDEF).any():
+                break
+            for rep in range(numrep):
+                lanes = numpy.nonzero(out[:, rep] == CRUSH_ITEM_UNDEF)[0]
+                if not lanes.size:
+                    continue
+
+                r = numpy.full(lanes.size, rep + numrep * ftotal, dtype=numpy.int64)
+                chosen, status = self.descend(x[lanes], bucket_ids[lanes], r, type_id)
+                skip = status == 2
+                out[lanes[skip], rep] = CRUSH_ITEM_NONE
+                out2[lanes[skip], rep] = CRUSH_ITEM_NONE
+
+                good = status == 0
+                good &= ~self.collides(out[lanes], numpy.full(lanes.size, numrep), chosen)
+
+                if recurse_to_leaf:
+                    leaf = chosen.copy()
+                    sub = numpy.nonzero(good & (chosen < 0))[0]
+                    if sub.size:
+                        sub_lanes = lanes[sub]
+                        leaf[sub] = self.choose_leaf_indep(x[sub_lanes], chosen[sub],
+                                                           numpy.full(sub.size, rep), r[sub], numrep,
+                                                           recurse_tries, weights)
+                        good[sub] = leaf[sub] != CRUSH_ITEM_NONE
+                    out2[lanes[good], rep] = leaf[good]
+
+                if type_id == 0:
+                    cand = numpy.nonzero(good)[0]
+                    good[cand] = ~self.is_out(weights, chosen[cand], x[lanes[cand]])
+
+                out[lanes[good], rep] = chosen[good]
+
+        out[out == CRUSH_ITEM_UNDEF] = CRUSH_ITEM_NONE
+        out2[out2 == CRUSH_ITEM_UNDEF] = CRUSH_ITEM_NONE
+        return out, out2
+
+    def do_rule(self, rule, x, result_max, weights):
+        """
+        crush_do_rule for array of inputs x, returns array (len(x), result_max)
+        with CRUSH_ITEM_NONE in unused slots
+        """
+        nlanes = len(x)
+        x = _u32(x)
+        result = numpy.full((nlanes, result_max), CRUSH_ITEM_NONE, dtype=numpy.int64)
+        result_len = numpy.zeros(nlanes, dtype=numpy.int64)
+        work = numpy.zeros((nlanes, 0), dtype=numpy.int64)
+        wsize = numpy.zeros(nlanes, dtype=numpy.int64)
+
+        choose_tries = self.choose_total_tries + 1
+        choose_leaf_tries = 0
+        vary_r = self.chooseleaf_vary_r
+        stable = self.chooseleaf_stable
+
+        for step in rule.steps:
+            op = step['op']
+            if op == 'take':
+                work = numpy.full((nlanes, 1), step['item'], dtype=numpy.int64)
+                wsize = numpy.ones(nlanes, dtype=numpy.int64)
+            # as in crush_do_rule, out of range values keep current setting
+            elif op == 'set_choose_tries':
+                if step['num'] > 0:
+                    choose_tries = step['num']
+            elif op == 'set_chooseleaf_tries':
+                if step['num'] > 0:
+                    choose_leaf_tries = step['num']
+            elif op == 'set_chooseleaf_vary_r':
+                if step['num'] >= 0:
+                    vary_r = step['num']
+            elif op == 'set_chooseleaf_stable':
+                if step['num'] >= 0:
+                    stable = step['num']
+            elif op in ('choose_firstn', 'chooseleaf_firstn', 'choose_indep', 'chooseleaf_indep'):
+                firstn = op.endswith('firstn')
+                recurse_to_leaf = op.startswith('chooseleaf')
+                numrep = step['num'] if step['num'] > 0 else step['num'] + result_max
+                if numrep <= 0:
+                    # crush_do_rule places nothing, so following emit has empty work vector
+                    work = numpy.zeros((nlanes, 0), dtype=numpy.int64)
+                    wsize = numpy.zeros(nlanes, dtype=numpy.int64)
+                    continue
+
+                new_work = numpy.full((nlanes, result_max), CRUSH_ITEM_NONE, dtype=numpy.int64)
+                osize = numpy.zeros(nlanes, dtype=numpy.int64)
+
+                for idx in range(work.shape[1]):
+                    # previous indep step leaves CRUSH_ITEM_NONE in slots it failed to fill,
+                    # crush_do_rule skips them and everything else, which is not a bucket
+                    lanes = numpy.nonzero(idx < wsize)[0]
+                    lanes = lanes[self.is_bucket(work[lanes, idx])]
+                    if not lanes.size:
+                        continue
+
+                    left = result_max - osize[lanes]
+                    if firstn:
+                        if choose_leaf_tries:
+                            recurse_tries = choose_leaf_tries
+                        elif self.chooseleaf_descend_once:
+                            recurse_tries = 1
+                        else:
+                            recurse_tries = choose_tries
+
+                        out, out2, placed = self.choose_firstn(x[lanes], work[lanes, idx], numrep, step['type_id'],
+                                                               left, choose_tries, recurse_tries, recurse_to_leaf,
+                                                               weights, vary_r, stable)
+                    else:
+                        placed = numpy.minimum(numrep, left)
+                        out, out2 = self.choose_indep(x[lanes], work[lanes, idx], numrep, step['type_id'],
+                                                      placed, choose_tries, choose_leaf_tries or 1,
+                                                      recurse_to_leaf, weights)
+
+                    res = out2 if recurse_to_leaf else out
+                    for pos in range(res.shape[1]):
+                        sel = numpy.nonzero(pos < placed)[0]
+                        new_work[lanes[sel], osize[lanes[sel]]] = res[sel, pos]
+                        osize[lanes[sel]] += 1
+
+                work = new_work
+                wsize = osize
+            elif op == 'emit':
+                for idx in range(work.shape[1]):
+                    sel = numpy.nonzero((idx < wsize) & (result_len < result_max))[0]
+                    result[sel, result_len[sel]] = work[sel, idx]
+                    result_len[sel] += 1
+                wsize = numpy.zeros(nlanes, dtype=numpy.int64)
+            elif op != 'noop':
+                raise UnsupportedMap("Rule {0}: unsupported step {1!r}".format(rule.name, op))
+
+        return result
+
+
+def load_crush(crush_js):
+    "Load crush map from 'crushtool --dump' / 'ceph osd crush dump' json"
+    if not isinstance(crush_js, dict):
+        crush_js = json.loads(crush_js)
+
+    if crush_js.get('choose_args'):
+        raise UnsupportedMap("crush choose_args (weight sets)")
+
+    type_ids = {tp['name']: tp['type_id'] for tp in crush_js['types']}
+    buckets = []
+    for bucket in crush_js['buckets']:
+        if bucket['alg'] != 'straw2':
+            raise UnsupportedMap("Bucket {0} has alg {1}, only straw2 supported".format(bucket['name'],
+                                                                                       bucket['alg']))
+        if bucket['hash'] not in ('rjenkins1', 0):
+            raise UnsupportedMap("Bucket {0} has hash {1}".format(bucket['name'], bucket['hash']))
+
+        items = sorted(bucket['items'], key=lambda item: item['pos'])
+        buckets.append(Bucket(bucket['id'], bucket['name'], bucket['type_id'],
+                              [item['id'] for item in items],
+                              [item['weight'] for item in items]))
+
+    rules = []
+    for rule in crush_js['rules']:
+        steps = []
+        for step in rule['steps']:
+            step = step.copy()
+            if 'type' in step:
+                step['type_id'] = type_ids[step['type']]
+            steps.append(step)
+        rules.append(Rule(rule['rule_id'], rule['rule_name'], steps, rule.get('ruleset')))
+
+    max_devices = max([dev['id'] for dev in crush_js['devices']] + [-1]) + 1
+    return CrushMap(buckets, rules, crush_js.get('tunables', {}), max_devices,
+                    type_names={tp['type_id']: tp['name'] for tp in crush_js['types']},
+                    device_names={dev['id']: dev['name'] for dev in crush_js['devices']})
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# osd map
+
+
+class PoolInfo(object):
+    def __init__(self, pid, name, pg_num, pgp_num, size, rule_id, erasure, hashpspool):
+        self.pid = pid
+        self.name = name
+        self.pg_num = pg_num
+        self.pgp_num = pgp_num
+        self.size = size
+        self.rule_id = rule_id
+        self.erasure = erasure
+        self.hashpspool = hashpspool
+
+    def pps(self):
+        "placement seed for all PG of pool"
+        ps = numpy.arange(self.pg_num, dtype=numpy.int64)
+        mask = (1 << (self.pgp_num - 1).bit_length()) - 1
+        stable = numpy.where((ps & mask) < self.pgp_num, ps & mask, ps & (mask >> 1))
+        if self.hashpspool:
+            return crush_hash32_2(stable, self.pid)
+        return _u32(stable + self.pid)
+
+
+class OSDMapInfo(object):
+    def __init__(self, epoch, pools, weights, up, exists, pg_upmap, pg_upmap_items, primary_affinity=None,
+                 pg_temp=None, primary_temp=None):
+        self.epoch = epoch
+        self.pools = pools
+        self.weights = weights
+        self.up = up
+        self.exists = exists
+        self.pg_upmap = pg_upmap
+        self.pg_upmap_items = pg_upmap_items
+        if primary_affinity is None:
+            primary_affinity = numpy.full(len(weights), MAX_PRIMARY_AFFINITY, dtype=numpy.int64)
+        self.primary_affinity = primary_affinity
+        self.pg_temp = pg_temp or {}
+        self.primary_temp = primary_temp or {}
+
+
+def apply_reweights(osdmap, reweights):
+    "Set OSD reweights from {osd_id: reweight in [0, 1]}, as 'ceph osd reweight' would do"
+    for osd_id, reweight in reweights.items():
+        if osd_id >= len(osdmap.exists) or not osdmap.exists[osd_id]:
+            raise UnsupportedMap("Can't reweight osd.{0}, it's not in osd map".format(osd_id))
+        osdmap.weights[osd_id] = int(round(reweight * WEIGHT_ONE))
+
+
+def _parse_pgid(pgid):
+    pool_id, pg_id = pgid.split(".")
+    return int(pool_id), int(pg_id, 16)
+
+
+def load_osdmap(osd_dump_js):
+    "Load osd map from 'osdmaptool --dump json' / 'ceph osd dump' json"
+    if not isinstance(osd_dump_js, dict):
+        osd_dump_js = json.loads(osd_dump_js)
+
+    pools = []
+    for pool in osd_dump_js['pools']:
+        pools.append(PoolInfo(pool['pool'], pool['pool_name'], pool['pg_num'],
+                              pool.get('pg_placement_num', pool['pg_num']), pool['size'],
+                              pool.get('crush_rule', pool.get('crush_ruleset')),
+                              pool['type'] == POOL_TYPE_ERASURE,
+                              bool(pool['flags'] & POOL_FLAG_HASHPSPOOL)))
+
+    max_osd = max([osd['osd'] for osd in osd_dump_js['osds']] + [osd_dump_js.get('max_osd', 0) - 1]) + 1
+    weights = numpy.zeros(max_osd, dtype=numpy.int64)
+    up = numpy.zeros(max_osd, dtype=bool)
+    exists = numpy.zeros(max_osd, dtype=bool)
+    primary_affinity = numpy.full(max_osd, MAX_PRIMARY_AFFINITY, dtype=numpy.int64)
+    for osd in osd_dump_js['osds']:
+        weights[osd['osd']] = int(round(osd['weight'] * WEIGHT_ONE))
+        up[osd['osd']] = bool(osd['up'])
+        exists[osd['osd']] = True
+        primary_affinity[osd['osd']] = int(round(osd.get('primary_affinity', 1.0) * MAX_PRIMARY_AFFINITY))
+
+    pg_upmap = {_parse_pgid(item['pgid']): item['osds'] for item in osd_dump_js.get('pg_upmap', [])}
+    pg_upmap_items = {_parse_pgid(item['pgid']): [(mp['from'], mp['to']) for mp in item['mappings']]
+                      for item in osd_dump_js.get('pg_upmap_items', [])}
+
+    pg_temp = {_parse_pgid(item['pgid']): item['osds'] for item in osd_dump_js.get('pg_temp', [])}
+    primary_temp = {_parse_pgid(item['pgid']): item['osd'] for item in osd_dump_js.get('primary_temp', [])}
+
+    return OSDMapInfo(osd_dump_js['epoch'], pools, weights, up, exists, pg_upmap, pg_upmap_items,
+                      primary_affinity, pg_temp, primary_temp)
+
+
+def _apply_upmap(osdmap, pg, raw):
+    def marked_out(osd_id):
+        return osd_id != CRUSH_ITEM_NONE and 0 <= osd_id < len(osdmap.weights) and osdmap.weights[osd_id] == 0
+
+    upmap = osdmap.pg_upmap.get(pg)
+    if upmap is not None:
+        if any(marked_out(osd_id) for osd_id in upmap):
+            # ceph rejects whole upmap, pg_upmap_items are not applied too
+            return raw
+        raw = list(upmap)
+
+    for frm, to in osdmap.pg_upmap_items.get(pg, []):
+        if to in raw or marked_out(to):
+            continue
+        if frm in raw:
+            raw[raw.index(frm)] = to
+
+    return raw
+
+
+def _first_used(osd_sets):
+    "Index of first used slot in every row, 0 for empty rows"
+    return numpy.argmax(osd_sets != NO_OSD, axis=1) if osd_sets.shape[1] else numpy.zeros(len(osd_sets), dtype=int)
+
+
+def _apply_primary_affinity(osdmap, pool, pps, up):
+    """
+    Primary of every up set, as OSDMap::_apply_primary_affinity selects it. Up sets of replicated
+    pools are changed in place to have primary first. Returns int32 array, NO_OSD for empty sets
+    """
+    rows = numpy.arange(len(up))
+    first = _first_used(up)
+    primary = up[rows, first] if up.shape[1] else numpy.full(len(up), NO_OSD, dtype=numpy.int32)
+
+    used = up != NO_OSD
+    affinity = numpy.full(up.shape, MAX_PRIMARY_AFFINITY, dtype=numpy.int64)
+    affinity[used] = osdmap.primary_affinity[up[used]]
+    sel = numpy.nonzero((affinity < MAX_PRIMARY_AFFINITY).any(axis=1))[0]
+    if not sel.size:
+        return primary
+
+    sub = up[sel]
+    hashes = crush_hash32_2(pps[sel, None], numpy.where(used[sel], sub, 0)).astype(numpy.int64) >> 16
+    accepted = used[sel] & ((affinity[sel] >= MAX_PRIMARY_AFFINITY) | (hashes < affinity[sel]))
+    # OSD, which rejected primary role, is still used, if no other accepts it
+    pos = numpy.where(accepted.any(axis=1), numpy.argmax(accepted, axis=1), first[sel])
+    primary[sel] = sub[numpy.arange(len(sel)), pos]
+
+    if not pool.erasure:
+        cols = numpy.arange(up.shape[1])[None, :]
+        order = numpy.argsort(numpy.where(cols == pos[:, None], -1, cols), axis=1, kind='stable')
+        up[sel] = numpy.take_along_axis(sub, order, axis=1)
+
+    return primary
+
+
+def map_pool(crush, osdmap, pool, pgs=None):
+    """
+    Up set of every PG of pool, as int32 array (pg_num, size), NO_OSD in empty slots.
+    Replicated pools have all OSDs shifted to the beginning of the row and primary first, as ceph does.
+    pgs - array of PG numbers to map only them, rows of result follows pgs order
+    """
+    return map_pool_up(crush, osdmap, pool, pgs)[0]
+
+
+def map_pool_up(crush, osdmap, pool, pgs=None):
+    "(up sets, up primaries) of PGs of pool, see map_pool"
+    return raw_to_up(osdmap, pool, map_pool_raw(crush, osdmap, pool, pgs), pgs)
+
+
+def map_pool_raw(crush, osdmap, pool, pgs=None):
+    "crush result for PGs of pool, before upmaps and up/exists filtering, see map_pool"
+    pps = pool.pps()
+    if pgs is not None:
+        pps = pps[numpy.asarray(pgs, dtype=numpy.int64)]
+    return crush.do_rule(crush.find_rule(pool.rule_id), pps, pool.size, osdmap.weights)
+
+
+def raw_to_up(osdmap, pool, raw, pgs=None):
+    "(up sets, up primaries) from map_pool_raw result for the same pgs"
+    pps = pool.pps()
+    if pgs is None:
+        pgs = numpy.arange(pool.pg_num)
+    else:
+        pgs = numpy.asarray(pgs, dtype=numpy.int64)
+        pps = pps[pgs]
+    raw = raw.copy()
+
+    valid = (raw >= 0) & (raw < len(osdmap.exists))
+    valid[valid] = osdmap.exists[raw[valid]]
+    raw[~valid] = CRUSH_ITEM_NONE
+
+    upmapped = set(osdmap.pg_upmap) | set(osdmap.pg_upmap_items)
+    rows = {pg: idx for idx, pg in enumerate(pgs.tolist())} if upmapped else {}
+    for pool_id, pg in sorted(upmapped):
+        if pool_id == pool.pid and pg in rows:
+            idx = rows[pg]
+            row = [int(osd_id) for osd_id in raw[idx] if pool.erasure or osd_id != CRUSH_ITEM_NONE]
+            row = _apply_upmap(osdmap, (pool_id, pg), row)[:pool.size]
+            raw[idx] = CRUSH_ITEM_NONE
+            raw[idx, :len(row)] = row
+
+    valid = (raw >= 0) & (raw < len(osdmap.up))
+    valid[valid] = osdmap.up[raw[valid]]
+    res = numpy.where(valid, raw, NO_OSD).astype(numpy.int32)
+
+    if not pool.erasure:
+        # stable shift of all used slots to the left
+        order = numpy.argsort(res == NO_OSD, axis=1, kind='stable')
+        res = numpy.take_along_axis(res, order, axis=1)
+
+    return res, _apply_primary_affinity(osdmap, pool, pps, res)
+
+
+def pool_acting(osdmap, pool, up, up_primary, pgs=None):
+    """
+    (acting sets, acting primaries) of PGs of pool from up sets and pg_temp/primary_temp of osd map,
+    as OSDMap::_get_temp_osds does. pgs - PG numbers of up rows, all PGs of pool by default
+    """
+    pgs = numpy.arange(len(up)) if pgs is None else numpy.asarray(pgs, dtype=numpy.int64)
+    rows = {pg: idx for idx, pg in enumerate(pgs.tolist())}
+    temps = [(rows[pg], osds) for (pool_id, pg), osds in osdmap.pg_temp.items() if pool_id == pool.pid and pg in rows]
+    primaries = [(rows[pg], osd_id) for (pool_id, pg), osd_id in osdmap.primary_temp.items()
+                 if pool_id == pool.pid and pg in rows]
+
+    width = max([up.shape[1]] + [len(osds) for _, osds in temps])
+    acting = numpy.full((len(up), width), NO_OSD, dtype=numpy.int32)
+    acting[:, :up.shape[1]] = up
+    acting_primary = up_primary.copy()
+
+    for idx, osds in temps:
+        row = []
+        for osd_id in osds:
+            if 0 <= osd_id < len(osdmap.exists) and osdmap.exists[osd_id] and osdmap.up[osd_id]:
+                row.append(osd_id)
+            elif pool.erasure:
+                row.append(NO_OSD)
+        if not row:
+            continue
+        acting[idx] = NO_OSD
+        acting[idx, :len(row)] = row
+        used = [osd_id for osd_id in row if osd_id != NO_OSD]
+        if used:
+            acting_primary[idx] = used[0]
+
+    for idx, osd_id in primaries:
+        acting_primary[idx] = osd_id
+
+    return acting, acting_primary
+
+
+def map_all_pools(crush, osdmap):
+    return {pool.pid: map_pool(crush, osdmap, pool) for pool in osdmap.pools}
+
+
+def load_osdmap_file(osd_map_f):
+    "Extract crush and osd map info from binary osd map file"
+    crush = load_crush(artifact_cache.dump_crush(artifact_cache.export_crush(osd_map_f)))
+    osdmap = load_osdmap(artifact_cache.dump_osdmap(osd_map_f))
+    return crush, osdmap
@@ -116,6 +116,12 @@ class ClientData(object):
         return '\x00' in self.data
 
 
+def osds_note(osds):
+    if not osds:
+        return ""
+    return " (ceph host {0}, {1})".format(osds[0].host, ", ".join(info.name for info in osds))
+
+
 def server_main(opts):
     # open tcp socket
     # wait until all clients connect
@@ -162,7 +168,13 @@ def server_main(opts):
             sock.close()
         else:
             good_clients[sock] = client
-        client_ips.append(client.addr)
+        client_ips.append(client.addr[0])
+
+    topology = None
+    if opts.ceph:
+        # cephlib is only needed with --ceph
+        from cluster_topology import live_topology
+        topology = live_topology()
 
     if len(client_ips) != len(clients):
         all_nodes = config['nodes'].copy()
@@ -175,12 +187,15 @@ def server_main(opts):
 
         for ip in client_ips:
             if ip not in ip2node:
-                logger.warning("Unexpected client %r", ip)
+                logger.warning("Unexpected client %r%s", ip,
+                               osds_note(topology.osds_by_ip(ip)) if topology else "")
             else:
                 del ip2node[ip]
 
         for node in set(ip2node.values()):
-            logger.error("Client %s has not connected", node['hostnames'][0])
+            hostname = node['hostnames'][0]
+            logger.error("Client %s has not connected%s", hostname,
+                         osds_note(topology.host_osds(hostname)) if topology else "")
 
     return 0
 
@@ -232,6 +247,8 @@ def parse_args(argv):
     server.add_argument('-i', '--ip', help="Server ip to listen on", default='')
     server.add_argument('-l', '--log-level', default='INFO', choices=("DEBUG", "INFO", "WARNING", "ERROR", "NO_LOG"))
     server.add_argument('-r', '--report', help="Save yaml report to FILE", metavar='FILE')
+    server.add_argument('-c', '--ceph', action="store_true",
+                        help="Show OSDs of unexpected and missing clients, from live ceph cluster")
     server.set_defaults(main_func=server_main)
 
     return parser.parse_args(argv)
@@ -2,38 +2,455 @@ from __future__ import print_function
 
 import sys
 import json
+import argparse
 import collections
 
+import numpy
 
-def load_PG_distribution(pgdump_path, key='acting'):
-    pg_dump = json.load(open(pgdump_path))
-    osd_pool_pg_2d = collections.defaultdict(lambda: collections.Counter())
-
-    for pg in pg_dump['pg_stats']:
-        pool = int(pg['pgid'].split('.', 1)[0])
-        for osd_num in pg[key]:
-            osd_pool_pg_2d[osd_num][pool] += 1
-    return osd_pool_pg_2d
-
-
-def show_pg_distr(osd_pool_pg_2d):
-    all_pools = set()
-    for pools_per_osd in osd_pool_pg_2d.values():
-        all_pools.update(pools_per_osd.keys())
-    all_pools = sorted(all_pools)
-    format = "%4s | " + "  ".join(["%4s"] * len(all_pools)) + " %6s \n"
-    line_sz = len(format % (('',) * (len(all_pools) + 2))) - 1
-    res = format % tuple([''] + all_pools + ['total'])
-    res += '-' * line_sz + "\n"
-    for osd, per_pool in sorted(osd_pool_pg_2d.items()):
-        pgs = [per_pool.get(pool_id, 0) for pool_id in all_pools]
-        res += format % tuple([osd] + pgs + [sum(pgs)])
+from cephlib.units import b2ssize
+
+import pg_series
+import pg_snapshot
+import cluster_snapshot
+
+
+class PGDistribution(object):
+    """
+    Dense OSD x pool matrices, rows are sorted osd ids, columns are sorted pool ids:
+        pgs - PG count of pool on OSD
+        bytes - data of pool on OSD, None if not loaded
+        ops - read and write operations of pool PGs on OSD, None if not loaded
+    For crush bucket roll-ups rows are bucket names, label is bucket type and capacity is crush
+    weight of every bucket, so bucket imbalance is counted per weight unit
+    """
+    def __init__(self, osds, pools, pgs, bytes=None, ops=None, label='osd', capacity=None):
+        self.osds = osds
+        self.pools = pools
+        self.pgs = pgs
+        self.bytes = bytes
+        self.ops = ops
+        self.label = label
+        self.capacity = capacity
+
+    def matrix(self, metric='pgs'):
+        return getattr(self, metric)
+
+    def osd_totals(self, metric='pgs'):
+        "Per OSD totals, indexed by osd id"
+        totals = numpy.zeros(self.osds.max(initial=-1) + 1, dtype=numpy.int64)
+        totals[self.osds] = self.matrix(metric).sum(axis=1)
+        return totals
+
+
+METRICS = ('pgs', 'bytes', 'ops')
+
+
+def load_PG_distribution(pg_source=None, key='acting', with_bytes=False, with_ops=False):
+    """
+    pg_source - pg dump file, ClusterSnapshot or None for live cluster
+    key - 'acting' or 'up' to count PGs of every OSD in set, 'primary' to count only PGs, where OSD is primary
+    """
+    snapshot = cluster_snapshot.pgs_of(pg_source)
+    osd_sets = snapshot.primary[:, None] if key == 'primary' else getattr(snapshot, key)
+    used = osd_sets != pg_snapshot.NO_OSD
+
+    osds, rows = numpy.unique(osd_sets[used], return_inverse=True)
+    pools, cols = numpy.unique(numpy.broadcast_to(snapshot.pool[:, None], osd_sets.shape)[used], return_inverse=True)
+    cells = rows * len(pools) + cols
+    shape = (len(osds), len(pools))
+
+    def weighted(pg_values):
+        values = numpy.broadcast_to(pg_values[:, None], osd_sets.shape)[used]
+        # float64 sums are exact up to 2**53 per cell
+        res = numpy.bincount(cells, weights=values, minlength=shape[0] * shape[1])
+        return res.round().astype(numpy.int64).reshape(shape)
+
+    pgs = numpy.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+    return PGDistribution(osds, pools, pgs,
+                          weighted(snapshot.num_bytes) if with_bytes else None,
+                          weighted(snapshot.num_ops) if with_ops else None)
+
+
+STATS = ('min', 'max', 'mean', 'std', 'imbalance')
+
+
+def spread_stats(matrix, axis):
+    """
+    min/max/mean/std of matrix along axis, only non-zero cells are counted, as OSD without PG of pool
+    is most likely not in pool crush rule. imbalance is max / mean - 1.
+    Returns {stat name: float64 array}, nan for empty lines
+    """
+    values = numpy.where(matrix > 0, matrix, numpy.nan).astype(numpy.float64)
+    present = (matrix > 0).any(axis=axis)
+    res = {name: numpy.full(present.shape, numpy.nan) for name in STATS}
+    lines = values[:, present] if axis == 0 else values[present]
+    res['min'][present] = numpy.nanmin(lines, axis=axis)
+    res['max'][present] = numpy.nanmax(lines, axis=axis)
+    res['mean'][present] = numpy.nanmean(lines, axis=axis)
+    res['std'][present] = numpy.nanstd(lines, axis=axis)
+    res['imbalance'][present] = res['max'][present] / res['mean'][present] - 1.0
+    return res
+
+
+def osd_load_stats(matrix, capacity=None):
+    """
+    Per row total and its ratio to mean row total minus 1.
+    With capacity ratio is counted for total per capacity unit, nan for rows without capacity
+    """
+    totals = matrix.sum(axis=1)
+    if capacity is None:
+        mean = totals.mean() if len(totals) else 0
+        imbalance = totals / float(mean) - 1.0 if mean else numpy.zeros(len(totals))
+        return totals, imbalance
+
+    imbalance = numpy.full(len(totals), numpy.nan)
+    has_capacity = capacity > 0
+    if has_capacity.any() and totals.sum():
+        mean = totals[has_capacity].sum() / float(capacity[has_capacity].sum())
+        imbalance[has_capacity] = totals[has_capacity] / capacity[has_capacity] / mean - 1.0
+    return totals, imbalance
+
+
+class DomainIndex(object):
+    """
+    Precomputed OSD => ancestor bucket index arrays for every crush type of cephlib crush tree:
+        levels - {type: (bucket names, int32 array of bucket index by osd id, -1 if OSD has no such ancestor)},
+                 ordered from root to leafs
+        weights - crush weight by osd id
+    OSD, which is placed in few subtrees, is counted in first one
+    """
+    def __init__(self, crush):
+        paths = collections.OrderedDict()
+        weights = {}
+        for node in crush.iter_nodes('osd'):
+            osd_id = int(node.name.split('.')[1])
+            if osd_id not in paths:
+                paths[osd_id] = node.full_path
+                weights[osd_id] = node.weight
+
+        size = max(paths) + 1 if paths else 0
+        self.weights = numpy.zeros(size, dtype=numpy.float64)
+        self.weights[list(weights.keys())] = list(weights.values())
+
+        bucket_ids = collections.OrderedDict()
+        self.levels = collections.OrderedDict()
+        for osd_id, path in paths.items():
+            for tp, name in path:
+                if tp == 'osd':
+                    continue
+                if tp not in self.levels:
+                    bucket_ids[tp] = {}
+                    self.levels[tp] = ([], numpy.full(size, -1, dtype=numpy.int32))
+                names, index = self.levels[tp]
+                if name not in bucket_ids[tp]:
+                    bucket_ids[tp][name] = len(names)
+                    names.append(name)
+                index[osd_id] = bucket_ids[tp][name]
+
+    def rollup(self, distr, level):
+        "PGDistribution of buckets of given type, summed over OSDs of distr"
+        names, index = self.levels[level]
+        buckets = numpy.full(len(distr.osds), -1, dtype=numpy.int32)
+        known = distr.osds < len(index)
+        buckets[known] = index[distr.osds[known]]
+        rows = buckets >= 0
+        shape = (len(names), len(distr.pools))
+        cells = (buckets[rows][:, None] * shape[1] + numpy.arange(shape[1])).ravel()
+
+        def roll(matrix):
+            if matrix is None:
+                return None
+            res = numpy.bincount(cells, weights=matrix[rows].ravel(), minlength=shape[0] * shape[1])
+            return res.round().astype(numpy.int64).reshape(shape)
+
+        placed = index >= 0
+        capacity = numpy.bincount(index[placed], weights=self.weights[placed], minlength=shape[0])
+        return PGDistribution(numpy.array(names), distr.pools, roll(distr.pgs), roll(distr.bytes), roll(distr.ops),
+                              label=level, capacity=capacity)
+
+
+def format_stat(name, value, metric):
+    if value != value:
+        return "-"
+    if name == 'imbalance':
+        return "{0:.1%}".format(value)
+    if metric == 'bytes':
+        return b2ssize(int(round(value)))
+    return "{0:.{1}f}".format(value, 0 if name in ('min', 'max') else 1)
+
+
+def current_primary_affinity(cluster):
+    "{osd_id: primary affinity} from osd map, empty if osd map is not available"
+    try:
+        topology = cluster.topology
+    except cluster_snapshot.MissingArtifact:
+        return {}
+    return {info.id: info.primary_affinity for info in topology}
+
+
+def suggest_primary_affinity(acting, primary, metric='pgs', curr_affinity=None, min_affinity=0.05, min_diff=0.05):
+    """
+    Primary affinity, which moves primary load of every OSD towards its fair share - the same part of
+    all primary load, as OSD has of load of all acting sets. Affinity can only make OSD primary less often,
+    so overloaded OSDs get it lowered proportionally to overload and underloaded ones get it raised back
+    to at most 1.
+    acting, primary - PGDistribution for acting sets and primaries
+    Returns {osd_id: (current affinity, suggested affinity)} for OSDs, which need change at least min_diff
+    """
+    member_load = acting.osd_totals(metric).astype(numpy.float64)
+    primary_load = numpy.zeros(len(member_load), dtype=numpy.float64)
+    primary_totals = primary.osd_totals(metric)
+    primary_load[:len(primary_totals)] = primary_totals[:len(member_load)]
+    if not member_load.sum() or not primary_load.sum():
+        return {}
+
+    target = member_load * (primary_load.sum() / member_load.sum())
+    curr = numpy.ones(len(member_load), dtype=numpy.float64)
+    for osd_id, affinity in (curr_affinity or {}).items():
+        if osd_id < len(curr):
+            curr[osd_id] = affinity
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ratio = numpy.where(primary_load > 0, target / primary_load, numpy.inf)
+    suggested = numpy.clip(curr * ratio, min_affinity, 1.0)
+    suggested[member_load == 0] = curr[member_load == 0]
+
+    changed = numpy.nonzero(numpy.abs(suggested - curr) >= min_diff)[0]
+    return {osd_id: (float(curr[osd_id]), round(float(suggested[osd_id]), 2)) for osd_id in changed.tolist()}
+
+
+def write_affinity(suggestions, fd):
+    for osd_id, (curr, suggested) in sorted(suggestions.items()):
+        fd.write("ceph osd primary-affinity osd.{0} {1:.2f}  # was {2:.2f}\n".format(osd_id, suggested, curr))
+
+
+def write_text(distr, fd, metric='pgs'):
+    "Lines are written as they are formatted, so big tables are not kept in memory as text"
+    matrix = distr.matrix(metric)
+    totals, imbalances = osd_load_stats(matrix, distr.capacity)
+    fmt = b2ssize if metric == 'bytes' else str
+    width = max(11, len(fmt(totals.max(initial=0))) + 2)
+    label_width = max([9] + [len(str(label)) for label in distr.osds.tolist()])
+
+    def line(first, cells):
+        return str(first).rjust(label_width) + " |" + "".join(cell.rjust(width) for cell in cells) + "\n"
+
+    header = line(distr.label, [str(pool_id) for pool_id in distr.pools.tolist()] + ["total", "imbalance"])
+    fd.write(header)
+    fd.write("-" * (len(header) - 1) + "\n")
+    for label, row, total, imbalance in zip(distr.osds.tolist(), matrix.tolist(), totals.tolist(),
+                                            imbalances.tolist()):
+        fd.write(line(label, [fmt(value) for value in row] +
+                      [fmt(total), format_stat('imbalance', imbalance, metric)]))
+
+    fd.write("-" * (len(header) - 1) + "\n")
+    pool_stats = spread_stats(matrix, axis=0)
+    total_stats = spread_stats(totals[:, None], axis=0)
+    for name in STATS:
+        values = pool_stats[name].tolist() + total_stats[name].tolist()
+        fd.write(line(name, [format_stat(name, value, metric) for value in values]))
+
+
+def write_csv(distr, fd, metric='pgs'):
+    matrix = distr.matrix(metric)
+    totals, imbalances = osd_load_stats(matrix, distr.capacity)
+    fd.write(",".join([distr.label] + ["pool_{0}".format(pool_id) for pool_id in distr.pools.tolist()] +
+                      ["total", "imbalance"]) + "\n")
+    for label, row, total, imbalance in zip(distr.osds.tolist(), matrix.tolist(), totals.tolist(),
+                                            imbalances.tolist()):
+        fd.write("{0},{1},{2},{3}\n".format(label, ",".join(map(str, row)), total,
+                                            "" if imbalance != imbalance else "{0:.4f}".format(imbalance)))
+
+
+def nan_to_none(values):
+    return [None if value != value else value for value in values.tolist()]
+
+
+def stats_to_json(stats):
+    return {name: nan_to_none(values) for name, values in stats.items()}
+
+
+def distr_to_json(distr):
+    res = {'osds' if distr.label == 'osd' else 'buckets': distr.osds.tolist(), 'pools': distr.pools.tolist()}
+    if distr.capacity is not None:
+        res['capacity'] = distr.capacity.tolist()
+    for metric in METRICS:
+        matrix = distr.matrix(metric)
+        if matrix is None:
+            continue
+        totals, imbalances = osd_load_stats(matrix, distr.capacity)
+        res[metric] = matrix.tolist()
+        res[metric + '_pool_stats'] = stats_to_json(spread_stats(matrix, axis=0))
+        res[metric + '_osd_stats'] = {'total': totals.tolist(), 'imbalance': nan_to_none(imbalances)}
     return res
 
 
+def write_json(distr, fd):
+    json.dump(distr_to_json(distr), fd)
+    fd.write("\n")
+
+
+def write_domains(distr, domains, levels, fd, out_format='text', metric='pgs'):
+    "Roll-up tables for every crush type from levels, csv and text tables are separated with empty line"
+    if out_format == 'json':
+        json.dump({level: distr_to_json(domains.rollup(distr, level)) for level in levels}, fd)
+        fd.write("\n")
+        return
+
+    for idx, level in enumerate(levels):
+        if idx:
+            fd.write("\n")
+        rollup = domains.rollup(distr, level)
+        if out_format == 'csv':
+            write_csv(rollup, fd, metric)
+        else:
+            write_text(rollup, fd, metric)
+
+
+def series_metric(pg_count, osd_bytes, metric):
+    return osd_bytes if metric == 'bytes' else pg_count
+
+
+def write_series_text(series, fd, metric='pgs'):
+    "Line per dump with changes against previous one, then per OSD change from first to last dump"
+    fmt = b2ssize if metric == 'bytes' else str
+    templ = "{0:>26} {1:>12} {2:>9} {3:>10} {4:>10} {5:>10}\n"
+    fd.write(templ.format("stamp", "version", "remapped", "moved", "max", "imbalance"))
+    first = last = None
+    for point, pg_count, osd_bytes, remapped, moved in series.iter_usage():
+        values = series_metric(pg_count, osd_bytes, metric)
+        stats = spread_stats(values[:, None], axis=0)
+        fd.write(templ.format(point.stamp or "-", point.version if point.version is not None else "-",
+                              remapped, b2ssize(moved), format_stat('max', stats['max'][0], metric),
+                              format_stat('imbalance', stats['imbalance'][0], metric)))
+        if first is None:
+            first = values.copy()
+        last = values
+
+    if first is None:
+        return
+
+    fd.write("\nSeries takes {0}B of memory, {1}B as full dumps\n".format(b2ssize(series.nbytes),
+                                                                       b2ssize(series.full_nbytes)))
+    fd.write("\n")
+    width = max(11, len(fmt(max(first.max(initial=0), last.max(initial=0)))) + 2)
+    fd.write("{0:>9} |{1:>{w}}{2:>{w}}{3:>{w}}\n".format("osd", "first", "last", "change", w=width))
+    for osd_id in numpy.nonzero(first | last)[0].tolist():
+        change = int(last[osd_id]) - int(first[osd_id])
+        sign = "+" if change > 0 else ("-" if change < 0 else "")
+        fd.write("{0:>9} |{1:>{w}}{2:>{w}}{3:>{w}}\n".format(osd_id, fmt(int(first[osd_id])), fmt(int(last[osd_id])),
+                                                             sign + fmt(abs(change)), w=width))
+
+
+def write_series_csv(series, fd, metric='pgs'):
+    "Row per dump, column per OSD, rows are written as series is replayed"
+    osds = ["osd_{0}".format(osd_id) for osd_id in range(series.max_osd + 1)]
+    fd.write(",".join(["name", "stamp", "version", "remapped", "moved_bytes"] + osds) + "\n")
+    for point, pg_count, osd_bytes, remapped, moved in series.iter_usage():
+        values = series_metric(pg_count, osd_bytes, metric)
+        fd.write("{0},{1},{2},{3},{4},{5}\n".format(point.name, point.stamp or "",
+                                                    "" if point.version is None else point.version,
+                                                    remapped, moved, ",".join(map(str, values.tolist()))))
+
+
+def write_series_json(series, fd):
+    res = {'names': [], 'stamps': [], 'versions': [], 'remapped': [], 'moved_bytes': [], 'pgs': [], 'bytes': [],
+           'osds': list(range(series.max_osd + 1))}
+    for point, pg_count, osd_bytes, remapped, moved in series.iter_usage():
+        res['names'].append(point.name)
+        res['stamps'].append(point.stamp)
+        res['versions'].append(point.version)
+        res['remapped'].append(remapped)
+        res['moved_bytes'].append(moved)
+        res['pgs'].append(pg_count.tolist())
+        res['bytes'].append(osd_bytes.tolist())
+    json.dump(res, fd)
+    fd.write("\n")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Show PG count (or data) per OSD and pool with spread statistics")
+    parser.add_argument("-f", "--format", choices=("text", "csv", "json"), default="text", help="Output format")
+    parser.add_argument("-k", "--metric", choices=METRICS, default="pgs",
+                        help="Show PG count, data size or read/write ops, json always has PG count and " +
+                             "also selected metric")
+    parser.add_argument("-u", "--up", action="store_true", help="Use up sets instead of acting")
+    parser.add_argument("-P", "--primary", action="store_true", help="Count only PGs, where OSD is primary")
+    parser.add_argument("-a", "--affinity", action="store_true",
+                        help="Suggest primary affinity, which evens primary load by selected metric")
+    parser.add_argument("-d", "--domains", default=None,
+                        help="Comma separated crush types, like 'host,rack,root', or 'all', to show sums " +
+                             "per crush bucket of these types instead of per OSD (needs osd map)")
+    parser.add_argument("-o", "--osd-map", default=None,
+                        help="OSD map file to get current primary affinity and crush tree, live cluster is " +
+                             "used if neither osd map nor pg dump is passed")
+    parser.add_argument("-S", "--series", action="store_true",
+                        help="Show how acting PG count (or data) per OSD changes over series of pg dumps, " +
+                             "given in time order")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Processes to load series dumps, cpu count by default")
+    parser.add_argument("pg_dump", nargs="*",
+                        help="PG dump json file, may be gzipped, live cluster is used if omitted. " +
+                             "Few files for --series")
+    return parser.parse_args(argv[1:])
+
+
 def main(argv):
-    distr = load_PG_distribution(argv[1])
-    print(show_pg_distr(distr))
+    opts = parse_args(argv)
+    if opts.series:
+        if opts.metric == 'ops':
+            print("Series only has PG count and data", file=sys.stderr)
+            return 1
+        if not opts.pg_dump:
+            print("Pass pg dump files for --series", file=sys.stderr)
+            return 1
+        series = pg_series.load_series(opts.pg_dump, jobs=opts.jobs)
+        if opts.format == 'json':
+            write_series_json(series, sys.stdout)
+        elif opts.format == 'csv':
+            write_series_csv(series, sys.stdout, opts.metric)
+        else:
+            write_series_text(series, sys.stdout, opts.metric)
+        return 0
+
+    if len(opts.pg_dump) > 1:
+        print("Only one pg dump can be passed without --series", file=sys.stderr)
+        return 1
+    opts.pg_dump = opts.pg_dump[0] if opts.pg_dump else None
+    # osd map is only taken from cluster, when pg dump is taken from it too
+    cluster = cluster_snapshot.ClusterSnapshot(osd_map_f=opts.osd_map, pg_dump_f=opts.pg_dump,
+                                               offline=opts.pg_dump is not None and opts.osd_map is None)
+    params = dict(with_bytes=opts.metric == 'bytes', with_ops=opts.metric == 'ops')
+
+    if opts.affinity:
+        acting = load_PG_distribution(cluster, key='acting', **params)
+        primary = load_PG_distribution(cluster, key='primary', **params)
+        suggestions = suggest_primary_affinity(acting, primary, opts.metric, current_primary_affinity(cluster))
+        write_affinity(suggestions, sys.stdout)
+        return 0
+
+    key = 'primary' if opts.primary else ('up' if opts.up else 'acting')
+    distr = load_PG_distribution(cluster, key=key, **params)
+
+    if opts.domains:
+        try:
+            domains = DomainIndex(cluster.crush)
+        except cluster_snapshot.MissingArtifact as exc:
+            print("{0}. Pass osd map with -o to show crush domains".format(exc), file=sys.stderr)
+            return 1
+        # leafs first
+        levels = list(reversed(domains.levels)) if opts.domains == 'all' else opts.domains.split(',')
+        unknown = [level for level in levels if level not in domains.levels]
+        if unknown:
+            print("No crush buckets of type(s) {0}".format(", ".join(unknown)), file=sys.stderr)
+            return 1
+        write_domains(distr, domains, levels, sys.stdout, opts.format, opts.metric)
+    elif opts.format == 'json':
+        write_json(distr, sys.stdout)
+    elif opts.format == 'csv':
+        write_csv(distr, sys.stdout, opts.metric)
+    else:
+        write_text(distr, sys.stdout, opts.metric)
     return 0
 
 
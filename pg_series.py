@@ -0,0 +1,179 @@
+"""
+Series of pg dumps, stored as deltas.
+
+Every dump is loaded (in parallel, bypassing pg snapshot cache) into PG arrays, sorted
+by pgid, and only acting sets of PGs, which acting set differs from previous dump, are kept.
+PG sizes change much more often, than acting sets, so they are kept apart: sizes of
+changed PGs with their indexes, or sizes of all PGs, if it takes less memory.
+Dump with different set of PGs (pool created, removed or split) is kept in full.
+Per OSD PG count and data are updated from deltas only, so series of hundreds of
+dumps takes memory of one dump plus changes.
+"""
+
+from __future__ import print_function
+
+import logging
+import multiprocessing
+
+import numpy
+
+import pg_snapshot
+from pg_snapshot import NO_OSD
+
+
+logger = logging.getLogger("remap.series")
+
+
+class SeriesPoint(object):
+    """
+    One dump of series. For full point rows is None and acting/num_bytes are for all PGs, keys are pgids.
+    Else acting are sets of rows, which acting set changed, and num_bytes are sizes of bytes_rows,
+    or of all PGs, if bytes_rows is None
+    """
+    def __init__(self, name, version, stamp, rows, acting, num_bytes, keys=None, bytes_rows=None):
+        self.name = name
+        self.version = version
+        self.stamp = stamp
+        self.rows = rows
+        self.acting = acting
+        self.num_bytes = num_bytes
+        self.keys = keys
+        self.bytes_rows = bytes_rows
+
+    @property
+    def is_full(self):
+        return self.rows is None
+
+    @property
+    def nbytes(self):
+        "Memory, taken by point arrays"
+        return sum(arr.nbytes for arr in (self.rows, self.acting, self.num_bytes, self.keys, self.bytes_rows)
+                   if arr is not None)
+
+
+def pg_keys(pool, ps):
+    return (pool.astype(numpy.int64) << 32) | ps.astype(numpy.int64)
+
+
+def load_sorted(pg_dump_f):
+    "(version, stamp, pgid keys, acting, num_bytes) of pg dump, sorted by pgid"
+    # snapshot cache keeps few latest snapshots, series of many dumps would only evict them
+    snapshot = pg_snapshot.load_pg_snapshot(pg_dump_f, cache_dir=None)
+    keys = pg_keys(snapshot.pool, snapshot.ps)
+    order = numpy.argsort(keys, kind='stable')
+    return (snapshot.version, snapshot.stamp, keys[order], numpy.array(snapshot.acting[order]),
+            numpy.array(snapshot.num_bytes[order]))
+
+
+def add_usage(pg_count, osd_bytes, acting, sizes, sign=1):
+    used = acting != NO_OSD
+    osds = acting[used]
+    pg_count += sign * numpy.bincount(osds, minlength=len(pg_count))
+    slot_sizes = numpy.broadcast_to(sizes[:, None], acting.shape)[used]
+    osd_bytes += sign * numpy.bincount(osds, weights=slot_sizes, minlength=len(osd_bytes)).round().astype(numpy.int64)
+
+
+def new_slots(old, new):
+    "Mask of slots of new acting sets, which OSD is not in the same row of old"
+    present = (new[:, :, None] == old[:, None, :]).any(axis=2)
+    return (new != NO_OSD) & ~present
+
+
+class PGSeries(object):
+    def __init__(self):
+        self.points = []
+        self.max_osd = -1
+        # latest state: keys, acting, num_bytes
+        self.state = None
+        # memory, which points would take, if every dump was kept in full
+        self.full_nbytes = 0
+
+    @property
+    def nbytes(self):
+        return sum(point.nbytes for point in self.points)
+
+    def append(self, name, version, stamp, keys, acting, num_bytes):
+        self.max_osd = max(self.max_osd, int(acting.max(initial=-1)))
+        self.full_nbytes += keys.nbytes + acting.nbytes + num_bytes.nbytes
+        if self.state is None or self.state[0].shape != keys.shape or self.state[1].shape != acting.shape or \
+                not numpy.array_equal(self.state[0], keys):
+            self.points.append(SeriesPoint(name, version, stamp, None, acting, num_bytes, keys))
+        else:
+            _, prev_acting, prev_bytes = self.state
+            rows = numpy.nonzero((prev_acting != acting).any(axis=1))[0].astype(numpy.int32)
+            bytes_rows = numpy.nonzero(prev_bytes != num_bytes)[0].astype(numpy.int32)
+            if bytes_rows.nbytes + num_bytes[bytes_rows].nbytes < num_bytes.nbytes:
+                self.points.append(SeriesPoint(name, version, stamp, rows, acting[rows], num_bytes[bytes_rows],
+                                               bytes_rows=bytes_rows))
+            else:
+                self.points.append(SeriesPoint(name, version, stamp, rows, acting[rows], num_bytes))
+        self.state = (keys, acting, num_bytes)
+
+    def iter_usage(self):
+        """
+        Replay series, yields (point, pg_count, osd_bytes, remapped PG, moved bytes) for every point.
+        pg_count and osd_bytes are indexed by osd id and updated in place, copy them to keep.
+        Remap is counted against previous point, for full points only PGs with the same pgid are compared
+        """
+        size = self.max_osd + 1
+        pg_count = numpy.zeros(size, dtype=numpy.int64)
+        osd_bytes = numpy.zeros(size, dtype=numpy.int64)
+        keys = acting = num_bytes = None
+
+        for point in self.points:
+            if point.is_full:
+                remapped, moved = 0, 0
+                if acting is not None:
+                    common, old_rows, new_rows = numpy.intersect1d(keys, point.keys, assume_unique=True,
+                                                                   return_indices=True)
+                    if len(common) and acting.shape[1] == point.acting.shape[1]:
+                        joined = new_slots(acting[old_rows], point.acting[new_rows])
+                        remapped = int(joined.any(axis=1).sum())
+                        moved = int((joined.sum(axis=1) * point.num_bytes[new_rows]).sum())
+                keys, acting, num_bytes = point.keys, point.acting.copy(), point.num_bytes.copy()
+                pg_count[:] = 0
+                osd_bytes[:] = 0
+                add_usage(pg_count, osd_bytes, acting, num_bytes)
+            else:
+                rows = point.rows
+                if point.bytes_rows is None:
+                    bytes_rows = numpy.nonzero(num_bytes != point.num_bytes)[0]
+                    new_bytes = point.num_bytes[bytes_rows]
+                else:
+                    bytes_rows, new_bytes = point.bytes_rows, point.num_bytes
+                updated = numpy.union1d(rows, bytes_rows)
+                add_usage(pg_count, osd_bytes, acting[updated], num_bytes[updated], sign=-1)
+                num_bytes[bytes_rows] = new_bytes
+                joined = new_slots(acting[rows], point.acting)
+                remapped = int(joined.any(axis=1).sum())
+                moved = int((joined.sum(axis=1) * num_bytes[rows]).sum())
+                acting[rows] = point.acting
+                add_usage(pg_count, osd_bytes, acting[updated], num_bytes[updated])
+
+            yield point, pg_count, osd_bytes, remapped, moved
+
+
+def load_series(pg_dump_files, jobs=None):
+    """
+    Load pg dumps in parallel into PGSeries, in given order.
+    Dumps are decoded by worker processes, main process keeps only deltas
+    """
+    series = PGSeries()
+    jobs = min(jobs or multiprocessing.cpu_count(), len(pg_dump_files))
+    if jobs <= 1:
+        for pg_dump_f in pg_dump_files:
+            series.append(pg_dump_f, *load_sorted(pg_dump_f))
+        return series
+
+    logger.debug("Load %s pg dumps in %s processes", len(pg_dump_files), jobs)
+    proc_pool = multiprocessing.Pool(jobs)
+    try:
+        # imap keeps order and lets main process turn loaded dumps into deltas while others are loading
+        for pg_dump_f, loaded in zip(pg_dump_files, proc_pool.imap(load_sorted, pg_dump_files)):
+            series.append(pg_dump_f, *loaded)
+    finally:
+        proc_pool.terminate()
+        proc_pool.join()
+    logger.debug("%s pg dumps take %s bytes, %s bytes in full", len(series.points), series.nbytes,
+                 series.full_nbytes)
+    return series
@@ -0,0 +1,379 @@
+"""
+Parsed 'ceph pg dump' snapshot, stored on disk as memory-mappable numpy arrays.
+
+Snapshots are keyed by pgmap version, so any tool, which runs against the same
+pgmap version, loads arrays in milliseconds instead of decoding json again.
+Snapshots of live cluster are kept per cluster fsid, as pgmap versions of
+different clusters are unrelated.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import gzip
+import json
+import array
+import codecs
+import shutil
+import logging
+import tempfile
+import subprocess
+
+import numpy
+
+from cephlib.common import run_locally
+
+
+logger = logging.getLogger("remap.snapshot")
+
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/ceph_tools/pg_snapshots")
+MAX_CACHED_SNAPSHOTS = 8
+FORMAT_VERSION = 2
+NO_OSD = -1
+
+
+class PGSnapshot(object):
+    """
+    All PG stats, which tools needs, one array row per PG:
+        pool, ps - pool id and pg number
+        acting, up - int32 (pg_count, max_set_size), NO_OSD in empty slots
+        primary - acting primary
+        num_bytes - PG data size
+        num_ops - PG read and write operations count since PG creation
+    """
+    arrays = ('pool', 'ps', 'acting', 'up', 'primary', 'num_bytes', 'num_ops')
+
+    def __init__(self, version, stamp, pool, ps, acting, up, primary, num_bytes, num_ops):
+        self.version = version
+        self.stamp = stamp
+        self.pool = pool
+        self.ps = ps
+        self.acting = acting
+        self.up = up
+        self.primary = primary
+        self.num_bytes = num_bytes
+        self.num_ops = num_ops
+
+    def __len__(self):
+        return len(self.pool)
+
+    def pool_ids(self):
+        return numpy.unique(self.pool).tolist()
+
+    def pool_pg_sizes(self):
+        "{pool_id: int64 array of PG sizes, indexed by pg number}"
+        res = {}
+        for pool_id in self.pool_ids():
+            sel = self.pool == pool_id
+            res[pool_id] = numpy.zeros(self.ps[sel].max() + 1, dtype=numpy.int64)
+            res[pool_id][self.ps[sel]] = self.num_bytes[sel]
+        return res
+
+    def osd_usage(self, key='acting'):
+        "Returns (pg_count, bytes) arrays, indexed by osd id"
+        osd_sets = getattr(self, key)
+        used = osd_sets != NO_OSD
+        osds = osd_sets[used]
+        sizes = numpy.broadcast_to(self.num_bytes[:, None], osd_sets.shape)[used]
+        max_osd = osds.max(initial=-1) + 1
+        pg_count = numpy.bincount(osds, minlength=max_osd)
+        # float64 sums are exact up to 8PiB per OSD
+        osd_bytes = numpy.bincount(osds, weights=sizes, minlength=max_osd).round().astype(numpy.int64)
+        return pg_count, osd_bytes
+
+
+class PGDumpStream(object):
+    """
+    Incremental reader of 'ceph pg dump --format=json' output, which walks pg_stats
+    one record at a time, never keeping more than one chunk and one record in memory.
+    version and stamp are filled as soon as pg_stats list is found.
+    Both top level (before nautilus) and 'pg_map' nested pg_stats layouts are accepted.
+    ValueError is raised for truncated input and if header before pg_stats or single
+    record grows above max_size, so malformed input can't make buffer grow to whole dump
+    """
+    pg_stats_start = re.compile(r'"pg_stats"\s*:\s*\[')
+    version_re = re.compile(r'"version"\s*:\s*(\d+)')
+    stamp_re = re.compile(r'"stamp"\s*:\s*"([^"]*)"')
+    separator_re = re.compile(r'[\s,]*')
+
+    def __init__(self, fd, chunk_size=1 << 20, max_size=16 << 20):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf8")()
+        self.version = None
+        self.stamp = None
+        self.eof = False
+
+    def read_chunk(self):
+        while True:
+            data = self.fd.read(self.chunk_size)
+            if not data:
+                self.eof = True
+            if isinstance(data, bytes):
+                # chunk can end inside of multibyte char, which is decoded with next chunk
+                data = self.utf8.decode(data, final=not data)
+            if data or self.eof:
+                return data
+
+    def drain(self):
+        # let producer process finish writing, it would get SIGPIPE otherwise
+        while not self.eof:
+            self.read_chunk()
+
+    def __iter__(self):
+        buf = ""
+        while True:
+            match = self.pg_stats_start.search(buf)
+            if match:
+                break
+            if self.eof:
+                raise ValueError("No pg_stats found in pg dump")
+            if len(buf) > self.max_size:
+                raise ValueError("No pg_stats found in first {0} bytes of pg dump".format(len(buf)))
+            buf += self.read_chunk()
+
+        header = buf[:match.start()]
+        version = self.version_re.search(header)
+        stamp = self.stamp_re.search(header)
+        self.version = int(version.group(1)) if version else None
+        self.stamp = stamp.group(1) if stamp else None
+
+        pos = match.end()
+        while True:
+            pos = self.separator_re.match(buf, pos).end()
+            if pos == len(buf):
+                if self.eof:
+                    raise ValueError("Unexpected end of pg dump")
+                buf = self.read_chunk()
+                pos = 0
+                continue
+
+            if buf[pos] == ']':
+                return
+
+            try:
+                pg, end = self.decoder.raw_decode(buf, pos)
+            except ValueError:
+                if self.eof:
+                    raise ValueError("Unexpected end of pg dump or broken pg_stats record")
+                if len(buf) - pos > self.max_size:
+                    raise ValueError("pg_stats record is longer than {0} bytes, pg dump is broken".format(
+                                     self.max_size))
+                # record is split between chunks
+                buf = buf[pos:] + self.read_chunk()
+                pos = 0
+                continue
+
+            yield pg
+            pos = end
+
+
+class SnapshotBuilder(object):
+    "Collects pg_stats records into compact arrays, memory grows only with arrays size"
+    def __init__(self):
+        self.pool = array.array('i')
+        self.ps = array.array('i')
+        self.primary = array.array('i')
+        self.num_bytes = array.array('q')
+        self.num_ops = array.array('q')
+        self.sets = {'acting': (array.array('i'), array.array('i')),
+                     'up': (array.array('i'), array.array('i'))}
+
+    def add(self, pg):
+        pool_id, pg_id = pg['pgid'].split(".")
+        self.pool.append(int(pool_id))
+        self.ps.append(int(pg_id, 16))
+        self.primary.append(pg.get('acting_primary', pg['acting'][0] if pg['acting'] else NO_OSD))
+        self.num_bytes.append(pg['stat_sum']['num_bytes'])
+        self.num_ops.append(pg['stat_sum'].get('num_read', 0) + pg['stat_sum'].get('num_write', 0))
+        for key, (osd_ids, lengths) in self.sets.items():
+            osd_ids.extend(pg[key])
+            lengths.append(len(pg[key]))
+
+    def osd_sets(self, key):
+        osd_ids, lengths = self.sets[key]
+        osd_ids = numpy.frombuffer(osd_ids, dtype=numpy.int32) if osd_ids else numpy.zeros(0, dtype=numpy.int32)
+        lengths = numpy.frombuffer(lengths, dtype=numpy.int32) if lengths else numpy.zeros(0, dtype=numpy.int32)
+        res = numpy.full((len(lengths), lengths.max(initial=0)), NO_OSD, dtype=numpy.int32)
+        rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        starts = numpy.cumsum(lengths) - lengths
+        res[rows, numpy.arange(len(osd_ids)) - numpy.repeat(starts, lengths)] = osd_ids
+        return res
+
+    def build(self, version, stamp):
+        arrays = [numpy.array(arr, dtype=dtype) for arr, dtype in ((self.pool, numpy.int32),
+                                                                   (self.ps, numpy.int32),
+                                                                   (self.primary, numpy.int32),
+                                                                   (self.num_bytes, numpy.int64),
+                                                                   (self.num_ops, numpy.int64))]
+        pool, ps, primary, num_bytes, num_ops = arrays
+        return PGSnapshot(version, stamp, pool, ps, self.osd_sets('acting'), self.osd_sets('up'), primary, num_bytes,
+                          num_ops)
+
+
+def from_stream(fd):
+    "Build snapshot in one pass over pg dump from file object or process pipe"
+    stream = PGDumpStream(fd)
+    builder = SnapshotBuilder()
+    for pg in stream:
+        builder.add(pg)
+    stream.drain()
+    return builder.build(stream.version, stream.stamp)
+
+
+def from_pg_dump(pg_dump):
+    "Build snapshot from already decoded pg dump"
+    pg_map = pg_dump.get('pg_map', pg_dump)
+    builder = SnapshotBuilder()
+    for pg in pg_map['pg_stats']:
+        builder.add(pg)
+    return builder.build(pg_map.get('version'), pg_map.get('stamp'))
+
+
+def save(snapshot, cache_dir=DEFAULT_CACHE_DIR):
+    if snapshot.version is None:
+        logger.debug("PG dump has no version, snapshot is not cached")
+        return
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # write into temporary dir and rename to make concurrent runs safe
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    for name in PGSnapshot.arrays:
+        numpy.save(os.path.join(tmp_dir, name + ".npy"), getattr(snapshot, name))
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as fd:
+        json.dump({'version': snapshot.version, 'stamp': snapshot.stamp, 'format': FORMAT_VERSION}, fd)
+
+    dst = os.path.join(cache_dir, str(snapshot.version))
+    cached = load(snapshot.version, cache_dir)
+    if cached is None or cached.stamp != snapshot.stamp:
+        # old format or broken snapshot, or same version from other pg dump, e.g. from other cluster
+        shutil.rmtree(dst, ignore_errors=True)
+
+    try:
+        os.rename(tmp_dir, dst)
+    except OSError:
+        # same version is stored by concurrent process
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _cleanup(cache_dir)
+
+
+def _cleanup(cache_dir, keep=MAX_CACHED_SNAPSHOTS):
+    versions = sorted(int(name) for name in os.listdir(cache_dir) if name.isdigit())
+    for version in versions[:-keep]:
+        shutil.rmtree(os.path.join(cache_dir, str(version)), ignore_errors=True)
+
+
+def load(version, cache_dir=DEFAULT_CACHE_DIR):
+    "Load cached snapshot arrays as memory maps, returns None if no snapshot for version"
+    path = os.path.join(cache_dir, str(version))
+    try:
+        with open(os.path.join(path, "meta.json")) as fd:
+            meta = json.load(fd)
+        if meta['format'] != FORMAT_VERSION:
+            return None
+        arrays = [numpy.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in PGSnapshot.arrays]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    return PGSnapshot(meta['version'], meta['stamp'], *arrays)
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return "{0}:{1}:{2}".format(os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+
+def _files_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "files.json")) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _update_files_index(cache_dir, file_key, snapshot):
+    cached = set(os.listdir(cache_dir))
+    index = {key: val for key, val in _files_index(cache_dir).items() if str(val[0]) in cached}
+    index[file_key] = [snapshot.version, snapshot.stamp]
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(tmp_fd, "w") as fd:
+        json.dump(index, fd)
+    os.rename(tmp_path, os.path.join(cache_dir, "files.json"))
+
+
+def cluster_fsid():
+    return json.loads(run_locally("ceph fsid --format=json").decode("utf8"))['fsid']
+
+
+def current_version():
+    "(pgmap version, stamp) of live cluster, None for values, which can't be found"
+    pg_stat = json.loads(run_locally("ceph pg stat --format=json").decode("utf8"))
+    summary = pg_stat.get('pg_summary', {})
+    return pg_stat.get('version', summary.get('version')), pg_stat.get('stamp', summary.get('stamp'))
+
+
+def load_live_snapshot():
+    cmd = ["ceph", "pg", "dump", "--format=json"]
+    logger.debug("CMD: %s", " ".join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        snapshot = from_stream(proc.stdout)
+    finally:
+        proc.stdout.close()
+        retcode = proc.wait()
+
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, " ".join(cmd))
+    return snapshot
+
+
+def open_dump(pg_dump_f):
+    "Binary file object for pg dump, gzip compressed dumps are detected by content"
+    with open(pg_dump_f, "rb") as fd:
+        magic = fd.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(pg_dump_f, "rb")
+    return open(pg_dump_f, "rb")
+
+
+def load_pg_snapshot(pg_dump_f=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Get pg dump snapshot from file or from live cluster, if pg_dump_f is None.
+    Cached snapshot is used if one exists for the same pgmap version (and cluster fsid for live cluster)
+    and stamp, cache_dir=None disables cache
+    """
+    version = stamp = None
+    if cache_dir is None:
+        pass
+    elif pg_dump_f is None:
+        cache_dir = os.path.join(cache_dir, cluster_fsid())
+        version, stamp = current_version()
+    else:
+        version, stamp = _files_index(cache_dir).get(_file_key(pg_dump_f), (None, None))
+
+    if version is not None:
+        snapshot = load(version, cache_dir)
+        # 'ceph pg stat' of older releases has no stamp, then fsid and version are checked only
+        if snapshot is not None and (snapshot.stamp == stamp or (pg_dump_f is None and stamp is None)):
+            logger.debug("Use cached pg dump snapshot for pgmap version %s", version)
+            return snapshot
+
+    if pg_dump_f is None:
+        snapshot = load_live_snapshot()
+    else:
+        with open_dump(pg_dump_f) as fd:
+            snapshot = from_stream(fd)
+    if cache_dir is not None:
+        save(snapshot, cache_dir)
+        if pg_dump_f is not None and snapshot.version is not None:
+            _update_files_index(cache_dir, _file_key(pg_dump_f), snapshot)
+
+    return snapshot
@@ -2,10 +2,12 @@ from __future__ import print_function
 
 import os
 import sys
-import time
+import copy
 import json
 import math
+import collections
 import shutil
+import subprocess
 import os.path
 import logging
 import argparse
@@ -16,8 +18,12 @@ import yaml
 
 from cephlib.common import run_locally, tmpnam
 from cephlib.units import b2ssize
-from cephlib.crush import load_crushmap
-from calculate_remap import calculate_remap, get_osd_curr
+import cluster_snapshot
+import rebalance_tracker
+import rebalance_scheduler
+import rebalance_journal
+from crush_mapper import UnsupportedMap
+from calculate_remap import calculate_remap, calculate_remap_steps, get_osd_curr, import_crush, RemapStats
 
 
 logger = logging.getLogger("ceph.rebalance")
@@ -32,20 +38,6 @@ default_zone_order = ["osd", "host", "chassis", "rack", "row", "pdu",
                       "pod", "room", "datacenter", "region", "root"]
 
 
-def is_rebalance_complete(allowed_states=("active+clean", "active+remapped")):
-    pg_stat = json.loads(run_locally("ceph pg stat --format=json").decode('utf8'))
-    if 'num_pg_by_state' in pg_stat:
-        for dct in pg_stat['num_pg_by_state']:
-            if dct['name'] not in allowed_states and dct["num"] != 0:
-                return False
-    else:
-        ceph_state = json.loads(run_locally("ceph -s --format=json").decode('utf8'))
-        for pg_stat_dict in ceph_state['pgmap']['pgs_by_state']:
-            if pg_stat_dict['state_name'] not in allowed_states and pg_stat_dict['count'] != 0:
-                return False
-    return True
-
-
 def request_weight_update(node, new_weight):
     path_s = " ".join("{0}={1}".format(tp, name) for tp, name in node.full_path)
     cmd = "ceph osd crush set {name} {weight} {path}".format(name=node.name, weight=new_weight, path=path_s)
@@ -57,56 +49,62 @@ def request_reweight_update(node, new_weight):
     run_locally("ceph osd reweight {0} {1}".format(osd_id, new_weight))
 
 
-def wait_rebalance_to_complete(any_updates, sleep_interwal=2):
-    if not any_updates:
-        if is_rebalance_complete():
+def current_crush_version():
+    "Crush version of live cluster osd map, None for ceph before luminous"
+    return json.loads(run_locally("ceph osd dump --format=json").decode("utf8")).get('crush_version')
+
+
+def request_weight_updates(changes, retries=3):
+    """
+    Apply all weight changes of round as one new crush map, so cluster gets one new osd map epoch.
+    Crush map is set with version it was read at, so monitor rejects it, if crush was changed meanwhile,
+    and update is repeated on new crush. If crush keeps changing or cluster can't check version,
+    changes are applied with per OSD commands, which can't overwrite other crush changes
+    """
+    for _ in range(retries):
+        crush_version = current_crush_version()
+        if crush_version is None:
+            logger.warning("Cluster doesn't report crush version, apply weights one by one")
+            break
+
+        # version is read before the map, so map is never older, than version passed to monitor
+        crushmap_bin_f = tmpnam()
+        run_locally("ceph osd getcrushmap -o {0}".format(crushmap_bin_f))
+        update_crush_weights(crushmap_bin_f, changes)
+        try:
+            run_locally("ceph osd setcrushmap -i {0} {1}".format(crushmap_bin_f, crush_version))
             return
-
-    logger.debug("Waiting for cluster to complete rebalance")
-
-    if any_updates:
-        time.sleep(sleep_interwal)
-
-    while not is_rebalance_complete():
-        sleep_interwal *= 1.5
-        time.sleep(sleep_interwal)
-        logger.debug("Waiting for cluster to complete rebalance")
-
-
-def load_all_data(opts, no_cache=False):
-    if no_cache or not opts.osd_map:
-        if opts.offline:
-            logger.error("Can't get osd's map in offline mode as --osd-map is not passed from CLI")
-            return None, None, None, None
-        else:
-            osd_map_f = tmpnam()
-            run_locally("ceph osd getmap -o {0}".format(osd_map_f))
+        except subprocess.CalledProcessError:
+            if current_crush_version() == crush_version:
+                raise
+            logger.warning("Crush map was changed by someone else during round update, retry")
     else:
-        osd_map_f = opts.osd_map
+        logger.warning("Crush map keeps changing, apply weights one by one")
 
-    crushmap_bin_f = tmpnam()
-    run_locally("osdmaptool --export-crush {0} {1}".format(crushmap_bin_f, osd_map_f))
+    for node, new_weight in changes:
+        request_weight_update(node, new_weight)
 
-    crushmap_txt_f = tmpnam()
-    run_locally("crushtool -d {0} -o {1}".format(crushmap_bin_f, crushmap_txt_f))
 
-    if no_cache or not opts.osd_tree:
-        if opts.offline:
-            logger.warning("Can't get osd's reweright in offline mode as --osd-tree is not passed from CLI")
-            osd_tree_js = None
-        else:
-            osd_tree_js = run_locally("ceph osd tree --format=json").decode("utf8")
-    else:
-        osd_tree_js = open(opts.osd_tree).read()
+def request_reweight_updates(changes):
+    "Apply all reweights of round with single 'ceph osd reweightn' call"
+    # monitor accepts only string osd ids and string values in 16.16 fixed point
+    reweights = {str(int(node.name.split('.')[1])): str(int(round(new_weight * 0x10000)))
+                 for node, new_weight in changes}
+    run_locally("ceph osd reweightn '{0}'".format(json.dumps(reweights)))
 
-    curr_reweight = {}
-    if osd_tree_js:
-        for node in json.loads(osd_tree_js)['nodes']:
-            if node['type'] == 'osd':
-                curr_reweight[node['name']] = node.get('reweight', 1.0)
 
-    crush = load_crushmap(crushmap_txt_f)
-    return crush, curr_reweight, crushmap_bin_f, osd_map_f
+def load_all_data(cluster):
+    """
+    Returns (crush, {osd name: reweight}, binary crush map file, osd map file), Nones if osd map is not available.
+    Crush map file is private copy, which is updated in place during rebalance
+    """
+    try:
+        crushmap_bin_f = tmpnam()
+        shutil.copy(cluster.crushmap_bin_f, crushmap_bin_f)
+        return cluster.crush, cluster.reweights, crushmap_bin_f, cluster.osd_map_f
+    except cluster_snapshot.MissingArtifact as exc:
+        logger.error("%s", exc)
+        return None, None, None, None
 
 
 class Config(object):
@@ -120,6 +118,12 @@ class Config(object):
         self.reweight_nodes = []
         self.total_weight_change = 0.0
         self.total_reweight_change = 0.0
+        # {crush type: max OSDs under one bucket of this type, updated in one round}
+        self.domain_limits = {}
+        # {osd name: full_path}, to find failure domains of reweighted OSDs
+        self.osd_paths = {}
+        # {node name: name of paired node}, paired weight changes are applied in the same round
+        self.weight_pairs = {}
 
 
 def prepare_update_config(config_dict, crush, curr_reweight):
@@ -131,6 +135,14 @@ def prepare_update_config(config_dict, crush, curr_reweight):
     config.min_weight_diff = config_dict.get('min_weight_diff', 0.01)
     config.min_reweight_diff = config_dict.get('min_reweight_diff', 0.01)
 
+    config.domain_limits = dict(config_dict.get('failure_domains', {}))
+    for domain_type, limit in config.domain_limits.items():
+        if limit < 1:
+            logger.error("Limit of updated OSDs per %s must be at least 1, not %s", domain_type, limit)
+            return None
+    if config.domain_limits:
+        config.osd_paths = {node.name: node.full_path for node in crush.iter_nodes('osd')}
+
     new_osd_reweights = {}
 
     for node in config_dict['osds']:
@@ -187,8 +199,373 @@ def prepare_update_config(config_dict, crush, curr_reweight):
     return config
 
 
+def node_domains(node, config):
+    "Failure domains of node, which have limits, as list of (type, name)"
+    path = getattr(node, 'full_path', None) or config.osd_paths.get(node.name, [])
+    return [(tp, name) for tp, name in path if tp in config.domain_limits]
+
+
+def take_round_nodes(active_list, config, pairs=None):
+    """
+    Remove changes for next round from active_list and return them.
+    Changes, which would exceed per failure domain limits, are skipped and stay at the list head.
+    pairs - {node name: paired node name}, paired changes are taken together or both skipped
+    """
+    if not (config.domain_limits or pairs):
+        next_nodes = active_list[:config.max_nodes_per_round]
+        del active_list[:config.max_nodes_per_round]
+        return next_nodes
+
+    active = {node.name: (node, coef) for node, coef in active_list}
+    used = collections.Counter()
+    taken = set()
+    next_nodes = []
+    for node, coef in active_list:
+        if node.name in taken:
+            continue
+        group = [(node, coef)]
+        partner = (pairs or {}).get(node.name)
+        if partner in active and partner not in taken and config.max_nodes_per_round > 1:
+            group.append(active[partner])
+        domains = collections.Counter(domain for item, _ in group for domain in node_domains(item, config))
+        if len(next_nodes) + len(group) <= config.max_nodes_per_round and \
+                all(used[domain] + count <= config.domain_limits[domain[0]] for domain, count in domains.items()):
+            next_nodes.extend(group)
+            used.update(domains)
+            taken.update(item.name for item, _ in group)
+    active_list[:] = [(node, coef) for node, coef in active_list if node.name not in taken]
+    return next_nodes
+
+
+def iter_rounds(config):
+    """
+    Split config changes into rounds, the same way cluster update does.
+    Yields (is_reweight_round, [(node, old_weight, new_weight)]), node.weight is set to new weight and
+    config node lists are consumed
+    """
+    round = 0
+    while config.rebalance_nodes or config.reweight_nodes:
+        is_reweight_round = (round % 2 == 1 or not config.rebalance_nodes)
+        if is_reweight_round:
+            active_list = config.reweight_nodes
+            max_change = config.max_reweight_change
+            min_diff = config.min_reweight_diff
+        else:
+            active_list = config.rebalance_nodes
+            max_change = config.max_weight_change
+            min_diff = config.min_weight_diff
+
+        next_nodes = take_round_nodes(active_list, config, None if is_reweight_round else config.weight_pairs)
+
+        changes = []
+        for node, coef in next_nodes:
+            change = coef - node.weight
+
+            if abs(change) > max_change + min_diff:
+                change = math.copysign(max_change, change)
+
+            changes.append((node, node.weight, node.weight + change))
+            node.weight += change
+
+            if abs(node.weight - coef) > min_diff:
+                active_list.append((node, coef))
+
+        yield is_reweight_round, changes
+        round += 1
+
+
+def copy_config(config):
+    "Config copy, which can be consumed by iter_rounds without touching crush nodes"
+    res = copy.copy(config)
+    res.rebalance_nodes = [(FakedNode(name=node.name, id=node.id, weight=node.weight, full_path=node.full_path),
+                            new_weight)
+                           for node, new_weight in config.rebalance_nodes]
+    res.reweight_nodes = [(FakedNode(name=node.name, weight=node.weight), new_weight)
+                          for node, new_weight in config.reweight_nodes]
+    return res
+
+
+def update_crush_weights(crushmap_bin_f, changes):
+    "Set new weights in binary crush map file in place, changes is a list of (node, new_weight)"
+    cmd_templ = "crushtool -i {crush_map_f} -o {crush_map_f} --update-item {id} {weight} {name} {loc}"
+    for node, new_weight in changes:
+        loc = " ".join("--loc {0} {1}".format(tp, name) for tp, name in node.full_path)
+        run_locally(cmd_templ.format(crush_map_f=crushmap_bin_f, id=node.id, weight=new_weight,
+                                     name=node.name, loc=loc))
+
+
+def osd_reweights(changes):
+    "{osd_id: new_reweight} for list of (node, new_reweight), as crush_mapper.apply_reweights expects"
+    return {int(node.name.split('.')[1]): new_weight for node, new_weight in changes}
+
+
+def simulate_rounds(config, crushmap_bin_f, osd_map_f, pg_dump_f=None):
+    """
+    Replay cluster update rounds on copy of crush map and calculate data movement for every round.
+    Reweights of previous rounds are applied to every round map by in-process mapping engine.
+    Returns ([(is_reweight_round, RemapStats)], RemapStats for direct change)
+    """
+    round_crush_f = tmpnam()
+    shutil.copy(crushmap_bin_f, round_crush_f)
+
+    map_files = [osd_map_f]
+    reweights = [None]
+    curr_reweights = {}
+    round_types = []
+    for is_reweight_round, changes in iter_rounds(copy_config(config)):
+        if not is_reweight_round:
+            update_crush_weights(round_crush_f, [(node, new_weight) for node, _, new_weight in changes])
+            map_files.append(import_crush(osd_map_f, round_crush_f))
+        else:
+            curr_reweights.update(osd_reweights([(node, new_weight) for node, _, new_weight in changes]))
+            map_files.append(map_files[-1])
+        reweights.append(dict(curr_reweights))
+        round_types.append(is_reweight_round)
+
+    steps, direct = calculate_remap_steps(map_files, pg_dump_f=pg_dump_f, reweights=reweights)
+    rounds = [(is_reweight_round, RemapStats("round {0}".format(idx), osd_changes))
+              for idx, (is_reweight_round, osd_changes) in enumerate(zip(round_types, steps), 1)]
+    return rounds, RemapStats("direct", direct)
+
+
+def parent_path(node):
+    return tuple((tp, name) for tp, name in node.full_path if name != node.name)
+
+
+def change_size(item):
+    node, new_weight = item
+    return abs(new_weight - node.weight)
+
+
+def common_depth(path1, path2):
+    depth = 0
+    for item1, item2 in zip(path1, path2):
+        if item1 != item2:
+            break
+        depth += 1
+    return depth
+
+
+def can_pair(node1, node2, config):
+    "Two changes fit in one round, i.e. their common failure domains allow at least two changed nodes"
+    common = set(node_domains(node1, config)) & set(node_domains(node2, config))
+    return config.max_nodes_per_round > 1 and all(config.domain_limits[tp] > 1 for tp, _ in common)
+
+
+def config_order(nodes, config):
+    return list(nodes), {}
+
+
+def paired_order(nodes, config):
+    """
+    Pair every weight increase with decrease of similar size in the nearest bucket, where failure domain
+    limits allow to change both in one round, e.g. with 'host: 1' pairs are made from different hosts
+    of the same rack. Data, leaving decreased OSD, goes to its neighbour in the same round, and pair
+    needs the same number of rounds to complete. Pairs go first, biggest first.
+    Returns (ordered nodes, {node name: paired node name}), take_round_nodes keeps pairs in one round
+    """
+    increases = sorted([item for item in nodes if item[1] > item[0].weight], key=change_size, reverse=True)
+    decreases = sorted([item for item in nodes if item[1] <= item[0].weight], key=change_size, reverse=True)
+
+    paired = []
+    pairs = {}
+    for inc in increases:
+        best_idx, best_key = None, None
+        for idx, dec in enumerate(decreases):
+            depth = common_depth(parent_path(inc[0]), parent_path(dec[0]))
+            # changes under different roots don't exchange data
+            if depth == 0 or not can_pair(inc[0], dec[0], config):
+                continue
+            key = (depth, -abs(change_size(inc) - change_size(dec)))
+            if best_key is None or key > best_key:
+                best_idx, best_key = idx, key
+        if best_idx is None:
+            continue
+        dec = decreases.pop(best_idx)
+        paired.extend([inc, dec])
+        pairs[inc[0].name] = dec[0].name
+        pairs[dec[0].name] = inc[0].name
+
+    singles = [item for item in increases if item[0].name not in pairs] + decreases
+    return paired + singles, pairs
+
+
+def size_order(nodes, config):
+    "Biggest changes first, nodes, which needs the same number of rounds, are changed together"
+    return sorted(nodes, key=change_size, reverse=True), {}
+
+
+# every ordering returns (ordered weight changes, weight_pairs)
+ORDERINGS = [("config", config_order), ("paired", paired_order), ("by size", size_order)]
+
+
+def plan_order(config, crushmap_bin_f, osd_map_f, pg_dump_f=None):
+    """
+    Reorder config weight changes to minimize step-by-step data movement.
+    Every ordering from ORDERINGS is simulated with remap estimator, the cheapest one is kept in config.
+    Returns ({ordering name: bytes to be moved}, name of selected ordering)
+    """
+    results = collections.OrderedDict()
+    best = None
+    for name, order_func in ORDERINGS:
+        candidate = copy.copy(config)
+        candidate.rebalance_nodes, candidate.weight_pairs = order_func(config.rebalance_nodes, config)
+        rounds, _ = simulate_rounds(candidate, crushmap_bin_f, osd_map_f, pg_dump_f=pg_dump_f)
+        results[name] = sum(stats.bytes_moved for _, stats in rounds)
+        logger.debug("%s order moves %sB", name, b2ssize(results[name]))
+        if best is None or results[name] < results[best[0]]:
+            best = name, candidate
+
+    config.rebalance_nodes = best[1].rebalance_nodes
+    config.weight_pairs = best[1].weight_pairs
+    return results, best[0]
+
+
+def show_simulation(rounds, direct):
+    total_bytes = 0
+    total_pg = 0
+    for idx, (is_reweight_round, stats) in enumerate(rounds, 1):
+        total_bytes += stats.bytes_moved
+        total_pg += stats.pg_moved
+        logger.info("Round %3d %-8s: %8sB %5d PG, total %8sB %6d PG", idx,
+                    "reweight" if is_reweight_round else "weight", b2ssize(stats.bytes_moved),
+                    stats.pg_moved, b2ssize(total_bytes), total_pg)
+
+    logger.info("Step-by-step bytes to be moved : %sB", b2ssize(total_bytes))
+    logger.info("Step-by-step PG to be moved : %s", total_pg)
+    logger.info("One-shot change would move %sB in %s PG", b2ssize(direct.bytes_moved), direct.pg_moved)
+    if direct.bytes_moved:
+        overhead = total_bytes - direct.bytes_moved
+        logger.info("Step-by-step overhead : %sB (%.1f%%)", b2ssize(overhead),
+                    overhead * 100.0 / direct.bytes_moved)
+
+
+def count_rounds(config):
+    return sum(1 for _ in iter_rounds(copy_config(config)))
+
+
+def run_rounds(config, tracker, batch=False, scheduler=None, gate=None, journal=None, meter=None):
+    """
+    Update cluster round by round, waiting for rebalance to complete after each round.
+    batch - apply whole round with one osd map change instead of one change per OSD
+    scheduler - AdaptiveScheduler, which updates round size and steps before every round
+    gate - PipelineGate, which allows to start next round before rebalance completes
+    journal, meter - ProgressJournal and RecoveryMeter to record finished rounds and show ETA
+    """
+    # steps may be changed by scheduler, so progress is measured in initial steps
+    weight_unit = config.max_weight_change
+    reweight_unit = config.max_reweight_change
+    already_changed = 0.0
+    requested_changes = config.total_weight_change / weight_unit + config.total_reweight_change / reweight_unit
+
+    tracker.wait_complete(False)
+
+    for is_reweight_round, changes in iter_rounds(config):
+        if already_changed > config.min_weight_diff:
+            logger.info("Done %s%%", int(already_changed * 100.0 / requested_changes + 0.5))
+
+        if is_reweight_round:
+            max_change = reweight_unit
+            upd_func = request_reweight_update
+            batch_upd_func = request_reweight_updates
+        else:
+            max_change = weight_unit
+            upd_func = request_weight_update
+            batch_upd_func = request_weight_updates
+
+        if gate is not None:
+            gate.start_round(tracker.status)
+
+        if journal is not None:
+            journal.start_round()
+            if meter is not None:
+                meter.start_round()
+
+        if batch:
+            batch_upd_func([(node, new_weight) for node, _, new_weight in changes])
+        else:
+            for node, _, new_weight in changes:
+                upd_func(node, new_weight)
+
+        for node, old_weight, new_weight in changes:
+            already_changed += abs(new_weight - old_weight) / max_change
+
+        tracker.wait_complete(True, ready=None if gate is None else gate.ready)
+        if scheduler is not None:
+            scheduler.adjust(config)
+
+        if journal is not None:
+            record = journal.finish_round(changes, 0 if meter is None else meter.finish_round())
+            eta = journal.eta(count_rounds(config))
+            throughput = journal.throughput()
+            logger.info("Round %s done in %s, recovered %sB, throughput %sB/s, ETA %s", record['round'],
+                        rebalance_journal.format_duration(record['end'] - record['start']),
+                        b2ssize(record['recovered_bytes']),
+                        "-" if throughput is None else b2ssize(throughput),
+                        "-" if eta is None else rebalance_journal.format_duration(eta))
+
+    if gate is not None:
+        logger.info("All changes are applied, waiting for rebalance to complete")
+        tracker.wait_complete(False)
+
+
+def estimate_movement(config, cluster, crushmap_bin_f, osd_map_f, opts):
+    """
+    Log expected data movement of config, returns estimated bytes to be moved or None.
+    Raises UnsupportedMap, if reweights can't be accounted for
+    """
+    estimated_bytes = None
+    if opts.minimize_movement and not (opts.offline and not opts.pg_dump):
+        results, best = plan_order(config, crushmap_bin_f, osd_map_f, pg_dump_f=cluster)
+        logger.info("Use %s order, it moves %sB", best, b2ssize(results[best]))
+        logger.info("Saved compared to config order : %sB", b2ssize(results["config"] - results[best]))
+
+    if opts.simulate_rounds and not (opts.offline and not opts.pg_dump):
+        rounds, direct = simulate_rounds(config, crushmap_bin_f, osd_map_f, pg_dump_f=cluster)
+        show_simulation(rounds, direct)
+        estimated_bytes = sum(stats.bytes_moved for _, stats in rounds)
+
+    if config.rebalance_nodes:
+        update_crush_weights(crushmap_bin_f, config.rebalance_nodes)
+        osd_map_new_f = import_crush(osd_map_f, crushmap_bin_f)
+    else:
+        osd_map_new_f = osd_map_f
+
+    if opts.offline and not opts.pg_dump:
+        logger.warning("Can't calculate pg/data movement in offline mode if no pg dump provided")
+    else:
+        osd_changes = calculate_remap(osd_map_f, osd_map_new_f, pg_dump_f=cluster,
+                                      new_reweights=osd_reweights(config.reweight_nodes))
+
+        total_send = 0
+        total_moved_pg = 0
+
+        for osd_id, osd_change in sorted(osd_changes.items()):
+            total_send += osd_change.bytes_in
+            total_moved_pg += osd_change.pg_in
+
+        logger.info("Total bytes to be moved : %sB", b2ssize(total_send))
+        logger.info("Total PG to be moved  : %s", total_moved_pg)
+        if estimated_bytes is None:
+            estimated_bytes = total_send
+
+        if opts.show_after:
+            osd_curr = get_osd_curr(cluster)
+            for osd_id, osd_change in sorted(osd_changes.items()):
+                pg_diff = osd_change.pg_in - osd_change.pg_out
+                bytes_diff = osd_change.bytes_in - osd_change.bytes_out
+                logger.info("OSD {0}, PG {1:>4d} => {2:>4d},  bytes {3:>6s} => {4:>6s}".format(
+                            osd_id, osd_curr[osd_id].pg,
+                            osd_curr[osd_id].pg + pg_diff,
+                            b2ssize(osd_curr[osd_id].bytes),
+                            b2ssize(osd_curr[osd_id].bytes + bytes_diff)))
+
+    return estimated_bytes
+
+
 def do_rebalance(config_dict, opts):
-    crush, curr_reweight, crushmap_bin_f, osd_map_f = load_all_data(opts)
+    cluster = cluster_snapshot.ClusterSnapshot.from_opts(opts)
+    crush, curr_reweight, crushmap_bin_f, osd_map_f = load_all_data(cluster)
     if crush is None:
         return 1
 
@@ -214,51 +591,31 @@ def do_rebalance(config_dict, opts):
     if config.total_reweight_change > 0:
         logger.info("Total sum of all reweight changes = %.2f", config.total_reweight_change)
 
-    # --------------------  DO ESTIMATION ------------------------------------------------------------------------------
-
-    if not opts.no_estimate:
-        if config.total_reweight_change != 0.0:
-            logger.warning("Can't estimate reweight results! Estimation only includes weight changes!")
-
-        if config.total_weight_change == 0:
-            logger.info("No weight is changes. No PG/data would be moved")
-        else:
-            cmd_templ = "crushtool -i {crush_map_f} -o {crush_map_f} --update-item {id} {weight} {name} {loc}"
-            for node, new_weight in config.rebalance_nodes:
-                loc = " ".join("--loc {0} {1}".format(tp, name) for tp, name in node.full_path)
-                cmd = cmd_templ.format(crush_map_f=crushmap_bin_f, id=node.id, weight=new_weight,
-                                       name=node.name, loc=loc)
-                run_locally(cmd)
-
-            osd_map_new_f = tmpnam()
-            shutil.copy(osd_map_f, osd_map_new_f)
-            run_locally("osdmaptool --import-crush {0} {1}".format(crushmap_bin_f, osd_map_new_f))
-
-            if opts.offline and not opts.pg_dump:
-                logger.warning("Can't calculate pg/data movement in offline mode if no pg dump provided")
-            else:
-                osd_changes = calculate_remap(osd_map_f, osd_map_new_f, pg_dump_f=opts.pg_dump)
-
-                total_send = 0
-                total_moved_pg = 0
-
-                for osd_id, osd_change in sorted(osd_changes.items()):
-                    total_send += osd_change.bytes_in
-                    total_moved_pg += osd_change.pg_in
+    journal = None
+    resumed = False
+    if not (opts.estimate_only or opts.offline):
+        journal = rebalance_journal.ProgressJournal(opts.journal or opts.config + ".journal")
+        cfg_hash = rebalance_journal.config_hash(opts.config)
+        fsid = cluster.osd_dump.get('fsid')
+        resumed = journal.can_resume(cfg_hash, config, fsid=fsid, epoch=cluster.epoch)
+
+    if resumed:
+        journal.restore_order(config)
+        logger.info("Continue run from %s: %s rounds done, %sB recovered", journal.path, len(journal.rounds),
+                    b2ssize(journal.recovered_bytes()))
+        if journal.plan.get('estimated_bytes') is not None:
+            logger.info("Total bytes to be moved : %sB", b2ssize(journal.plan['estimated_bytes']))
 
-                logger.info("Total bytes to be moved : %sB", b2ssize(total_send))
-                logger.info("Total PG to be moved  : %s", total_moved_pg)
+    # --------------------  DO ESTIMATION ------------------------------------------------------------------------------
 
-                if opts.show_after:
-                    osd_curr = get_osd_curr()
-                    for osd_id, osd_change in sorted(osd_changes.items()):
-                        pg_diff = osd_change.pg_in - osd_change.pg_out
-                        bytes_diff = osd_change.bytes_in - osd_change.bytes_out
-                        logger.info("OSD {0}, PG {1:>4d} => {2:>4d},  bytes {3:>6s} => {4:>6s}".format(
-                                    osd_id, osd_curr[osd_id].pg,
-                                    osd_curr[osd_id].pg + pg_diff,
-                                    b2ssize(osd_curr[osd_id].bytes),
-                                    b2ssize(osd_curr[osd_id].bytes + bytes_diff)))
+    estimated_bytes = None
+    if not (opts.no_estimate or resumed):
+        try:
+            estimated_bytes = estimate_movement(config, cluster, crushmap_bin_f, osd_map_f, opts)
+        except UnsupportedMap as exc:
+            logger.error("Can't estimate data movement: %s", exc)
+            if opts.estimate_only:
+                return 1
 
         if opts.estimate_only:
             return 0
@@ -271,48 +628,23 @@ def do_rebalance(config_dict, opts):
 
     logger.info("Start updating the cluster")
 
-    already_changed = 0.0
-    requested_changes = config.total_weight_change / config.max_weight_change + \
-                        config.total_reweight_change / config.max_reweight_change
-
-    wait_rebalance_to_complete(False)
-
-    round = 0
-    while config.rebalance_nodes or config.reweight_nodes:
-        if already_changed > config.min_weight_diff:
-            logger.info("Done %s%%", int(already_changed * 100.0 / requested_changes + 0.5))
-
-        is_reweight_round = (round % 2 == 1 or not config.rebalance_nodes)
-        if is_reweight_round:
-            active_list = config.reweight_nodes
-            max_change = config.max_reweight_change
-            min_diff = config.min_reweight_diff
-            upd_func = request_reweight_update
-        else:
-            active_list = config.rebalance_nodes
-            max_change = config.max_weight_change
-            min_diff = config.min_weight_diff
-            upd_func = request_weight_update
-
-        next_nodes = active_list[:config.max_nodes_per_round]
-        del active_list[:config.max_nodes_per_round]
-
-        for node, coef in next_nodes:
-            change = coef - node.weight
+    if not resumed:
+        journal.start_plan(cfg_hash, config, estimated_bytes, fsid=fsid, epoch=cluster.epoch)
 
-            if abs(change) > max_change + min_diff:
-                change = math.copysign(max_change, change)
+    scheduler = None
+    if config_dict.get('adaptive'):
+        scheduler = rebalance_scheduler.AdaptiveScheduler(config_dict['adaptive'], config)
 
-            node.weight += change
-            upd_func(node, node.weight)
+    gate = None
+    if config_dict.get('pipeline'):
+        gate = rebalance_scheduler.PipelineGate(config_dict['pipeline'])
 
-            if abs(node.weight - coef) > min_diff:
-                active_list.append((node, coef))
-
-            already_changed += abs(change) / max_change
-
-        wait_rebalance_to_complete(True)
-        round += 1
+    tracker = rebalance_tracker.open_tracker(on_check=None if scheduler is None else scheduler.sample)
+    meter = rebalance_journal.RecoveryMeter(tracker.status)
+    try:
+        run_rounds(config, tracker, batch=opts.batch, scheduler=scheduler, gate=gate, journal=journal, meter=meter)
+    finally:
+        tracker.close()
 
     # ------------------- CHECK RESULTS --------------------------------------------------------------------------------
 
@@ -320,7 +652,12 @@ def do_rebalance(config_dict, opts):
         return 0
 
     logger.info("Verifying results")
-    crush, curr_reweight, crushmap_bin_f, osd_map_f = load_all_data(opts, no_cache=True)
+    # verification needs cluster state after all updates, not files from cli
+    if cluster.osd_map_file is None and cluster.osd_tree_file is None:
+        cluster.refresh()
+    else:
+        cluster = cluster_snapshot.ClusterSnapshot()
+    crush, curr_reweight, crushmap_bin_f, osd_map_f = load_all_data(cluster)
     failed = False
 
     for node in crush.iter_nodes('osd'):
@@ -384,6 +721,25 @@ min_weight_diff: 0.01
 # minimal reweight difference to be corrected
 min_reweight_diff: 0.01
 
+# optional: max OSDs, updated in one round, under one crush bucket of given type,
+# to spread recovery load over failure domains
+failure_domains:
+  host: 1
+  rack: 2
+
+# optional: adapt OSDs per round and steps to recovery load, see rebalance_scheduler.py
+# latency is OSD commit/apply latency percentile, as ceph has no client latency stats
+adaptive:
+  max_latency_ms: 50
+  latency_percentile: 0.9
+  max_recovery_bw: 500M
+
+# optional: start next round when misplaced objects ratio falls below threshold,
+# keeping misplaced data under hard cap
+pipeline:
+  max_misplaced_ratio: 0.01
+  max_inflight: 200G
+
 # list of all OSD to be rebalanced
 osds:
   # OSD tree location: name, root, host
@@ -414,9 +770,25 @@ def parse_args(argv):
                         help="Show PGs and data distibution after rebalance complete" +
                              "(incompatible with -n/--no-estimate)")
 
+    parser.add_argument("-r", "--simulate-rounds", action='store_true',
+                        help="Estimate data movement for every rebalance round, as well as for one-shot change " +
+                             "(incompatible with -n/--no-estimate)")
+
+    parser.add_argument("-m", "--minimize-movement", action='store_true',
+                        help="Order OSD changes to minimize data movement, as estimated for every round " +
+                             "(incompatible with -n/--no-estimate)")
+
     parser.add_argument("-n", "--no-estimate", action='store_true',
                         help="Don't estimate rebalance size (incompatible with -e/--estimate-only)")
 
+    parser.add_argument("-b", "--batch", action='store_true',
+                        help="Apply all changes of round as one osd map update: single setcrushmap for weights " +
+                             "and single reweightn for reweights")
+
+    parser.add_argument("-J", "--journal", metavar="FILE", default=None,
+                        help="Progress journal file, CONFIG.journal by default. Run with unchanged config " +
+                             "continues plan from journal")
+
     parser.add_argument("-o", "--osd-map", metavar="FILE", help="Pass OSD map from CLI")
     parser.add_argument("-p", "--pg-dump", metavar="FILE", help="Pass PG map json file from CLI")
     parser.add_argument("-t", "--osd-tree", metavar="FILE", help="Pass osd tree json file from CLI")
@@ -443,6 +815,14 @@ def parse_args(argv):
         logger.error("-s/--show-after is incompatible with -n/--no-estimate\n")
         return None
 
+    if opts.simulate_rounds and opts.no_estimate:
+        logger.error("-r/--simulate-rounds is incompatible with -n/--no-estimate\n")
+        return None
+
+    if opts.minimize_movement and opts.no_estimate:
+        logger.error("-m/--minimize-movement is incompatible with -n/--no-estimate\n")
+        return None
+
     return opts
 
 
@@ -0,0 +1,228 @@
+"""
+Run rebalance on many clusters at once.
+
+Every cluster is driven by its own rebalance.py process with CEPH_CONF pointing to
+cluster config, so ceph cli and librados calls of one cluster never mix with others,
+and failure or hang of one run doesn't affect the rest. Output of all runs is read
+by one asyncio event loop, which keeps per cluster progress and shows it as one table.
+Every run writes its own journal, so fleet can be restarted. Requires python 3.5+.
+
+Fleet file example(yaml):
+
+    clusters:
+      - name: dc1
+        conf: /etc/ceph/dc1.conf
+        config: dc1-rebalance.yaml
+        # optional, CONFIG.journal by default
+        journal: dc1-rebalance.journal
+        # optional, extra rebalance.py options
+        args: [-b, -n]
+      - name: dc2
+        conf: /etc/ceph/dc2.conf
+        config: dc2-rebalance.yaml
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import asyncio
+import logging
+import argparse
+
+import yaml
+
+from cephlib.common import setup_loggers
+
+
+logger = logging.getLogger("ceph.fleet")
+
+
+REBALANCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rebalance.py")
+MAX_LINE = 1 << 20
+STOP_TIMEOUT = 10
+
+done_re = re.compile(r"Done (?P<done>\d+)%")
+eta_re = re.compile(r"ETA (?P<eta>.*)$")
+log_line_re = re.compile(r"^\S+ - (?P<level>[A-Z]+) - (?P<message>.*)$")
+
+
+class ClusterRun(object):
+    "rebalance.py process for one cluster and its progress"
+    def __init__(self, name, conf, config, journal=None, args=()):
+        self.name = name
+        self.conf = conf
+        self.config = config
+        self.journal = journal
+        self.args = list(args)
+        self.proc = None
+        self.done = 0
+        self.eta = None
+        self.last_message = ""
+        self.last_error = None
+        self.retcode = None
+
+    def cmd(self):
+        cmd = [sys.executable, REBALANCE] + self.args
+        if self.journal:
+            cmd += ["-J", self.journal]
+        return cmd + [self.config]
+
+    async def start(self):
+        env = os.environ.copy()
+        env["CEPH_CONF"] = self.conf
+        logger.debug("%s CMD: %s", self.name, " ".join(self.cmd()))
+        self.proc = await asyncio.create_subprocess_exec(*self.cmd(), env=env, stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.STDOUT, limit=MAX_LINE)
+
+    async def watch(self):
+        "Follow output of started process till it exits"
+        while True:
+            line = await self.proc.stdout.readline()
+            if not line:
+                break
+            line = line.decode("utf8", "replace").rstrip()
+            self.update(line)
+            logger.debug("%s: %s", self.name, line)
+        await self.finish()
+        logger.info("%s: rebalance %s", self.name, self.state())
+
+    def update(self, line):
+        "Update progress from output line of rebalance.py"
+        match = log_line_re.match(line)
+        level, message = (match.group('level'), match.group('message')) if match else (None, line)
+        if not message:
+            return
+
+        self.last_message = message
+        if level in ('ERROR', 'CRITICAL') or message.startswith('Traceback'):
+            self.last_error = message
+
+        done = done_re.search(message)
+        if done:
+            self.done = int(done.group('done'))
+
+        eta = eta_re.search(message)
+        if eta:
+            self.eta = eta.group('eta')
+
+    async def finish(self):
+        self.retcode = await self.proc.wait()
+        if self.retcode == 0:
+            self.done = 100
+            self.eta = None
+
+    @property
+    def running(self):
+        return self.proc is not None and self.retcode is None
+
+    def state(self):
+        if self.proc is None:
+            return "not started"
+        if self.retcode is None:
+            return "running"
+        return "done" if self.retcode == 0 else "failed({0})".format(self.retcode)
+
+    def stop(self):
+        if self.running and self.proc.returncode is None:
+            try:
+                self.proc.terminate()
+            except ProcessLookupError:
+                pass
+
+
+def show_progress(runs, fd=None):
+    fd = sys.stdout if fd is None else fd
+    name_w = max([len("cluster")] + [len(run.name) for run in runs])
+    templ = "{0:<{w}} {1:>11} {2:>5} {3:>8}  {4}\n"
+    res = templ.format("cluster", "state", "done", "ETA", "last message", w=name_w)
+    for run in runs:
+        message = run.last_error if run.last_error is not None else run.last_message
+        res += templ.format(run.name, run.state(), "{0}%".format(run.done), run.eta or "-", message, w=name_w)
+    fd.write(res + "\n")
+    fd.flush()
+
+
+async def show_progress_every(runs, show_interval):
+    while True:
+        show_progress(runs)
+        await asyncio.sleep(show_interval)
+
+
+async def watch_fleet(runs, show_interval):
+    for run in runs:
+        try:
+            await run.start()
+        except OSError as exc:
+            logger.error("%s: failed to start rebalance: %s", run.name, exc)
+            run.last_error = str(exc)
+            run.retcode = -1
+
+    shower = asyncio.ensure_future(show_progress_every(runs, show_interval))
+    try:
+        await asyncio.gather(*[run.watch() for run in runs if run.running])
+    finally:
+        shower.cancel()
+
+
+def run_fleet(runs, show_interval=60.0):
+    """
+    Start all runs and wait for them to finish, showing progress table every show_interval seconds.
+    Returns list of failed runs
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(watch_fleet(runs, show_interval))
+    finally:
+        # runs are left only on error or interrupt, collect them, so no zombies are left
+        for run in runs:
+            run.stop()
+        stopped = [run.proc.wait() for run in runs if run.running]
+        if stopped:
+            loop.run_until_complete(asyncio.wait(stopped, timeout=STOP_TIMEOUT))
+        loop.close()
+
+    show_progress(runs)
+    return [run for run in runs if run.retcode != 0]
+
+
+def load_fleet(fleet_f):
+    with open(fleet_f) as fd:
+        fleet = yaml.safe_load(fd)
+
+    runs = []
+    for cluster in fleet['clusters']:
+        runs.append(ClusterRun(cluster['name'], cluster['conf'], cluster['config'],
+                               journal=cluster.get('journal'), args=cluster.get('args', ())))
+    return runs
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run rebalance.py on many clusters concurrently",
+                                     epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show output of all runs")
+    parser.add_argument("-i", "--show-interval", type=float, default=60.0,
+                        help="Interval between progress tables, seconds")
+    parser.add_argument("-a", "--args", default="",
+                        help="Extra rebalance.py options for all clusters, e.g. '-b -n'")
+    parser.add_argument("fleet", help="Yaml file with clusters list")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    opts = parse_args(argv)
+    setup_loggers([logger], default_level=logging.DEBUG if opts.verbose else logging.INFO)
+
+    runs = load_fleet(opts.fleet)
+    for run in runs:
+        run.args = opts.args.split() + run.args
+
+    failed = run_fleet(runs, show_interval=opts.show_interval)
+    for run in failed:
+        logger.error("%s: rebalance failed: %s", run.name, run.last_error)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv))
@@ -0,0 +1,222 @@
+"""
+Rebalance progress journal.
+
+Journal is a json-lines file, which starts with plan record (config hash, cluster fsid and
+osd map epoch, order of OSD changes with start and target weights and estimated data movement),
+followed by record for every finished round with its timestamps and recovered bytes. Recovered
+bytes are taken from cumulative num_bytes_recovered of pg stats sum at round start and end.
+Journal gives ETA during run and allows restarted run to continue previous plan without new
+estimation, if it runs against the same cluster and weights weren't changed outside of plan.
+"""
+
+from __future__ import print_function
+
+import json
+import time
+import hashlib
+import logging
+
+import rebalance_tracker
+
+
+logger = logging.getLogger("ceph.rebalance")
+
+
+def config_hash(config_f):
+    with open(config_f, "rb") as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+def node_key(node):
+    return [node.name, [list(item) for item in node.full_path]] if hasattr(node, 'full_path') else [node.name, None]
+
+
+class RecoveryMeter(object):
+    """
+    Bytes recovered during round, as change of cumulative num_bytes_recovered in pg stats sum
+    between round start and round end. Measured intervals don't overlap, so recovery of pipelined
+    rounds is credited to the round, during which it happened
+    """
+    def __init__(self, status):
+        self.status = status
+        self.round_start = None
+
+    def read(self):
+        "Current cumulative recovered bytes, None if not available"
+        try:
+            return rebalance_tracker.bytes_recovered(self.status.pg_stats_sum())
+        except Exception as exc:
+            logger.warning("Failed to get recovered bytes: %s", exc)
+            return None
+
+    def start_round(self):
+        self.round_start = self.read()
+
+    def finish_round(self):
+        "Bytes recovered since start_round, 0 if unknown"
+        start, end = self.round_start, self.read()
+        if start is None or end is None:
+            return 0
+        return max(0, end - start)
+
+
+class ProgressJournal(object):
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.plan = None
+        self.rounds = []
+        self.round_start = None
+        self.load()
+
+    def load(self):
+        "Read journal, lines which can't be decoded (e.g. truncated last record) are skipped"
+        try:
+            with open(self.path) as fd:
+                lines = fd.readlines()
+        except (IOError, OSError):
+            lines = []
+
+        records = []
+        for line_no, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skip broken record at %s:%s", self.path, line_no)
+                continue
+            if isinstance(record, dict) and record.get('type') in ('plan', 'round'):
+                records.append(record)
+            else:
+                logger.warning("Skip unknown record at %s:%s", self.path, line_no)
+
+        for record in records:
+            if record['type'] == 'plan':
+                self.plan = record
+                self.rounds = []
+            elif record['type'] == 'round':
+                self.rounds.append(record)
+
+    def append(self, record):
+        with open(self.path, "a") as fd:
+            fd.write(json.dumps(record) + "\n")
+
+    def can_resume(self, cfg_hash, config=None, fsid=None, epoch=None):
+        """
+        Journal plan can be continued, if it was made for the same config and cluster fsid,
+        osd map epoch didn't go back and every weight from config is still between its start
+        weight and target from plan, i.e. no one changed weights, except previous run
+        """
+        if self.plan is None or self.plan['config_hash'] != cfg_hash:
+            return False
+
+        if fsid is not None and self.plan.get('fsid') != fsid:
+            logger.warning("Journal %s is for cluster %s, not for %s. Start new plan",
+                           self.path, self.plan.get('fsid'), fsid)
+            return False
+
+        if epoch is not None and (self.plan.get('epoch') is None or epoch < self.plan['epoch']):
+            logger.warning("Journal %s plan started at osd map epoch %s, but current epoch is %s. Start new plan",
+                           self.path, self.plan.get('epoch'), epoch)
+            return False
+
+        if config is not None:
+            changed = self.changed_outside(config)
+            if changed:
+                logger.warning("Weights of %s were changed outside of journal %s plan. Start new plan",
+                               ", ".join(changed), self.path)
+                return False
+
+        return True
+
+    def changed_outside(self, config):
+        "Names of config nodes, which current weight is out of plan range [start weight, target weight]"
+        changed = []
+        for attr, plan_key, eps in (('rebalance_nodes', 'start_weights', config.min_weight_diff),
+                                    ('reweight_nodes', 'start_reweights', config.min_reweight_diff)):
+            planned = {json.dumps(key): (start, target) for key, start, target in self.plan.get(plan_key, [])}
+            for node, _ in getattr(config, attr):
+                start_target = planned.get(json.dumps(node_key(node)))
+                if start_target is None:
+                    changed.append(node.name)
+                    continue
+                low, high = sorted(start_target)
+                if not low - eps <= node.weight <= high + eps:
+                    changed.append(node.name)
+        return changed
+
+    def start_plan(self, cfg_hash, config, estimated_bytes=None, fsid=None, epoch=None):
+        self.plan = {'type': 'plan',
+                     'config_hash': cfg_hash,
+                     'fsid': fsid,
+                     'epoch': epoch,
+                     'time': self.clock(),
+                     'weight_order': [node_key(node) for node, _ in config.rebalance_nodes],
+                     'reweight_order': [node_key(node) for node, _ in config.reweight_nodes],
+                     'weight_pairs': sorted(config.weight_pairs.items()),
+                     'start_weights': [[node_key(node), node.weight, new_weight]
+                                       for node, new_weight in config.rebalance_nodes],
+                     'start_reweights': [[node_key(node), node.weight, new_weight]
+                                         for node, new_weight in config.reweight_nodes],
+                     'estimated_bytes': estimated_bytes}
+        self.rounds = []
+        with open(self.path, "w") as fd:
+            fd.write(json.dumps(self.plan) + "\n")
+
+    def restore_order(self, config):
+        "Reorder and pair config changes as they were in plan, changes, missing in plan, go last"
+        config.weight_pairs = dict(self.plan.get('weight_pairs', []))
+        for attr, order_key in (('rebalance_nodes', 'weight_order'), ('reweight_nodes', 'reweight_order')):
+            order = {json.dumps(key): idx for idx, key in enumerate(self.plan[order_key])}
+            nodes = getattr(config, attr)
+            nodes.sort(key=lambda item: order.get(json.dumps(node_key(item[0])), len(order)))
+
+    def start_round(self):
+        self.round_start = self.clock()
+
+    def finish_round(self, changes, recovered_bytes):
+        record = {'type': 'round',
+                  'round': len(self.rounds) + 1,
+                  'start': self.round_start,
+                  'end': self.clock(),
+                  'changes': [[node.name, old, new] for node, old, new in changes],
+                  'recovered_bytes': recovered_bytes}
+        self.rounds.append(record)
+        self.append(record)
+        return record
+
+    def recovered_bytes(self):
+        return sum(record['recovered_bytes'] for record in self.rounds)
+
+    def duration(self):
+        return sum(record['end'] - record['start'] for record in self.rounds)
+
+    def throughput(self):
+        "Average observed recovery bytes per second, None if unknown"
+        duration = self.duration()
+        recovered = self.recovered_bytes()
+        return recovered / duration if duration > 0 and recovered > 0 else None
+
+    def eta(self, remaining_rounds):
+        """
+        Seconds till rebalance completes, None if unknown.
+        Estimated by remaining data and observed throughput, if plan has estimation,
+        else by average round duration
+        """
+        if not self.rounds:
+            return None
+
+        throughput = self.throughput()
+        estimated = self.plan.get('estimated_bytes') if self.plan else None
+        if estimated and throughput and estimated > self.recovered_bytes():
+            return (estimated - self.recovered_bytes()) / throughput
+
+        return remaining_rounds * self.duration() / len(self.rounds)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{0}h {1:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    return "{0}m {1:02d}s".format(seconds // 60, seconds % 60)
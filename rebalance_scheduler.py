@@ -0,0 +1,206 @@
+"""
+Adaptive rebalance concurrency and rounds pipelining.
+
+While cluster recovers after round, recovery throughput, misplaced ratio and OSD
+latency are sampled. Before next round number of OSDs per round and weight step
+are halved if any target from config is exceeded, or grown slowly if all
+measured values are well below targets.
+
+Ceph doesn't report client op latency in pool or PG stats, only client io rates,
+so OSD commit/apply latency from 'ceph osd perf' is used instead. It is disk latency,
+which grows from recovery io as well, so max_latency_ms must be set above latency,
+which cluster shows under acceptable recovery load, or omitted to not throttle on it.
+
+Config section example:
+
+    adaptive:
+        max_latency_ms: 50       # max OSD commit/apply latency percentile, no limit by default
+        latency_percentile: 0.9  # percentile over all OSDs, which is compared to max_latency_ms
+        max_recovery_bw: 500M    # max recovery bytes per second
+        max_misplaced_ratio: 0.05
+        min_updated_nodes: 1
+        max_updated_nodes: 16
+        min_step: 0.02           # reweight step is scaled proportionally to weight step
+        max_step: 1.0
+
+With 'pipeline' section next round starts as soon as misplaced and degraded objects
+ratio falls below threshold, instead of waiting for all PGs to become clean. Gate
+stays closed until misplacement of just applied round is visible, i.e. misplaced data
+has grown or no PGs are peering, activating or unknown:
+
+    pipeline:
+        max_misplaced_ratio: 0.01   # start next round below this ratio
+        max_inflight: 200G          # hard cap on misplaced data, including next round
+"""
+
+from __future__ import print_function
+
+import time
+import logging
+
+from cephlib.units import ssize2b
+
+import rebalance_tracker
+
+
+logger = logging.getLogger("ceph.rebalance")
+
+
+SHRINK = 0.5
+GROW = 1.25
+# grow only if all values are below this part of their targets
+GROW_THRESHOLD = 0.7
+
+
+def percentile(values, part):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def to_bytes(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return ssize2b(value)
+
+
+def misplaced(pgmap):
+    "(misplaced and degraded objects ratio, raw bytes of these objects)"
+    ratio = pgmap.get('misplaced_ratio', 0.0) + pgmap.get('degraded_ratio', 0.0)
+    return ratio, int(ratio * pgmap.get('bytes_used', 0))
+
+
+SETTLING_STATES = ("peering", "activating", "unknown")
+
+
+def is_settling(cluster_status):
+    "True if some PGs are not yet active with current map, so misplaced counters are incomplete"
+    states = rebalance_tracker.pg_states(cluster_status) or {}
+    return any(count and any(part in SETTLING_STATES for part in state.split('+'))
+               for state, count in states.items())
+
+
+class RecoverySample(object):
+    def __init__(self, recovery_bw, misplaced_ratio, latency_ms):
+        self.recovery_bw = recovery_bw
+        self.misplaced_ratio = misplaced_ratio
+        self.latency_ms = latency_ms
+
+
+def take_sample(status, latency_percentile=0.9):
+    "Recovery sample, latency is OSD commit/apply latency, as a proxy of client latency"
+    pgmap = status.cluster_status().get('pgmap', {})
+    misplaced_ratio, _ = misplaced(pgmap)
+    latencies = list(rebalance_tracker.osd_latencies(status.osd_perf()).values())
+    return RecoverySample(pgmap.get('recovering_bytes_per_sec', 0), misplaced_ratio,
+                          percentile(latencies, latency_percentile))
+
+
+class PipelineGate(object):
+    """
+    Decides when next round can start, while previous one still recovers.
+    Misplaced data of next round is expected to be the same as the one, which previous round has added
+    """
+    def __init__(self, pipeline_cfg):
+        self.max_ratio = pipeline_cfg.get('max_misplaced_ratio', 0.01)
+        self.max_inflight = to_bytes(pipeline_cfg.get('max_inflight'))
+        self.round_bytes = 0
+        self.round_start_bytes = None
+        self.round_peak_bytes = 0
+        self.round_visible = False
+
+    def start_round(self, status):
+        if self.round_start_bytes is not None:
+            self.round_bytes = max(0, self.round_peak_bytes - self.round_start_bytes)
+        _, self.round_start_bytes = misplaced(status.cluster_status().get('pgmap', {}))
+        self.round_peak_bytes = self.round_start_bytes
+        self.round_visible = False
+
+    def ready(self, status):
+        "Tracker ready hook"
+        cluster_status = status.cluster_status()
+        ratio, inflight = misplaced(cluster_status.get('pgmap', {}))
+        self.round_peak_bytes = max(self.round_peak_bytes, inflight)
+        if not self.round_visible:
+            # while PGs of new map peer, misplaced counters don't include this round yet
+            if inflight <= self.round_start_bytes and is_settling(cluster_status):
+                return False
+            self.round_visible = True
+        if ratio >= self.max_ratio:
+            return False
+        if self.max_inflight is not None and inflight + self.round_bytes > self.max_inflight:
+            return False
+        logger.debug("Misplaced ratio %.2f%%, %sB in flight, start next round", ratio * 100, inflight)
+        return True
+
+
+class AdaptiveScheduler(object):
+    def __init__(self, adaptive_cfg, config, sample_interval=10.0, clock=time.time):
+        self.max_latency_ms = adaptive_cfg.get('max_latency_ms')
+        self.latency_percentile = adaptive_cfg.get('latency_percentile', 0.9)
+        self.max_recovery_bw = to_bytes(adaptive_cfg.get('max_recovery_bw'))
+        self.max_misplaced_ratio = adaptive_cfg.get('max_misplaced_ratio')
+
+        self.min_nodes = adaptive_cfg.get('min_updated_nodes', 1)
+        self.max_nodes = adaptive_cfg.get('max_updated_nodes', max(config.max_nodes_per_round, 16))
+        self.min_step = adaptive_cfg.get('min_step', config.max_weight_change / 8)
+        self.max_step = adaptive_cfg.get('max_step', config.max_weight_change * 2)
+
+        self.base_step = config.max_weight_change
+        self.base_restep = config.max_reweight_change
+        self.sample_interval = sample_interval
+        self.clock = clock
+        self.last_sample = None
+        self.samples = []
+
+    def sample(self, status):
+        "Tracker on_check hook, samples not more often than sample_interval"
+        now = self.clock()
+        if self.last_sample is not None and now - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = now
+        try:
+            self.samples.append(take_sample(status, self.latency_percentile))
+        except Exception as exc:
+            logger.warning("Failed to sample recovery stats: %s", exc)
+
+    def load(self):
+        """
+        Max ratio of measured value to its target for collected samples, None if no samples.
+        Values without target are ignored
+        """
+        if not self.samples:
+            return None
+
+        ratios = [0.0]
+        for target, attr in ((self.max_latency_ms, 'latency_ms'),
+                             (self.max_recovery_bw, 'recovery_bw'),
+                             (self.max_misplaced_ratio, 'misplaced_ratio')):
+            if target:
+                ratios.append(max(getattr(sample, attr) for sample in self.samples) / float(target))
+        return max(ratios)
+
+    def adjust(self, config):
+        "Update config round size and steps for next round, using samples from previous round"
+        load = self.load()
+        self.samples = []
+        if load is None:
+            return
+
+        nodes = config.max_nodes_per_round
+        step = config.max_weight_change
+        if load > 1.0:
+            nodes = max(self.min_nodes, int(nodes * SHRINK))
+            step = max(self.min_step, step * SHRINK)
+        elif load < GROW_THRESHOLD:
+            nodes = min(self.max_nodes, nodes + 1)
+            step = min(self.max_step, step * GROW)
+
+        if nodes != config.max_nodes_per_round or step != config.max_weight_change:
+            logger.info("Load %.0f%% of target: OSDs per round %s => %s, step %.3f => %.3f",
+                        load * 100, config.max_nodes_per_round, nodes, config.max_weight_change, step)
+
+        config.max_nodes_per_round = nodes
+        config.max_weight_change = step
+        config.max_reweight_change = self.base_restep * step / self.base_step
@@ -0,0 +1,306 @@
+"""
+Rebalance completion tracking over one long-lived status channel.
+
+Cluster events come from streamed 'ceph -w' output, which is read by a background
+thread, so tracker wakes up as soon as cluster reports any change, instead of
+sleeping for ever growing interval. PG states are taken from pgmap lines of the
+stream, when ceph prints them, or requested from monitor through librados
+connection, which is opened once. Only if python rados module is not available
+'ceph pg stat' is executed, and only on events or after capped backoff.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from cephlib.common import run_locally
+
+
+logger = logging.getLogger("ceph.rebalance")
+
+
+ALLOWED_STATES = ("active+clean", "active+remapped")
+
+
+def pg_states(pg_stat):
+    "{state: pg count} from 'ceph pg stat' or 'ceph -s' json, None if there are no states in it"
+    if 'num_pg_by_state' in pg_stat:
+        return {dct['name']: dct['num'] for dct in pg_stat['num_pg_by_state']}
+
+    pgmap = pg_stat.get('pgmap', pg_stat.get('pg_summary', pg_stat))
+    if 'pgs_by_state' in pgmap:
+        return {dct['state_name']: dct['count'] for dct in pgmap['pgs_by_state']}
+
+    return None
+
+
+pgmap_line_re = re.compile(r"\d+\s+pgs:\s*(?P<states>[^;]*)")
+state_re = re.compile(r"(?P<count>\d+)\s+(?P<state>[a-z_+]+)")
+
+
+def parse_pgmap_line(line):
+    "{state: pg count} from 'ceph -w' pgmap line, like '... 512 pgs: 500 active+clean, 12 peering; ...', or None"
+    match = pgmap_line_re.search(line)
+    if not match:
+        return None
+    states = {state.group('state'): int(state.group('count')) for state in state_re.finditer(match.group('states'))}
+    return states or None
+
+
+def is_complete(states, allowed_states=ALLOWED_STATES):
+    return all(count == 0 or state in allowed_states for state, count in states.items())
+
+
+class CephWatchChannel(object):
+    "Lines of 'ceph -w' output, read by background thread"
+    def __init__(self, cmd=("ceph", "-w")):
+        logger.debug("CMD: %s", " ".join(cmd))
+        self.proc = subprocess.Popen(list(cmd), stdout=subprocess.PIPE, universal_newlines=True)
+        self.events = queue.Queue()
+        self.reader = threading.Thread(target=self.read_events)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_events(self):
+        for line in iter(self.proc.stdout.readline, ""):
+            self.events.put(line.strip())
+
+    def get(self, timeout):
+        "Next event line or None, if no event during timeout seconds"
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+
+class LocalChannel(object):
+    "In-process stand-in for CephWatchChannel, events are pushed by caller"
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def push(self, line):
+        self.events.put(line)
+
+    def get(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+def osd_latencies(osd_perf):
+    "{osd_id: max of commit and apply latency in ms} from 'ceph osd perf' json"
+    infos = osd_perf.get('osdstats', osd_perf).get('osd_perf_infos', [])
+    return {info['id']: max(info['perf_stats'].get('commit_latency_ms', 0),
+                            info['perf_stats'].get('apply_latency_ms', 0))
+            for info in infos}
+
+
+def bytes_recovered(pg_dump_summary):
+    "Cumulative num_bytes_recovered of all PGs from 'ceph pg dump summary' json"
+    pg_map = pg_dump_summary.get('pg_map', pg_dump_summary)
+    return pg_map['pg_stats_sum']['stat_sum']['num_bytes_recovered']
+
+
+class CLIStatus(object):
+    "PG states from ceph cli, one process per request"
+    def pg_stat(self):
+        pg_stat = json.loads(run_locally("ceph pg stat --format=json").decode('utf8'))
+        if pg_states(pg_stat) is None:
+            pg_stat = self.cluster_status()
+        return pg_stat
+
+    def cluster_status(self):
+        return json.loads(run_locally("ceph -s --format=json").decode('utf8'))
+
+    def osd_perf(self):
+        return json.loads(run_locally("ceph osd perf --format=json").decode('utf8'))
+
+    def pg_stats_sum(self):
+        return json.loads(run_locally("ceph pg dump summary --format=json").decode('utf8'))
+
+    def close(self):
+        pass
+
+
+class RadosStatus(object):
+    "PG states from monitor over single librados connection"
+    def __init__(self, conffile=None):
+        import rados
+        # same config as ceph cli uses
+        self.cluster = rados.Rados(conffile=conffile or os.environ.get("CEPH_CONF", "/etc/ceph/ceph.conf"))
+        self.cluster.connect()
+
+    def mon_command(self, prefix, mgr=False, **args):
+        cmd = json.dumps(dict(args, prefix=prefix, format="json"))
+        if mgr:
+            retcode, out, err = self.cluster.mgr_command(cmd, b'')
+        else:
+            retcode, out, err = self.cluster.mon_command(cmd, b'')
+        if retcode != 0:
+            raise RuntimeError("command {0!r} failed: {1}".format(prefix, err))
+        return json.loads(out.decode('utf8'))
+
+    def pg_stat(self):
+        # 'status' is served by monitor itself in all versions, unlike 'pg stat'
+        return self.mon_command("status")
+
+    def cluster_status(self):
+        return self.mon_command("status")
+
+    def osd_perf(self):
+        # served by mgr since luminous, by monitor before
+        if hasattr(self.cluster, "mgr_command"):
+            try:
+                return self.mon_command("osd perf", mgr=True)
+            except RuntimeError:
+                pass
+        return self.mon_command("osd perf")
+
+    def pg_stats_sum(self):
+        # served by mgr since luminous, by monitor before
+        if hasattr(self.cluster, "mgr_command"):
+            try:
+                return self.mon_command("pg dump", mgr=True, dumpcontents=["summary"])
+            except RuntimeError:
+                pass
+        return self.mon_command("pg dump", dumpcontents=["summary"])
+
+    def close(self):
+        self.cluster.shutdown()
+
+
+def open_status():
+    try:
+        return RadosStatus()
+    except Exception as exc:
+        logger.debug("Can't use librados for cluster status (%s), fall back to ceph cli", exc)
+        return CLIStatus()
+
+
+class RebalanceTracker(object):
+    """
+    Waits for all PGs to get into allowed states.
+    channel - source of cluster events with get(timeout) method,
+    status - source of authoritative PG states with pg_stat() method.
+    Status is requested on any non-pgmap event, but not more often than once in min_interval,
+    or if there are no events for backoff interval, which grows up to max_interval.
+    on_check(status) is called after every status request, e.g. to collect recovery stats
+    """
+    def __init__(self, channel, status, allowed_states=ALLOWED_STATES, min_interval=1.0, max_interval=30.0,
+                 settle_time=2.0, clock=time.time, on_check=None):
+        self.channel = channel
+        self.on_check = on_check
+        self.status = status
+        self.allowed_states = allowed_states
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.settle_time = settle_time
+        self.clock = clock
+        self.last_check = None
+        self.last_states = None
+        self.ready = None
+
+    def check(self):
+        self.last_check = self.clock()
+        states = pg_states(self.status.pg_stat())
+        if states is None:
+            raise ValueError("No PG states in cluster status")
+        self.last_states = states
+        if self.on_check is not None:
+            self.on_check(self.status)
+        if is_complete(states, self.allowed_states):
+            return True
+        return self.ready is not None and self.ready(self.status)
+
+    def drain(self, timeout):
+        """
+        Collect events for up to timeout seconds, returns after first event and all queued after it.
+        Returns (got_events, last pgmap states or None, need_check)
+        """
+        event = self.channel.get(timeout)
+        if event is None:
+            return False, None, False
+
+        states = None
+        need_check = False
+        while event is not None:
+            line_states = parse_pgmap_line(event)
+            if line_states is not None:
+                states = line_states
+            elif event:
+                need_check = True
+            event = self.channel.get(0)
+        return True, states, need_check
+
+    def wait_complete(self, any_updates, ready=None):
+        """
+        Wait till all PGs are in allowed states.
+        ready(status) - optional extra condition, which allows to stop waiting earlier
+        """
+        self.ready = ready
+        try:
+            self.wait(any_updates)
+        finally:
+            self.ready = None
+
+    def wait(self, any_updates):
+        if not any_updates and self.check():
+            return
+
+        logger.debug("Waiting for cluster to complete rebalance")
+
+        if any_updates:
+            # let PGs start peering with new map, events during this time are stale
+            deadline = self.clock() + self.settle_time
+            while self.clock() < deadline:
+                self.drain(max(0.0, deadline - self.clock()))
+            if self.check():
+                return
+
+        interval = self.min_interval
+        while True:
+            got_events, states, need_check = self.drain(interval)
+            if got_events:
+                interval = self.min_interval
+                if states is not None:
+                    self.last_states = states
+                    # confirm with status request, it also lets on_check see final state
+                    if is_complete(states, self.allowed_states) and self.check():
+                        return
+                # pgmap lines has no misplaced ratio, so extra ready condition needs status request
+                need_check = need_check or self.ready is not None
+                if need_check and self.clock() - self.last_check >= self.min_interval and self.check():
+                    return
+            else:
+                if self.check():
+                    return
+                interval = min(interval * 1.5, self.max_interval)
+                logger.debug("Waiting for cluster to complete rebalance")
+
+    def close(self):
+        self.channel.close()
+        self.status.close()
+
+
+def open_tracker(**params):
+    return RebalanceTracker(CephWatchChannel(), open_status(), **params)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# tools are plain scripts in repository root, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
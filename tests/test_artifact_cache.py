@@ -0,0 +1,71 @@
+"""
+Artifact cache: private cache dir, LRU eviction, which keeps entries in use.
+"""
+
+import os
+import stat
+
+import pytest
+
+import artifact_cache
+
+
+def write(data):
+    def producer(path):
+        with open(path, "w") as fd:
+            fd.write(data)
+    return producer
+
+
+def test_cache_dir_is_private(tmp_path):
+    cache = artifact_cache.ArtifactCache(str(tmp_path / "cache"))
+    path = cache.put("key", "name", write("data"))
+    assert stat.S_IMODE(os.lstat(cache.root).st_mode) == 0o700
+    assert cache.get("key", "name") == path
+
+
+def test_symlinked_cache_dir_is_refused(tmp_path):
+    (tmp_path / "other").mkdir()
+    os.symlink(str(tmp_path / "other"), str(tmp_path / "cache"))
+    cache = artifact_cache.ArtifactCache(str(tmp_path / "cache"))
+    with pytest.raises(artifact_cache.UnsafeCacheDir):
+        cache.get("key", "name")
+
+
+def test_evict_lru_and_skip_used_entries(tmp_path):
+    root = str(tmp_path / "cache")
+    reader = artifact_cache.ArtifactCache(root)
+    writer = artifact_cache.ArtifactCache(root, max_size=10)
+    used = writer.put("used", "name", write("x" * 4))
+    writer.put("old", "name", write("x" * 4))
+    writer.release()
+
+    # reader holds 'used', which is older, than 'old'
+    assert reader.get("used", "name") == used
+    os.utime(os.path.join(root, "used"), (0, 0))
+    writer.put("new", "name", write("x" * 4))
+    assert sorted(name for name in os.listdir(root) if not name.startswith(".")) == ["new", "used"]
+    assert open(used).read() == "xxxx"
+
+    reader.release()
+    writer.put("newer", "name", write("x" * 4))
+    assert reader.get("used", "name") is None
+
+
+def test_entry_is_released_after_use(tmp_path):
+    root = str(tmp_path / "cache")
+    reader = artifact_cache.ArtifactCache(root)
+    writer = artifact_cache.ArtifactCache(root, max_size=10)
+    with reader.entry("used", "name", write("x" * 4)) as used:
+        # nested use of the same entry keeps it locked till outer use ends
+        with reader.entry("used", "name") as path:
+            assert path == used
+        os.utime(os.path.join(root, "used"), (0, 0))
+        writer.put("new", "name", write("x" * 8))
+        assert open(used).read() == "xxxx"
+
+    assert reader.locks == {}
+    writer.put("newer", "name", write("x" * 8))
+    assert not os.path.exists(used)
+    with reader.entry("used", "name") as path:
+        assert path is None
@@ -0,0 +1,311 @@
+"""
+Vectorized remap diff and parallel mapping against straightforward implementations.
+"""
+
+import io
+import os
+import sys
+import json
+import collections
+
+import numpy
+import pytest
+
+import artifact_cache
+import crush_mapper
+import calculate_remap
+from calculate_remap import Pool
+from crush_mapper import NO_OSD
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def set_calc_diff(p_old, p_new):
+    "Per PG set difference, as calc_diff was before vectorization"
+    moved_to = collections.defaultdict(list)
+    moved_from = collections.defaultdict(list)
+    for pg_id in range(p_old.pg_count):
+        v1 = p_old.pg_osds(pg_id)
+        v2 = p_new.pg_osds(pg_id)
+        if v1 != v2:
+            for osd_id in v1 - v2:
+                moved_from[osd_id].append(pg_id)
+            for osd_id in v2 - v1:
+                moved_to[osd_id].append(pg_id)
+    return dict(moved_from.items()), dict(moved_to.items())
+
+
+def set_osd_diff(pool_pairs, pg_sizes):
+    "{osd_id: (pg_in, pg_out, bytes_in, bytes_out)}, sizes are summed per PG"
+    res = collections.defaultdict(lambda: [0, 0, 0, 0])
+    for pool_id, (old_pool, new_pool) in pool_pairs.items():
+        frm, to = set_calc_diff(old_pool, new_pool)
+        for osd_id, out_pgs in frm.items():
+            res[osd_id][1] += len(out_pgs)
+            res[osd_id][3] += sum(int(pg_sizes[pool_id][pg_id]) for pg_id in out_pgs)
+        for osd_id, in_pgs in to.items():
+            res[osd_id][0] += len(in_pgs)
+            res[osd_id][2] += sum(int(pg_sizes[pool_id][pg_id]) for pg_id in in_pgs)
+    return {osd_id: tuple(val) for osd_id, val in res.items()}
+
+
+def random_pool(rng, pid, pg_count, size, width, max_osd=50):
+    "Pool with size OSDs per PG, without repeats, in rows of width, NO_OSD in the rest"
+    mapping = numpy.full((pg_count, width), NO_OSD, dtype=numpy.int32)
+    for pg_num in range(pg_count):
+        mapping[pg_num, :size] = rng.choice(max_osd, size, replace=False)
+    return Pool(None, pid, pg_count, mapping)
+
+
+def make_pairs():
+    rng = numpy.random.RandomState(3)
+    pairs = {}
+    sizes = {}
+    for pid, (pg_count, old_size, new_size, old_width, new_width) in enumerate([(256, 3, 3, 3, 3),
+                                                                                 (128, 6, 6, 6, 6),
+                                                                                 (64, 2, 3, 2, 3),
+                                                                                 (64, 3, 2, 4, 3)], 1):
+        old = random_pool(rng, pid, pg_count, old_size, old_width)
+        new = random_pool(rng, pid, pg_count, new_size, new_width)
+        # most PGs keep their OSDs, some in other order
+        keep = rng.rand(pg_count) < 0.7
+        common = min(old_size, new_size)
+        new.mapping[keep, :common] = old.mapping[keep, :common][:, ::-1]
+        pairs[pid] = (old, new)
+        sizes[pid] = rng.randint(0, 1 << 34, size=pg_count).astype(numpy.int64)
+    return pairs, sizes
+
+
+def test_calc_diff_matches_set_diff():
+    pairs, _ = make_pairs()
+    for old, new in pairs.values():
+        moved_from, moved_to = calculate_remap.calc_diff(old, new)
+        exp_from, exp_to = set_calc_diff(old, new)
+        assert {osd_id: sorted(pgs) for osd_id, pgs in moved_from.items()} == exp_from
+        assert {osd_id: sorted(pgs) for osd_id, pgs in moved_to.items()} == exp_to
+
+
+def test_osd_diff_matches_set_diff():
+    pairs, sizes = make_pairs()
+    changes = calculate_remap.get_osd_diff(pairs, sizes)
+    assert {osd_id: (ch.pg_in, ch.pg_out, ch.bytes_in, ch.bytes_out)
+            for osd_id, ch in changes.items()} == set_osd_diff(pairs, sizes)
+
+
+def test_parallel_map_pgs_matches_serial(tmp_path, monkeypatch):
+    with open(os.path.join(DATA_DIR, "osdmap.json")) as fd:
+        data = json.load(fd)
+
+    def load_osdmap_file(osd_map_f):
+        return crush_mapper.load_crush(data['crush']), crush_mapper.load_osdmap(data['osd_dump'])
+
+    monkeypatch.setattr(crush_mapper, "load_osdmap_file", load_osdmap_file)
+    # empty cache and distinct map files, so both mappings are calculated
+    monkeypatch.setattr(artifact_cache, "_default_cache", None)
+    monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    map_files = []
+    for idx in range(2):
+        map_files.append(str(tmp_path / "osdmap{0}.bin".format(idx)))
+        with open(map_files[-1], "w") as fd:
+            fd.write(str(idx))
+
+    crush, osdmap = load_osdmap_file(None)
+    expected = {pool_info.pid: crush_mapper.map_pool(crush, osdmap, pool_info) for pool_info in osdmap.pools}
+    serial, _ = calculate_remap.map_pgs(map_files[:1], jobs=1)
+    parallel, bg_result = calculate_remap.map_pgs(map_files[1:], jobs=2, background=lambda: "done")
+    assert bg_result == "done"
+    for pools in serial + parallel:
+        assert sorted(pools) == sorted(expected)
+        for pid, mapping in expected.items():
+            assert pools[pid].mapping.tolist() == mapping.tolist()
+
+
+def set_parse(map_data):
+    "{pool_id: {pg_num: (acting, primary)}}, parsed from whole text, as parse was before int32 pools"
+    pools = {}
+    curr_pool = None
+    for line in map_data.split("\n"):
+        if curr_pool is not None:
+            mline = calculate_remap.pg_map_line.match(line)
+            if mline is not None:
+                osd_ids = [int(x) for x in mline.group('osd_ids').split(",") if x]
+                acting = [NO_OSD if osd_id == crush_mapper.CRUSH_ITEM_NONE else osd_id for osd_id in osd_ids]
+                curr_pool[int(mline.group('pg_id'), 16)] = (acting, int(mline.group('primary')))
+                continue
+            curr_pool = None
+        pline = calculate_remap.pool_start_line.match(line)
+        if pline:
+            curr_pool = pools[int(pline.group('pid'))] = {}
+    return pools
+
+
+# EC pool with hole and PG without OSDs, followed by osdmaptool summary
+EXTRA_DUMP = "pool 9 pg_num 3\n9.0\t[1,2147483647,3]\t1\n9.1\t[]\t-1\n9.2\t[4,5,6]\t4\n#osd\tcount\n"
+
+
+def test_stream_parse_matches_text_parse():
+    with open(os.path.join(DATA_DIR, "osdmap.pgs_dump.txt")) as fd:
+        text = fd.read() + EXTRA_DUMP
+    expected = set_parse(text)
+
+    pools = {pool.pid: pool for pool in calculate_remap.parse(io.StringIO(text))}
+    assert sorted(pools) == sorted(expected)
+    for pid, exp_pool in expected.items():
+        pool = pools[pid]
+        assert pool.pg_count == len(exp_pool)
+        for pg_num, (acting, primary) in exp_pool.items():
+            row = pool.mapping[pg_num].tolist()
+            assert row == acting + [NO_OSD] * (len(row) - len(acting))
+            assert pool.pg_osds(pg_num) == set(acting) - {NO_OSD}
+            assert pool.primary[pg_num] == primary
+
+
+# prints recorded data/osdmap.pgs_dump.txt (or its part for --pool) and osd map json for '--dump json'
+FAKE_OSDMAPTOOL = """#!{python}
+import sys
+import json
+
+args = sys.argv[1:]
+if "--dump" in args:
+    print(json.dumps(json.load(open({osdmap_js!r}))['osd_dump']))
+    sys.exit(0)
+
+pool = args[args.index("--pool") + 1] if "--pool" in args else None
+curr_pool = None
+for line in open({dump!r}):
+    if line.startswith("pool "):
+        curr_pool = line.split()[1]
+    elif line.startswith("#"):
+        curr_pool = None
+    if pool is None or curr_pool == pool:
+        sys.stdout.write(line)
+"""
+
+
+def test_parallel_osdmaptool_per_pool_matches_serial(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    tool = bin_dir / "osdmaptool"
+    dump_f = os.path.join(DATA_DIR, "osdmap.pgs_dump.txt")
+    tool.write_text(FAKE_OSDMAPTOOL.format(python=sys.executable, osdmap_js=os.path.join(DATA_DIR, "osdmap.json"),
+                                           dump=dump_f))
+    tool.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(artifact_cache, "_default_cache", None)
+    monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    map_files = []
+    for idx in range(2):
+        map_files.append(str(tmp_path / "osdmap{0}.bin".format(idx)))
+        with open(map_files[-1], "w") as fd:
+            fd.write(str(idx))
+
+    with open(dump_f) as fd:
+        expected = {pool.pid: pool for pool in calculate_remap.parse(fd)}
+    serial, _ = calculate_remap.map_pgs(map_files[:1], use_osdmaptool=True, jobs=1)
+    parallel, _ = calculate_remap.map_pgs(map_files[1:], use_osdmaptool=True, per_pool=True, jobs=3)
+    for pools in serial + parallel:
+        assert sorted(pools) == sorted(expected)
+        for pid, pool in expected.items():
+            assert pools[pid].mapping.tolist() == pool.mapping.tolist()
+
+
+def test_cached_mapping_is_keyed_by_mapping_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_cache, "_default_cache", None)
+    monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    map_f = str(tmp_path / "osdmap.bin")
+    with open(map_f, "w") as fd:
+        fd.write("map")
+
+    mapping = numpy.array([[1, 2], [2, 3]], dtype=numpy.int32)
+    calculate_remap.store_mapping(calculate_remap.mapping_key(map_f), "engine",
+                                  {1: Pool("rbd", 1, 2, mapping)})
+    cached = calculate_remap.load_cached_mapping(calculate_remap.mapping_key(map_f))
+    assert cached[1].mapping.tolist() == mapping.tolist()
+
+    # mapping from older engine must not be served
+    monkeypatch.setattr(calculate_remap, "MAPPING_VERSION", calculate_remap.MAPPING_VERSION + 1)
+    assert calculate_remap.load_cached_mapping(calculate_remap.mapping_key(map_f)) is None
+
+
+def test_reweights_are_never_dropped(tmp_path, monkeypatch):
+    def load_osdmap_file(osd_map_f):
+        raise crush_mapper.UnsupportedMap("crush choose_args (weight sets)")
+
+    def osdmaptool_map_pgs(osd_map_f, pool_id=None):
+        return {1: Pool("rbd", 1, 2, numpy.array([[1, 2], [2, 3]], dtype=numpy.int32))}
+
+    monkeypatch.setattr(crush_mapper, "load_osdmap_file", load_osdmap_file)
+    monkeypatch.setattr(calculate_remap, "osdmaptool_map_pgs", osdmaptool_map_pgs)
+    monkeypatch.setattr(artifact_cache, "_default_cache", None)
+    monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    map_f = str(tmp_path / "osdmap.bin")
+    with open(map_f, "w") as fd:
+        fd.write("map")
+
+    # osdmaptool can't apply reweights, its mapping must be neither returned nor cached under reweights key
+    reweights = {2: 0.5}
+    with pytest.raises(crush_mapper.UnsupportedMap):
+        calculate_remap.map_pgs([map_f], jobs=1, reweights=[reweights])
+    assert calculate_remap.load_cached_mapping(calculate_remap.mapping_key(map_f, reweights)) is None
+
+    # without reweights osdmaptool is a valid fallback
+    (pools,), _ = calculate_remap.map_pgs([map_f], jobs=1)
+    assert pools[1].mapping.tolist() == [[1, 2], [2, 3]]
+    assert calculate_remap.load_cached_mapping(calculate_remap.mapping_key(map_f)) is not None
+
+
+def test_evaluate_candidates_ranks_by_moved_data(tmp_path, monkeypatch):
+    with open(os.path.join(DATA_DIR, "osdmap.json")) as fd:
+        data = json.load(fd)
+
+    # candidate "map" file holds reweights, which candidate crush would give
+    def import_crush(osd_map_f, crush_f):
+        return crush_f
+
+    def load_osdmap_file(osd_map_f):
+        crush, osdmap = crush_mapper.load_crush(data['crush']), crush_mapper.load_osdmap(data['osd_dump'])
+        with open(osd_map_f) as fd:
+            reweights = json.load(fd)
+        crush_mapper.apply_reweights(osdmap, {int(osd_id): reweight for osd_id, reweight in reweights.items()})
+        return crush, osdmap
+
+    monkeypatch.setattr(calculate_remap, "import_crush", import_crush)
+    monkeypatch.setattr(crush_mapper, "load_osdmap_file", load_osdmap_file)
+    monkeypatch.setattr(artifact_cache, "_default_cache", None)
+    monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+
+    pg_sizes = {pool['pool']: numpy.full(pool['pg_num'], 100, dtype=numpy.int64) for pool in data['osd_dump']['pools']}
+    monkeypatch.setattr(calculate_remap, "get_pg_sizes", lambda pg_dump_f: pg_sizes)
+
+    candidates = {"base": {}, "one_out": {"3": 0.0}, "two_out": {"3": 0.0, "10": 0.0}, "half": {"3": 0.5}}
+    files = {}
+    for name, reweights in candidates.items():
+        files[name] = str(tmp_path / name)
+        with open(files[name], "w") as fd:
+            json.dump(reweights, fd)
+
+    ranked = calculate_remap.evaluate_candidates(files["base"], [files[name] for name in sorted(candidates)],
+                                                 jobs=1)
+    by_name = {os.path.basename(stats.name): stats for stats in ranked}
+    assert [os.path.basename(stats.name) for stats in ranked] == ["base", "half", "one_out", "two_out"]
+    assert by_name["base"].bytes_moved == 0 and by_name["base"].worst_osd is None
+    assert by_name["one_out"].bytes_moved == by_name["one_out"].pg_moved * 100 > 0
+
+    # every candidate is the same as direct remap of its map
+    maps, _ = calculate_remap.map_pgs([files["base"], files["two_out"]], jobs=1)
+    direct = calculate_remap.RemapStats("two_out", calculate_remap.remap_diff(maps[0], maps[1], pg_sizes))
+    assert (by_name["two_out"].bytes_moved, by_name["two_out"].pg_moved, by_name["two_out"].worst_inflow) == \
+        (direct.bytes_moved, direct.pg_moved, direct.worst_inflow)
+
+
+def test_remap_stats_worst_receiver():
+    changes = {}
+    for osd_id, bytes_in, pg_in in ((1, 300, 3), (2, 500, 2), (3, 500, 5)):
+        changes[osd_id] = calculate_remap.OSDChanges()
+        changes[osd_id].bytes_in = bytes_in
+        changes[osd_id].pg_in = pg_in
+    stats = calculate_remap.RemapStats("crush", changes)
+    assert (stats.bytes_moved, stats.pg_moved) == (1300, 10)
+    # ties go to lower osd id
+    assert (stats.worst_osd, stats.worst_inflow) == (2, 500)
@@ -0,0 +1,95 @@
+"""
+Cluster snapshot: lazy loading, epoch based refresh, offline mode.
+"""
+
+import json
+
+import pytest
+
+import artifact_cache
+import cluster_snapshot
+
+
+class FakeCluster(object):
+    "Live cluster, which osd map file content is its epoch"
+    def __init__(self, monkeypatch, epoch=10):
+        self.epoch = epoch
+        self.weights = {0: 1.0, 1: 1.0}
+        self.commands = []
+        self.dumps = 0
+        monkeypatch.setattr(cluster_snapshot, "run_locally", self.run_locally)
+        monkeypatch.setattr(cluster_snapshot, "current_epoch", lambda: self.epoch)
+        monkeypatch.setattr(artifact_cache, "dump_osdmap", self.dump_osdmap)
+
+    def run_locally(self, cmd):
+        self.commands.append(cmd.split(" -")[0])
+        if cmd.startswith("ceph osd getmap -o "):
+            with open(cmd.split()[-1], "w") as fd:
+                fd.write(str(self.epoch))
+            return b""
+        assert cmd.startswith("ceph osd tree")
+        return json.dumps({'nodes': [{'id': -1, 'name': "h0", 'type': "host", 'children': [0, 1]},
+                                     {'id': 0, 'name': "osd.0", 'type': "osd"},
+                                     {'id': 1, 'name': "osd.1", 'type': "osd"}]}).encode("utf8")
+
+    def dump_osdmap(self, osd_map_f):
+        self.dumps += 1
+        with open(osd_map_f) as fd:
+            epoch = int(fd.read())
+        return json.dumps({'epoch': epoch,
+                           'osds': [{'osd': osd_id, 'up': 1, 'in': 1, 'weight': weight,
+                                     'public_addr': "10.0.0.1:6800/1", 'cluster_addr': "10.0.1.1:6800/1"}
+                                    for osd_id, weight in sorted(self.weights.items())]})
+
+
+def test_artifacts_are_loaded_once(monkeypatch):
+    fake = FakeCluster(monkeypatch)
+    snapshot = cluster_snapshot.ClusterSnapshot()
+    assert snapshot.epoch == 10
+    assert snapshot.osd_dump['epoch'] == 10
+    assert snapshot.reweights == {"osd.0": 1.0, "osd.1": 1.0}
+    assert fake.commands == ["ceph osd getmap", "ceph osd tree"]
+    assert fake.dumps == 1
+
+
+def test_refresh_on_epoch_change(monkeypatch):
+    fake = FakeCluster(monkeypatch)
+    snapshot = cluster_snapshot.ClusterSnapshot()
+    # nothing loaded, nothing to refresh
+    assert not snapshot.refresh()
+    topology = snapshot.topology
+    assert not snapshot.refresh()
+
+    fake.epoch = 11
+    fake.weights[1] = 0.5
+    assert snapshot.refresh()
+    assert snapshot.epoch == 11
+    assert snapshot.reweights == {"osd.0": 1.0, "osd.1": 0.5}
+    # topology is updated in place
+    assert snapshot.topology is topology
+    assert topology.osd(0).host == "h0"
+    assert fake.commands.count("ceph osd getmap") == 2
+
+
+def test_files_are_never_refreshed(monkeypatch, tmp_path):
+    fake = FakeCluster(monkeypatch)
+    osd_map_f = str(tmp_path / "osdmap.bin")
+    with open(osd_map_f, "w") as fd:
+        fd.write("5")
+    snapshot = cluster_snapshot.ClusterSnapshot(osd_map_f=osd_map_f)
+    assert snapshot.epoch == 5
+    fake.epoch = 11
+    assert not snapshot.refresh()
+    assert snapshot.epoch == 5
+    # live osd tree doesn't describe map from file
+    assert snapshot.topology.osd(0).host is None
+    assert fake.commands == []
+
+
+def test_offline_needs_files(monkeypatch):
+    FakeCluster(monkeypatch)
+    snapshot = cluster_snapshot.ClusterSnapshot(offline=True)
+    with pytest.raises(cluster_snapshot.MissingArtifact):
+        snapshot.osd_map_f
+    with pytest.raises(cluster_snapshot.MissingArtifact):
+        snapshot.pgs
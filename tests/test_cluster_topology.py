@@ -0,0 +1,138 @@
+"""
+Cluster topology: indexes, incremental update on epoch change, live refresh.
+"""
+
+import json
+import copy
+
+import cluster
+import cluster_topology
+
+
+def dump_osd(osd_id, public, cluster_ip, up=1, weight=1.0):
+    return {'osd': osd_id, 'up': up, 'in': 1, 'weight': weight, 'primary_affinity': 1.0,
+            'public_addr': "{0}:6800/100".format(public), 'cluster_addr': "{0}:6801/100".format(cluster_ip)}
+
+
+def make_dump(epoch=10, crush_version=3):
+    return {'epoch': epoch, 'crush_version': crush_version,
+            'osds': [dump_osd(0, "10.0.0.1", "192.168.0.1"),
+                     dump_osd(1, "10.0.0.1", "192.168.0.1"),
+                     dump_osd(2, "10.0.0.2", "192.168.0.2")]}
+
+
+def make_tree(hosts):
+    "hosts - {host name: [osd ids]}, all under rack0 of root default"
+    nodes = [{'id': -1, 'name': "default", 'type': "root", 'children': [-2]},
+             {'id': -2, 'name': "rack0", 'type': "rack", 'children': []}]
+    for idx, (host, osd_ids) in enumerate(sorted(hosts.items())):
+        host_id = -3 - idx
+        nodes[1]['children'].append(host_id)
+        nodes.append({'id': host_id, 'name': host, 'type': "host", 'children': list(osd_ids)})
+        nodes.extend({'id': osd_id, 'name': "osd.{0}".format(osd_id), 'type': "osd"} for osd_id in osd_ids)
+    return {'nodes': nodes}
+
+
+def ids(infos):
+    return [info.id for info in infos]
+
+
+def test_indexes():
+    topology = cluster_topology.ClusterTopology.from_dumps(make_dump(), make_tree({"h1": [0, 1], "h2": [2]}))
+    assert len(topology) == 3
+    assert topology.osd(2).addrs == cluster_topology.OsdAddrs("10.0.0.2:6800", "192.168.0.2:6801")
+    assert topology.osd(0).location == {'host': "h1", 'rack': "rack0", 'root': "default"}
+    assert ids(topology.osds_by_ip("10.0.0.1")) == [0, 1]
+    assert ids(topology.osds_by_ip("192.168.0.2")) == [2]
+    assert topology.hosts() == ["h1", "h2"]
+    assert ids(topology.host_osds("h1")) == [0, 1]
+
+
+def test_same_epoch_is_ignored():
+    topology = cluster_topology.ClusterTopology.from_dumps(make_dump())
+    dump = make_dump()
+    dump['osds'][0]['up'] = 0
+    assert topology.update(dump) == 0
+    assert topology.osd(0).up
+
+
+def test_update_reindexes_changed_osds_only():
+    topology = cluster_topology.ClusterTopology.from_dumps(make_dump(), make_tree({"h1": [0, 1], "h2": [2]}))
+    dump = make_dump(epoch=11)
+    # osd.0 and osd.2 swap their addresses, osd.1 is marked down
+    dump['osds'][0] = dump_osd(0, "10.0.0.2", "192.168.0.2")
+    dump['osds'][2] = dump_osd(2, "10.0.0.1", "192.168.0.1")
+    dump['osds'][1]['up'] = 0
+    assert topology.update(dump) == 3
+    assert ids(topology.osds_by_ip("10.0.0.1")) == [1, 2]
+    assert ids(topology.osds_by_ip("10.0.0.2")) == [0]
+    assert not topology.osd(1).up
+    # location is kept without new osd tree
+    assert topology.osd(0).host == "h1"
+
+    dump = copy.deepcopy(dump)
+    dump['epoch'] = 12
+    dump['osds'][1]['weight'] = 0.5
+    assert topology.update(dump) == 1
+    assert topology.osd(1).reweight == 0.5
+
+
+def test_removed_and_relocated_osds():
+    topology = cluster_topology.ClusterTopology.from_dumps(make_dump(), make_tree({"h1": [0, 1], "h2": [2]}))
+    dump = make_dump(epoch=11)
+    del dump['osds'][2]
+    # osd.1 moved to h2, osd.2 is removed
+    assert topology.update(dump, make_tree({"h1": [0], "h2": [1]})) == 2
+    assert 2 not in topology
+    assert topology.osds_by_ip("10.0.0.2") == []
+    assert ids(topology.host_osds("h2")) == [1]
+    assert ids(topology.host_osds("h1")) == [0]
+
+
+def test_addr_ip():
+    assert cluster_topology.addr_ip("10.0.0.1:6800/100") == "10.0.0.1"
+    assert cluster_topology.addr_ip("[fd00::1]:6800/100") == "fd00::1"
+    assert cluster_topology.addr_ip("-") is None
+    assert cluster_topology.addr_ip("0.0.0.0:0/0") is None
+
+
+def test_get_all_osds_keeps_address_order():
+    addrs = cluster.get_all_osds(json.dumps(make_dump()))
+    assert addrs[2].public == "10.0.0.2:6800"
+    assert addrs[2].cluster == "192.168.0.2:6801"
+
+
+def test_refresh_fetches_tree_on_crush_change(monkeypatch):
+    state = {'dump': make_dump(), 'tree': make_tree({"h1": [0, 1], "h2": [2]})}
+    commands = []
+
+    def run_locally(cmd):
+        commands.append(cmd.split(" --")[0])
+        if cmd.startswith("ceph osd stat"):
+            return json.dumps({'epoch': state['dump']['epoch']}).encode("utf8")
+        if cmd.startswith("ceph osd dump"):
+            return json.dumps(state['dump']).encode("utf8")
+        assert cmd.startswith("ceph osd tree")
+        return json.dumps(state['tree']).encode("utf8")
+
+    monkeypatch.setattr(cluster_topology, "run_locally", run_locally)
+    topology = cluster_topology.ClusterTopology()
+    assert topology.refresh()
+    assert commands == ["ceph osd dump", "ceph osd tree"]
+
+    del commands[:]
+    assert not topology.refresh()
+    assert commands == ["ceph osd stat"]
+
+    # new epoch with the same crush version
+    del commands[:]
+    state['dump'] = make_dump(epoch=11)
+    assert topology.refresh()
+    assert commands == ["ceph osd stat", "ceph osd dump"]
+
+    del commands[:]
+    state['dump'] = make_dump(epoch=12, crush_version=4)
+    state['tree'] = make_tree({"h1": [0], "h2": [1, 2]})
+    assert topology.refresh()
+    assert commands == ["ceph osd stat", "ceph osd dump", "ceph osd tree"]
+    assert ids(topology.host_osds("h2")) == [1, 2]
@@ -0,0 +1,176 @@
+"""
+In-process CRUSH engine against reference results.
+
+data/crush_rules.json has crush_do_rule results of ceph's C mapper (libcrush) for synthetic
+map with two racks of three hosts. data/osdmap.pgs_dump.txt is expected acting sets for data/osdmap.json
+(primary affinity, pg_temp, primary_temp and upmaps) in 'osdmaptool --test-map-pgs-dump' format. It is NOT
+recorded from osdmaptool: it was produced by libcrush plus a port of OSDMap up/acting set code, so it only
+checks the engine against an independent implementation.
+
+Real osdmaptool results are checked for every map, recorded into data/osdmaptool with
+'calculate_remap.py verify -r tests/data/osdmaptool OSD_MAP...' on a host with ceph installed,
+and binary maps from there are verified against osdmaptool, if it's available.
+"""
+
+import os
+import sys
+import json
+import shutil
+
+import numpy
+import pytest
+
+import crush_mapper
+import artifact_cache
+import calculate_remap
+from crush_ln_table import RH_LH_TBL, LL_TBL
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def load_data(name):
+    with open(os.path.join(DATA_DIR, name)) as fd:
+        return json.load(fd)
+
+
+CRUSH_RULES = load_data("crush_rules.json")
+
+
+def test_ln_tables_are_verbatim():
+    assert len(RH_LH_TBL) == 128 * 2 + 2
+    assert len(LL_TBL) == 256
+    assert RH_LH_TBL[2:6] == [0x0000fe03f80fe040, 0x000002dfca16dde1, 0x0000fc0fc0fc0fc1, 0x000005b9e5a170b4]
+    assert RH_LH_TBL[-2:] == [0x0000800000000000, 0x0000ffff00000000]
+    assert LL_TBL[:3] == [0x0000000000000000, 0x00000002e2a60a00, 0x000000070cb64ec5]
+    assert LL_TBL[-1] == 0x000002dced24f814
+
+
+@pytest.mark.parametrize("profile", CRUSH_RULES['profiles'], ids=lambda profile: profile['name'])
+def test_do_rule_matches_libcrush(profile):
+    crush = crush_mapper.load_crush(profile['crush'])
+    x = numpy.array(CRUSH_RULES['x'], dtype=numpy.int64)
+    weights = numpy.array(CRUSH_RULES['weights'], dtype=numpy.int64)
+    for case in profile['cases']:
+        rule = crush.rules[case['rule']]
+        res = crush.do_rule(rule, x, case['result_max'], weights)
+        assert res.tolist() == case['expected'], "rule {0}, result_max {1}".format(rule.name, case['result_max'])
+
+
+def test_indep_on_short_failure_domain():
+    # 3 racks requested, only 2 exist: third slot is CRUSH_ITEM_NONE and must not be descended into
+    crush = crush_mapper.load_crush(CRUSH_RULES['profiles'][0]['crush'])
+    rule = [rule for rule in crush.rules.values() if rule.name == 'ec_short_rack'][0]
+    weights = numpy.full(crush.max_devices, crush_mapper.WEIGHT_ONE, dtype=numpy.int64)
+    res = crush.do_rule(rule, numpy.arange(100), 6, weights)
+    assert (res[:, 4:] == crush_mapper.CRUSH_ITEM_NONE).all()
+    assert (res[:, :4] != crush_mapper.CRUSH_ITEM_NONE).all()
+
+
+def test_zero_tries_steps_are_ignored():
+    crush = crush_mapper.load_crush(CRUSH_RULES['profiles'][0]['crush'])
+    rule = [rule for rule in crush.rules.values() if rule.name == 'zero_tries'][0]
+    plain = crush_mapper.Rule(100, 'plain', [step for step in rule.steps if not step['op'].startswith('set_')])
+    weights = numpy.full(crush.max_devices, crush_mapper.WEIGHT_ONE, dtype=numpy.int64)
+    x = numpy.arange(500)
+    assert crush.do_rule(rule, x, 6, weights).tolist() == crush.do_rule(plain, x, 6, weights).tolist()
+
+
+def recorded_mismatches(data_dir, name):
+    "Number of PGs, which engine maps not as recorded osdmaptool output of data_dir/name"
+    with open(os.path.join(data_dir, name + ".json")) as fd:
+        data = json.load(fd)
+    crush = crush_mapper.load_crush(data['crush'])
+    osdmap = crush_mapper.load_osdmap(data['osd_dump'])
+    with open(os.path.join(data_dir, name + ".pgs_dump.txt")) as fd:
+        expected = {pool.pid: pool for pool in calculate_remap.parse(fd)}
+    assert sorted(expected) == sorted(pool.pid for pool in osdmap.pools)
+    return calculate_remap.compare_mapping(crush, osdmap, expected)
+
+
+def test_map_pools_matches_reference_mapping():
+    assert recorded_mismatches(DATA_DIR, "osdmap") == 0
+
+
+RECORDED_DIR = os.path.join(DATA_DIR, "osdmaptool")
+RECORDED = sorted(name[:-len(".json")] for name in os.listdir(RECORDED_DIR)
+                  if name.endswith(".json")) if os.path.isdir(RECORDED_DIR) else []
+
+
+@pytest.mark.skipif(not RECORDED, reason="no osdmaptool output recorded in data/osdmaptool")
+@pytest.mark.parametrize("name", RECORDED or ["none"])
+def test_map_pools_matches_recorded_osdmaptool(name):
+    assert recorded_mismatches(RECORDED_DIR, name) == 0
+
+
+@pytest.mark.skipif(not RECORDED or shutil.which("osdmaptool") is None,
+                    reason="no osdmaptool or no recorded osd maps")
+@pytest.mark.parametrize("name", RECORDED or ["none"])
+def test_map_pools_matches_live_osdmaptool(name):
+    assert calculate_remap.verify_mapping(os.path.join(RECORDED_DIR, name + ".osdmap")) == 0
+
+
+# osdmaptool and crushtool stand-in, which gives dumps of data/osdmap.json and data/osdmap.pgs_dump.txt
+FAKE_TOOL = """#!{python}
+import os
+import sys
+import json
+
+args = sys.argv[1:]
+data = json.load(open({osdmap_js!r}))
+if "--export-crush" in args:
+    open(args[args.index("--export-crush") + 1], "w").write("crush")
+elif "--test-map-pgs-dump" in args:
+    print("osdmaptool: osdmap file '{{0}}'".format(args[-1]))
+    sys.stdout.write(open({dump!r}).read())
+elif os.path.basename(sys.argv[0]) == "crushtool":
+    print(json.dumps(data['crush']))
+else:
+    print(json.dumps(data['osd_dump']))
+"""
+
+
+def test_record_mapping(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for tool in ("osdmaptool", "crushtool"):
+        (bin_dir / tool).write_text(FAKE_TOOL.format(python=sys.executable,
+                                                     osdmap_js=os.path.join(DATA_DIR, "osdmap.json"),
+                                                     dump=os.path.join(DATA_DIR, "osdmap.pgs_dump.txt")))
+        (bin_dir / tool).chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(artifact_cache, "_default_cache", None)
+    monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    osd_map_f = tmp_path / "cluster1.bin"
+    osd_map_f.write_text("binary map")
+
+    out_dir = str(tmp_path / "recorded")
+    assert calculate_remap.record_mapping(str(osd_map_f), out_dir) == "cluster1"
+    assert sorted(os.listdir(out_dir)) == ["cluster1.json", "cluster1.osdmap", "cluster1.pgs_dump.txt"]
+    assert recorded_mismatches(out_dir, "cluster1") == 0
+
+
+def test_compare_mapping_is_ordered():
+    data = load_data("osdmap.json")
+    crush = crush_mapper.load_crush(data['crush'])
+    osdmap = crush_mapper.load_osdmap(data['osd_dump'])
+    with open(os.path.join(DATA_DIR, "osdmap.pgs_dump.txt")) as fd:
+        expected = {pool.pid: pool for pool in calculate_remap.parse(fd)}
+
+    # the same OSDs in other order is a mismatch, as is other primary
+    expected[1].mapping[0, [0, 1]] = expected[1].mapping[0, [1, 0]]
+    expected[2].primary[0] = crush_mapper.NO_OSD
+    assert calculate_remap.compare_mapping(crush, osdmap, expected) == 2
+
+
+def test_choose_without_replicas_clears_work():
+    # choose arg -4 with result_max 3 selects nothing, emit must not output taken root
+    crush = crush_mapper.load_crush(CRUSH_RULES['profiles'][0]['crush'])
+    rack = [rule for rule in crush.rules.values() if rule.name == 'ec_short_rack'][0]
+    rack_type = [step['type_id'] for step in rack.steps if 'type_id' in step][0]
+    rule = crush_mapper.Rule(100, 'negative', [{'op': 'take', 'item': -1},
+                                               {'op': 'choose_firstn', 'num': -4, 'type_id': rack_type},
+                                               {'op': 'emit'}])
+    weights = numpy.full(crush.max_devices, crush_mapper.WEIGHT_ONE, dtype=numpy.int64)
+    res = crush.do_rule(rule, numpy.arange(10), 3, weights)
+    assert (res == crush_mapper.CRUSH_ITEM_NONE).all()
@@ -0,0 +1,191 @@
+"""
+PG distribution: OSD x pool matrices, spread statistics, primary affinity, crush domain roll-ups.
+"""
+
+import io
+import json
+
+import numpy
+import pytest
+
+import pg_snapshot
+import pg_per_osd
+
+
+def pg(pgid, acting, num_bytes, ops=0):
+    return {'pgid': pgid, 'acting': acting, 'up': acting,
+            'stat_sum': {'num_bytes': num_bytes, 'num_read': ops, 'num_write': ops}}
+
+
+# osd.3 has no pool 1 PGs, osd.1 and osd.2 no pool 2 ones
+PG_DUMP = {'version': 1, 'stamp': "now",
+           'pg_stats': [pg("1.0", [0, 1], 100, 5), pg("1.1", [1, 2], 200, 10), pg("1.2", [2, 0], 300, 15),
+                        pg("2.0", [0, 3], 400), pg("2.1", [3, 0], 500)]}
+
+
+@pytest.fixture
+def snapshot(monkeypatch):
+    snapshot = pg_snapshot.from_pg_dump(PG_DUMP)
+    monkeypatch.setattr(pg_per_osd.cluster_snapshot, "pgs_of", lambda pg_source: snapshot)
+    return snapshot
+
+
+def test_distribution_matrix(snapshot):
+    distr = pg_per_osd.load_PG_distribution(with_bytes=True, with_ops=True)
+    assert distr.osds.tolist() == [0, 1, 2, 3]
+    assert distr.pools.tolist() == [1, 2]
+    assert distr.pgs.tolist() == [[2, 2], [2, 0], [2, 0], [0, 2]]
+    assert distr.bytes.tolist() == [[400, 900], [300, 0], [500, 0], [0, 900]]
+    assert distr.ops.tolist() == [[40, 0], [30, 0], [50, 0], [0, 0]]
+    assert distr.osd_totals('bytes').tolist() == [1300, 300, 500, 900]
+
+
+def test_spread_stats_skip_empty_cells(snapshot):
+    distr = pg_per_osd.load_PG_distribution(with_bytes=True)
+    stats = pg_per_osd.spread_stats(distr.bytes, axis=0)
+    assert stats['min'].tolist() == [300, 900]
+    assert stats['max'].tolist() == [500, 900]
+    assert stats['mean'].tolist() == [400, 900]
+    assert numpy.allclose(stats['std'], [numpy.sqrt(20000 / 3.0), 0])
+    assert numpy.allclose(stats['imbalance'], [0.25, 0])
+
+    # per OSD over pools, pool without data gives nan
+    stats = pg_per_osd.spread_stats(numpy.array([[1, 0], [3, 0]]), axis=0)
+    assert stats['mean'][0] == 2 and numpy.isnan(stats['mean'][1])
+
+
+def test_osd_load_stats(snapshot):
+    distr = pg_per_osd.load_PG_distribution(with_bytes=True)
+    totals, imbalance = pg_per_osd.osd_load_stats(distr.bytes)
+    assert totals.tolist() == [1300, 300, 500, 900]
+    assert numpy.allclose(imbalance, [1300 / 750.0 - 1, 300 / 750.0 - 1, 500 / 750.0 - 1, 900 / 750.0 - 1])
+
+    # per capacity unit, no capacity gives nan
+    totals, imbalance = pg_per_osd.osd_load_stats(distr.bytes, numpy.array([2.0, 1.0, 1.0, 0.0]))
+    mean = 2100 / 4.0
+    assert numpy.allclose(imbalance[:3], [650 / mean - 1, 300 / mean - 1, 500 / mean - 1])
+    assert numpy.isnan(imbalance[3])
+
+
+def test_write_csv(snapshot):
+    fd = io.StringIO()
+    pg_per_osd.write_csv(pg_per_osd.load_PG_distribution(), fd)
+    assert fd.getvalue().splitlines() == ["osd,pool_1,pool_2,total,imbalance",
+                                          "0,2,2,4,0.6000",
+                                          "1,2,0,2,-0.2000",
+                                          "2,2,0,2,-0.2000",
+                                          "3,0,2,2,-0.2000"]
+
+
+def test_primary_distribution(snapshot):
+    distr = pg_per_osd.load_PG_distribution(key='primary', with_bytes=True)
+    assert distr.osds.tolist() == [0, 1, 2, 3]
+    assert distr.pgs.tolist() == [[1, 1], [1, 0], [1, 0], [0, 1]]
+    assert distr.bytes.tolist() == [[100, 400], [200, 0], [300, 0], [0, 500]]
+
+
+def column(values):
+    "PGDistribution of one pool with given PG count per OSD 0..N-1"
+    return pg_per_osd.PGDistribution(numpy.arange(len(values)), numpy.array([1]),
+                                     numpy.array(values, dtype=numpy.int64)[:, None])
+
+
+def test_suggest_affinity_lowers_overloaded_primary():
+    # equal acting load, osd.0 is primary for two thirds of PGs
+    suggestions = pg_per_osd.suggest_primary_affinity(column([10, 10, 10]), column([20, 5, 5]))
+    assert suggestions == {0: (1.0, 0.5)}
+
+
+def test_suggest_affinity_raises_underloaded_primary():
+    suggestions = pg_per_osd.suggest_primary_affinity(column([10, 10, 10]), column([10, 5, 15]),
+                                                      curr_affinity={1: 0.5, 2: 1.0})
+    # osd.1 gets its affinity back, osd.2 is lowered proportionally to overload
+    assert suggestions == {1: (0.5, 1.0), 2: (1.0, 0.67)}
+
+
+def test_suggest_affinity_limits():
+    # osd.2 is never primary with low affinity, osd.3 has no PGs, osd.0 can't go below min_affinity
+    suggestions = pg_per_osd.suggest_primary_affinity(column([10, 10, 10, 0]), column([29, 1, 0, 0]),
+                                                      curr_affinity={2: 0.1, 3: 0.3}, min_affinity=0.4)
+    assert suggestions == {0: (1.0, 0.4), 2: (0.1, 1.0)}
+
+
+def test_write_affinity():
+    fd = io.StringIO()
+    pg_per_osd.write_affinity({2: (1.0, 0.67), 1: (0.5, 1.0)}, fd)
+    assert fd.getvalue().splitlines() == ["ceph osd primary-affinity osd.1 1.00  # was 0.50",
+                                          "ceph osd primary-affinity osd.2 0.67  # was 1.00"]
+
+
+
+class FakeNode(object):
+    def __init__(self, name, weight, full_path):
+        self.name = name
+        self.weight = weight
+        self.full_path = full_path
+
+
+class FakeCrush(object):
+    "cephlib crush tree stand-in, only OSD nodes with their full paths"
+    def __init__(self, osds):
+        self.osds = osds
+
+    def iter_nodes(self, node_type):
+        assert node_type == 'osd'
+        for osd_id, weight, path in self.osds:
+            name = "osd.{0}".format(osd_id)
+            yield FakeNode(name, weight, path + [("osd", name)])
+
+
+def make_domains():
+    def path(rack, host, root="default"):
+        return [("root", root), ("rack", rack), ("host", host)]
+
+    # osd.0 is also placed in second tree, it's counted in the first one only
+    return pg_per_osd.DomainIndex(FakeCrush([(0, 1.0, path("r0", "h0")), (1, 1.0, path("r0", "h0")),
+                                             (2, 2.0, path("r1", "h1")), (3, 0.0, path("r1", "h1")),
+                                             (0, 1.0, path("r2", "h0-ssd", root="ssd"))]))
+
+
+def test_domain_index():
+    domains = make_domains()
+    assert list(domains.levels) == ["root", "rack", "host"]
+    names, index = domains.levels["host"]
+    assert names == ["h0", "h1"]
+    assert index.tolist() == [0, 0, 1, 1]
+    assert domains.weights.tolist() == [1.0, 1.0, 2.0, 0.0]
+
+
+def test_rollup_per_host_and_root(snapshot):
+    domains = make_domains()
+    distr = pg_per_osd.load_PG_distribution(with_bytes=True)
+    hosts = domains.rollup(distr, "host")
+    assert hosts.label == "host"
+    assert hosts.osds.tolist() == ["h0", "h1"]
+    assert hosts.pgs.tolist() == [[4, 2], [2, 2]]
+    assert hosts.bytes.tolist() == [[700, 900], [500, 900]]
+    assert hosts.ops is None
+    assert hosts.capacity.tolist() == [2.0, 2.0]
+
+    root = domains.rollup(distr, "root")
+    assert root.pgs.tolist() == [[6, 4]]
+    assert root.capacity.tolist() == [4.0]
+
+
+def test_rollup_skips_osds_out_of_crush():
+    distr = pg_per_osd.PGDistribution(numpy.array([0, 2, 7]), numpy.array([1]), numpy.array([[1], [2], [4]]))
+    assert make_domains().rollup(distr, "rack").pgs.tolist() == [[1], [2]]
+
+
+def test_write_domains_json(snapshot):
+    fd = io.StringIO()
+    distr = pg_per_osd.load_PG_distribution()
+    pg_per_osd.write_domains(distr, make_domains(), ["host", "rack"], fd, out_format='json')
+    res = json.loads(fd.getvalue())
+    assert sorted(res) == ["host", "rack"]
+    assert res["rack"]["buckets"] == ["r0", "r1"]
+    assert res["rack"]["capacity"] == [2.0, 2.0]
+    assert res["rack"]["pgs"] == [[4, 2], [2, 2]]
+    # racks have the same weight, so imbalance is by PG count
+    assert res["rack"]["pgs_osd_stats"]['total'] == [6, 4]
+    assert numpy.allclose(res["rack"]["pgs_osd_stats"]['imbalance'], [0.2, -0.2])
@@ -0,0 +1,56 @@
+"""
+PG series: replay of deltas against usage of full dumps.
+"""
+
+import numpy
+
+import pg_series
+
+
+def make_dumps(count=12, pgs=2000, width=3):
+    rng = numpy.random.RandomState(1)
+    keys = numpy.arange(pgs, dtype=numpy.int64)
+    acting = rng.randint(0, 40, size=(pgs, width)).astype(numpy.int32)
+    num_bytes = rng.randint(0, 1 << 30, size=pgs).astype(numpy.int64)
+    dumps = []
+    for idx in range(count):
+        acting = acting.copy()
+        num_bytes = num_bytes.copy()
+        remapped = rng.rand(pgs) < 0.01
+        acting[remapped, 0] = rng.randint(0, 40, size=remapped.sum())
+        # dense and sparse size changes
+        written = rng.rand(pgs) < (0.9 if idx % 2 else 0.05)
+        num_bytes[written] += rng.randint(0, 1 << 20, size=written.sum())
+        dumps.append((keys, acting, num_bytes))
+    return dumps
+
+
+def test_replay_matches_full_dumps():
+    dumps = make_dumps()
+    series = pg_series.PGSeries()
+    for idx, (keys, acting, num_bytes) in enumerate(dumps):
+        series.append(str(idx), idx, None, keys, acting, num_bytes)
+
+    prev = None
+    for (point, pg_count, osd_bytes, remapped, moved), (_, acting, num_bytes) in zip(series.iter_usage(), dumps):
+        exp_count = numpy.zeros_like(pg_count)
+        exp_bytes = numpy.zeros_like(osd_bytes)
+        pg_series.add_usage(exp_count, exp_bytes, acting, num_bytes)
+        assert (pg_count == exp_count).all()
+        assert (osd_bytes == exp_bytes).all()
+        if prev is not None:
+            joined = pg_series.new_slots(prev, acting)
+            assert remapped == int(joined.any(axis=1).sum())
+            assert moved == int((joined.sum(axis=1) * num_bytes).sum())
+        prev = acting
+
+
+def test_size_changes_dont_store_acting():
+    dumps = make_dumps()
+    series = pg_series.PGSeries()
+    for idx, (keys, acting, num_bytes) in enumerate(dumps):
+        series.append(str(idx), idx, None, keys, acting, num_bytes)
+
+    for point in series.points[1:]:
+        assert len(point.rows) < 0.05 * len(dumps[0][0])
+    assert series.nbytes < series.full_nbytes / 4
@@ -0,0 +1,123 @@
+"""
+PG snapshot cache: stored snapshots are reused, stale ones are replaced.
+Streaming pg dump reader: chunk boundaries, dump layouts, broken input.
+"""
+
+import io
+import os
+import json
+
+import pytest
+
+import pg_snapshot
+
+
+def make_dump(version, stamp="2026-01-01 00:00:00.000000"):
+    pg_stats = [{'pgid': "1.{0:x}".format(pg_id), 'acting': [pg_id % 4, (pg_id + 1) % 4],
+                 'up': [pg_id % 4, (pg_id + 1) % 4], 'stat_sum': {'num_bytes': pg_id * 100}}
+                for pg_id in range(16)]
+    return {'version': version, 'stamp': stamp, 'pg_stats': pg_stats}
+
+
+def test_save_load_roundtrip(tmp_path):
+    snapshot = pg_snapshot.from_pg_dump(make_dump(10))
+    pg_snapshot.save(snapshot, str(tmp_path))
+    cached = pg_snapshot.load(10, str(tmp_path))
+    assert cached.stamp == snapshot.stamp
+    assert cached.acting.tolist() == snapshot.acting.tolist()
+    assert cached.num_bytes.tolist() == snapshot.num_bytes.tolist()
+
+
+def test_broken_snapshot_is_replaced(tmp_path):
+    broken = tmp_path / "10"
+    broken.mkdir()
+    (broken / "meta.json").write_text(json.dumps({'version': 10, 'stamp': "old", 'format': 1}))
+    (broken / "pool.npy").write_text("garbage")
+
+    snapshot = pg_snapshot.from_pg_dump(make_dump(10))
+    pg_snapshot.save(snapshot, str(tmp_path))
+    cached = pg_snapshot.load(10, str(tmp_path))
+    assert cached is not None
+    assert cached.num_bytes.tolist() == snapshot.num_bytes.tolist()
+    # no temporary directories left
+    assert sorted(os.listdir(str(tmp_path))) == ["10"]
+
+
+def test_snapshot_with_other_stamp_is_replaced(tmp_path):
+    pg_snapshot.save(pg_snapshot.from_pg_dump(make_dump(10, stamp="first")), str(tmp_path))
+    pg_snapshot.save(pg_snapshot.from_pg_dump(make_dump(10, stamp="second")), str(tmp_path))
+    assert pg_snapshot.load(10, str(tmp_path)).stamp == "second"
+
+
+def nautilus_dump(dump):
+    "'ceph pg dump' layout since nautilus, pg stats are nested in pg_map"
+    pg_map = {'version': dump['version'], 'stamp': dump['stamp'],
+              'pg_stats_sum': {'stat_sum': {'num_bytes': 12000}}}
+    pg_map['pg_stats'] = dump['pg_stats']
+    pg_map['osd_stats'] = [{'osd': 0, 'kb_used': 100}]
+    return {'pg_ready': True, 'pg_map': pg_map}
+
+
+def luminous_dump(dump):
+    "'ceph pg dump' layout before nautilus, pg stats are on top level after sums"
+    res = {'version': dump['version'], 'stamp': dump['stamp'], 'pg_stats_sum': {'stat_sum': {'num_bytes': 12000}}}
+    res['pg_stats'] = dump['pg_stats']
+    res['osd_stats'] = [{'osd': 0, 'kb_used': 100}]
+    return res
+
+
+def read_stream(data, **params):
+    stream = pg_snapshot.PGDumpStream(io.BytesIO(data), **params)
+    records = list(stream)
+    return stream, records
+
+
+@pytest.mark.parametrize("layout", [nautilus_dump, luminous_dump])
+def test_stream_dump_layouts(layout):
+    dump = make_dump(10)
+    stream, records = read_stream(json.dumps(layout(dump)).encode("utf8"))
+    assert records == dump['pg_stats']
+    assert stream.version == 10
+    assert stream.stamp == dump['stamp']
+
+
+def test_stream_records_split_between_chunks():
+    dump = make_dump(10, stamp=u"2026-01-01 \u0436")
+    for pg in dump['pg_stats']:
+        pg['state'] = u"active+clean \u0436" * 4
+    data = json.dumps(nautilus_dump(dump), ensure_ascii=False).encode("utf8")
+    # every record and multibyte char is split at some chunk size
+    for chunk_size in (1, 3, 7, 64, 333, len(data) - 1):
+        assert read_stream(data, chunk_size=chunk_size)[1] == dump['pg_stats']
+
+
+def test_stream_record_split_at_default_chunk():
+    dump = make_dump(10)
+    dump['pg_stats'] = [dict(pg, pgid="1.{0:x}".format(pg_id), state="x" * 1000)
+                        for pg_id, pg in enumerate(dump['pg_stats'] * 200)]
+    text = json.dumps(nautilus_dump(dump))
+    assert len(text) > 2 << 20
+    # 1MiB boundary is inside of record
+    assert text[(1 << 20) - 1] not in ", ]"
+    assert read_stream(text.encode("utf8"))[1] == dump['pg_stats']
+
+
+def test_stream_truncated_dump():
+    data = json.dumps(nautilus_dump(make_dump(10))).encode("utf8")
+    records_start = data.index(b'"pg_stats": [')
+    for size in (records_start, records_start + 200, len(data) // 2, data.rindex(b"]", 0, data.index(b"osd_stats"))):
+        with pytest.raises(ValueError):
+            read_stream(data[:size], chunk_size=64)
+
+
+def test_stream_buffer_is_bounded():
+    garbage = b'{"pg_stats": [{"pgid": "1.0", "state": active' + b" " * (1 << 20) + b'}]}'
+    fd = io.BytesIO(garbage)
+    with pytest.raises(ValueError):
+        list(pg_snapshot.PGDumpStream(fd, chunk_size=1024, max_size=64 * 1024))
+    assert fd.tell() < 128 * 1024
+
+    fd = io.BytesIO(b'{"version": 1, "pad": "' + b"x" * (1 << 20) + b'"}')
+    with pytest.raises(ValueError):
+        list(pg_snapshot.PGDumpStream(fd, chunk_size=1024, max_size=64 * 1024))
+    assert fd.tell() < 128 * 1024
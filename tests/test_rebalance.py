@@ -0,0 +1,349 @@
+"""
+Rebalance rounds: batched updates, failure domain limits, round splitting.
+"""
+
+import os
+import json
+import subprocess
+
+import numpy
+
+import artifact_cache
+import crush_mapper
+import calculate_remap
+import rebalance
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def load_map(weights=None, reweights=None):
+    "crush and osd map of data/osdmap.json with {osd id: crush weight} and {osd id: reweight} applied"
+    with open(os.path.join(DATA_DIR, "osdmap.json")) as fd:
+        data = json.load(fd)
+    crush, osdmap = crush_mapper.load_crush(data['crush']), crush_mapper.load_osdmap(data['osd_dump'])
+    for osd_id, weight in (weights or {}).items():
+        crush.set_item_weight(int(osd_id), int(round(weight * crush_mapper.WEIGHT_ONE)))
+    crush_mapper.apply_reweights(osdmap, reweights or {})
+    return crush, osdmap
+
+
+class MapTools(object):
+    """
+    crushtool and osdmaptool stand-in: crush and osd map files hold {osd id: crush weight} json,
+    which is applied to data/osdmap.json, when map is loaded
+    """
+    def __init__(self, monkeypatch, tmp_path):
+        self.tmp_path = tmp_path
+        self.count = 0
+        _, osdmap = load_map()
+        self.pg_sizes = {pool.pid: numpy.arange(pool.pg_num, dtype=numpy.int64) * 10 + 100 for pool in osdmap.pools}
+        monkeypatch.setattr(rebalance, "update_crush_weights", self.update_crush_weights)
+        monkeypatch.setattr(rebalance, "import_crush", self.import_crush)
+        monkeypatch.setattr(crush_mapper, "load_osdmap_file", self.load_osdmap_file)
+        monkeypatch.setattr(calculate_remap, "get_pg_sizes", lambda pg_dump_f: self.pg_sizes)
+        monkeypatch.setattr(artifact_cache, "_default_cache", None)
+        monkeypatch.setenv(artifact_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+
+    @staticmethod
+    def read(path):
+        with open(path) as fd:
+            return json.load(fd)
+
+    def new_file(self, weights):
+        self.count += 1
+        path = str(self.tmp_path / "map{0}".format(self.count))
+        with open(path, "w") as fd:
+            json.dump(weights, fd)
+        return path
+
+    def update_crush_weights(self, crushmap_bin_f, changes):
+        weights = self.read(crushmap_bin_f)
+        weights.update((str(node.id), new_weight) for node, new_weight in changes)
+        with open(crushmap_bin_f, "w") as fd:
+            json.dump(weights, fd)
+
+    def import_crush(self, osd_map_f, crush_map_f):
+        return self.new_file(self.read(crush_map_f))
+
+    def load_osdmap_file(self, osd_map_f):
+        return load_map(self.read(osd_map_f))
+
+    def remap(self, old, new):
+        "RemapStats between two (weights, reweights) states, mapped directly"
+        maps = []
+        for weights, reweights in (old, new):
+            crush, osdmap = load_map(weights, reweights)
+            maps.append({pool.pid: calculate_remap.pool_from_mapping(pool, crush_mapper.map_pool(crush, osdmap, pool))
+                         for pool in osdmap.pools})
+        return calculate_remap.RemapStats("", calculate_remap.remap_diff(maps[0], maps[1], self.pg_sizes))
+
+
+def test_reweightn_payload_has_string_values(monkeypatch):
+    commands = []
+    monkeypatch.setattr(rebalance, "run_locally", commands.append)
+    rebalance.request_reweight_updates([(rebalance.FakedNode(name="osd.3"), 0.5),
+                                        (rebalance.FakedNode(name="osd.12"), 1.0)])
+    assert len(commands) == 1
+    prefix = "ceph osd reweightn '"
+    assert commands[0].startswith(prefix) and commands[0].endswith("'")
+    assert json.loads(commands[0][len(prefix):-1]) == {"3": "32768", "12": "65536"}
+
+
+class FakeMonitor(object):
+    """
+    Monitor side of crush map commands: crush map file holds {osd name: weight} json,
+    setcrushmap with prior version fails, if crush was changed after that version
+    """
+    def __init__(self, monkeypatch, concurrent_changes=0, crush_version=7):
+        self.weights = {"osd.1": 1.0, "osd.2": 1.0}
+        self.crush_version = crush_version
+        self.concurrent_changes = concurrent_changes
+        self.commands = []
+        monkeypatch.setattr(rebalance, "run_locally", self.run_locally)
+        monkeypatch.setattr(rebalance, "update_crush_weights", self.update_crush_weights)
+
+    def change_crush(self, name, weight):
+        self.weights[name] = weight
+        if self.crush_version is not None:
+            self.crush_version += 1
+
+    def run_locally(self, cmd):
+        self.commands.append(" ".join(cmd.split()[:3]))
+        args = cmd.split()
+        if cmd.startswith("ceph osd dump"):
+            dump = {'epoch': 100}
+            if self.crush_version is not None:
+                dump['crush_version'] = self.crush_version
+            return json.dumps(dump).encode("utf8")
+        if cmd.startswith("ceph osd getcrushmap"):
+            with open(args[-1], "w") as fd:
+                json.dump(self.weights, fd)
+            if self.concurrent_changes:
+                # someone else changes crush, while round map is prepared
+                self.concurrent_changes -= 1
+                self.change_crush("osd.3", 0.5 + self.concurrent_changes)
+            return b""
+        if cmd.startswith("ceph osd setcrushmap"):
+            if int(args[-1]) != self.crush_version:
+                raise subprocess.CalledProcessError(1, cmd)
+            with open(args[4]) as fd:
+                self.weights = json.load(fd)
+            self.crush_version += 1
+            return b""
+        assert cmd.startswith("ceph osd crush set")
+        self.change_crush(args[4], float(args[5]))
+        return b""
+
+    @staticmethod
+    def update_crush_weights(crushmap_bin_f, changes):
+        with open(crushmap_bin_f) as fd:
+            weights = json.load(fd)
+        weights.update((node.name, new_weight) for node, new_weight in changes)
+        with open(crushmap_bin_f, "w") as fd:
+            json.dump(weights, fd)
+
+
+def weight_changes():
+    return [(rebalance.FakedNode(name="osd.1", full_path=[("host", "h0")]), 1.5),
+            (rebalance.FakedNode(name="osd.2", full_path=[("host", "h1")]), 0.5)]
+
+
+def test_batch_weight_update_sets_crush_once(monkeypatch):
+    monitor = FakeMonitor(monkeypatch)
+    rebalance.request_weight_updates(weight_changes())
+    assert monitor.commands == ["ceph osd dump", "ceph osd getcrushmap", "ceph osd setcrushmap"]
+    assert monitor.weights == {"osd.1": 1.5, "osd.2": 0.5}
+    assert monitor.crush_version == 8
+
+
+def test_batch_weight_update_keeps_concurrent_change(monkeypatch):
+    monitor = FakeMonitor(monkeypatch, concurrent_changes=1)
+    rebalance.request_weight_updates(weight_changes())
+    # first map is rejected as stale and round is applied on top of the new crush
+    assert monitor.commands.count("ceph osd setcrushmap") == 2
+    assert monitor.weights == {"osd.1": 1.5, "osd.2": 0.5, "osd.3": 0.5}
+
+
+def test_batch_weight_update_falls_back_to_per_osd_commands(monkeypatch):
+    monitor = FakeMonitor(monkeypatch, concurrent_changes=3)
+    rebalance.request_weight_updates(weight_changes(), retries=3)
+    assert monitor.commands.count("ceph osd setcrushmap") == 3
+    assert monitor.commands[-2:] == ["ceph osd crush", "ceph osd crush"]
+    assert monitor.weights == {"osd.1": 1.5, "osd.2": 0.5, "osd.3": 0.5}
+
+    # no crush version - no way to detect concurrent changes
+    monitor = FakeMonitor(monkeypatch, crush_version=None)
+    rebalance.request_weight_updates(weight_changes())
+    assert monitor.commands == ["ceph osd dump", "ceph osd crush", "ceph osd crush"]
+    assert monitor.weights == {"osd.1": 1.5, "osd.2": 0.5}
+
+
+def osd_node(osd_id, host, rack, weight=1.0):
+    name = "osd.{0}".format(osd_id)
+    return rebalance.FakedNode(name=name, id=osd_id, weight=weight,
+                               full_path=[("root", "default"), ("rack", rack), ("host", host), ("osd", name)])
+
+
+def round_config(max_nodes=4, domain_limits=None):
+    config = rebalance.Config()
+    config.max_nodes_per_round = max_nodes
+    config.max_weight_change = 0.5
+    config.max_reweight_change = 0.1
+    config.min_weight_diff = 0.01
+    config.min_reweight_diff = 0.01
+    config.domain_limits = domain_limits or {}
+    return config
+
+
+def names(changes):
+    return [item[0].name for item in changes]
+
+
+def test_round_takes_one_osd_per_host():
+    config = round_config(domain_limits={'host': 1})
+    active = [(osd_node(0, "h0", "r0"), 2.0), (osd_node(1, "h0", "r0"), 2.0),
+              (osd_node(2, "h1", "r0"), 2.0), (osd_node(3, "h2", "r1"), 2.0)]
+    assert names(rebalance.take_round_nodes(active, config)) == ["osd.0", "osd.2", "osd.3"]
+    # skipped OSD stays for next round
+    assert names(active) == ["osd.1"]
+
+
+def test_round_limits_per_host_and_rack():
+    config = round_config(max_nodes=10, domain_limits={'host': 1, 'rack': 2})
+    active = [(osd_node(idx, "h{0}".format(idx), "r0" if idx < 4 else "r1"), 2.0) for idx in range(6)]
+    assert names(rebalance.take_round_nodes(active, config)) == ["osd.0", "osd.1", "osd.4", "osd.5"]
+    assert names(active) == ["osd.2", "osd.3"]
+
+
+def test_round_limit_without_domains_keeps_order():
+    config = round_config(max_nodes=2)
+    active = [(osd_node(idx, "h0", "r0"), 2.0) for idx in range(3)]
+    assert names(rebalance.take_round_nodes(active, config)) == ["osd.0", "osd.1"]
+    assert names(active) == ["osd.2"]
+
+
+def test_reweight_rounds_use_osd_paths():
+    config = round_config(domain_limits={'host': 1})
+    nodes = [osd_node(0, "h0", "r0"), osd_node(1, "h0", "r0"), osd_node(2, "h1", "r0")]
+    config.osd_paths = {node.name: node.full_path for node in nodes}
+    config.reweight_nodes = [(rebalance.FakedNode(name=node.name, weight=1.0), 0.9) for node in nodes]
+    rounds = [(is_reweight, names(changes)) for is_reweight, changes in rebalance.iter_rounds(config)]
+    assert rounds == [(True, ["osd.0", "osd.2"]), (True, ["osd.1"])]
+
+
+def test_iter_rounds_splits_changes_by_step():
+    config = round_config(max_nodes=2, domain_limits={'host': 1})
+    config.rebalance_nodes = [(osd_node(0, "h0", "r0"), 2.0), (osd_node(1, "h0", "r0"), 1.5),
+                              (osd_node(2, "h1", "r0"), 0.8)]
+    # weight and reweight rounds alternate, reweight ones are empty here
+    rounds = [[(node.name, old, new) for node, old, new in changes]
+              for is_reweight, changes in rebalance.iter_rounds(config) if not is_reweight]
+    assert rounds == [[("osd.0", 1.0, 1.5), ("osd.2", 1.0, 0.8)],
+                      [("osd.1", 1.0, 1.5)],
+                      [("osd.0", 1.5, 2.0)]]
+
+
+def crush_osd(crush, osd_id):
+    "FakedNode for OSD of load_map() crush, as cephlib crush tree gives"
+    name = "osd.{0}".format(osd_id)
+    path = list(crush.path(osd_id)) + [("osd", name)]
+    return rebalance.FakedNode(name=name, id=osd_id, weight=crush.item_weight(osd_id) / float(crush_mapper.WEIGHT_ONE),
+                               full_path=path)
+
+
+def sim_config(crush):
+    config = round_config(max_nodes=2)
+    config.rebalance_nodes = [(crush_osd(crush, 0), 0.5), (crush_osd(crush, 4), 2.0), (crush_osd(crush, 8), 1.5)]
+    config.reweight_nodes = [(rebalance.FakedNode(name="osd.9", weight=1.0), 0.8)]
+    return config
+
+
+def test_simulate_rounds_matches_direct_remap(monkeypatch, tmp_path):
+    tools = MapTools(monkeypatch, tmp_path)
+    crush, _ = load_map()
+    config = sim_config(crush)
+    base_map = tools.new_file({})
+    rounds, direct = rebalance.simulate_rounds(config, tools.new_file({}), base_map)
+
+    # config is not consumed
+    assert [(node.name, node.weight) for node, _ in config.rebalance_nodes] == [("osd.0", 1.5), ("osd.4", 1.5),
+                                                                               ("osd.8", 2.0)]
+
+    # replay the same rounds on map state
+    weights, reweights = {}, {}
+    states = [({}, {})]
+    types = []
+    for is_reweight_round, changes in rebalance.iter_rounds(rebalance.copy_config(config)):
+        target = reweights if is_reweight_round else weights
+        target.update((int(node.name.split(".")[1]), new_weight) for node, _, new_weight in changes)
+        states.append((dict(weights), dict(reweights)))
+        types.append(is_reweight_round)
+
+    assert [is_reweight_round for is_reweight_round, _ in rounds] == types
+    for (_, stats), old, new in zip(rounds, states[:-1], states[1:]):
+        expected = tools.remap(old, new)
+        assert (stats.bytes_moved, stats.pg_moved) == (expected.bytes_moved, expected.pg_moved)
+    expected = tools.remap(states[0], states[-1])
+    assert (direct.bytes_moved, direct.pg_moved) == (expected.bytes_moved, expected.pg_moved)
+    assert direct.bytes_moved > 0
+    assert states[-1] == ({0: 0.5, 4: 2.0, 8: 1.5}, {9: 0.8})
+
+
+def order_nodes():
+    return [(osd_node(0, "h0", "r0", weight=1.0), 2.0), (osd_node(1, "h0", "r0", weight=1.0), 0.5),
+            (osd_node(2, "h0", "r0", weight=1.0), 1.2), (osd_node(3, "h1", "r0", weight=1.0), 0.7)]
+
+
+def test_paired_order_pairs_increase_with_decrease_under_host():
+    order, pairs = rebalance.paired_order(order_nodes(), round_config())
+    assert names(order) == ["osd.0", "osd.1", "osd.2", "osd.3"]
+    assert pairs == {"osd.0": "osd.1", "osd.1": "osd.0", "osd.2": "osd.3", "osd.3": "osd.2"}
+
+
+def test_paired_order_respects_domain_limits():
+    config = round_config(max_nodes=4, domain_limits={'host': 1})
+    nodes = [(osd_node(0, "h0", "r0"), 2.0), (osd_node(1, "h0", "r0"), 0.5),
+             (osd_node(2, "h1", "r0"), 1.5), (osd_node(3, "h1", "r0"), 0.4),
+             (osd_node(4, "h2", "r1"), 0.6)]
+    config.rebalance_nodes, config.weight_pairs = rebalance.paired_order(nodes, config)
+
+    # pairs are made from different hosts of the same rack, as host allows one change per round
+    assert names(config.rebalance_nodes) == ["osd.0", "osd.3", "osd.2", "osd.1", "osd.4"]
+
+    # and every round has both or none of pair members
+    rounds = [names(changes) for is_reweight, changes in rebalance.iter_rounds(config) if not is_reweight]
+    assert rounds[0] == ["osd.0", "osd.3", "osd.4"]
+    for changes in rounds:
+        for name in changes:
+            assert config.weight_pairs.get(name, name) in changes
+
+
+def test_size_order():
+    order, pairs = rebalance.size_order(order_nodes(), round_config())
+    assert names(order) == ["osd.0", "osd.1", "osd.3", "osd.2"]
+    assert pairs == {}
+
+
+def test_plan_order_keeps_cheapest_order(monkeypatch, tmp_path):
+    tools = MapTools(monkeypatch, tmp_path)
+    crush, _ = load_map()
+    config = sim_config(crush)
+    config.reweight_nodes = []
+    config.rebalance_nodes.append((crush_osd(crush, 5), 0.5))
+    crushmap_f, osd_map_f = tools.new_file({}), tools.new_file({})
+
+    moved = {}
+    for name, order_func in rebalance.ORDERINGS:
+        candidate = rebalance.copy_config(config)
+        candidate.rebalance_nodes, candidate.weight_pairs = order_func(config.rebalance_nodes, config)
+        rounds, _ = rebalance.simulate_rounds(candidate, crushmap_f, osd_map_f)
+        moved[name] = (sum(stats.bytes_moved for _, stats in rounds), names(candidate.rebalance_nodes))
+
+    results, best = rebalance.plan_order(config, crushmap_f, osd_map_f)
+    assert list(results) == [name for name, _ in rebalance.ORDERINGS]
+    assert results == {name: moved_bytes for name, (moved_bytes, _) in moved.items()}
+    assert results[best] == min(results.values())
+    # osd.5 decrease goes together with osd.4 increase on the same host
+    assert best == "paired" and results[best] < results["config"]
+    assert names(config.rebalance_nodes) == moved[best][1]
@@ -0,0 +1,115 @@
+"""
+Fleet rebalance: progress parsing and concurrent runs of stand-in rebalance script.
+"""
+
+import io
+import sys
+
+import rebalance_fleet
+
+
+# prints lines from config file, which also may sleep and set exit code, and shows CEPH_CONF and options
+FAKE_REBALANCE = """
+import os
+import io
+import sys
+import time
+
+print("10:00:00 - INFO - conf {0} args {1}".format(os.environ["CEPH_CONF"], " ".join(sys.argv[1:-1])))
+sys.stdout.flush()
+code = 0
+for line in open(sys.argv[-1]):
+    if line.startswith("exit "):
+        code = int(line.split()[1])
+    elif line.startswith("sleep "):
+        time.sleep(float(line.split()[1]))
+    else:
+        print(line.rstrip())
+        sys.stdout.flush()
+sys.exit(code)
+"""
+
+
+def test_update_from_rebalance_output():
+    run = rebalance_fleet.ClusterRun("dc1", "/etc/ceph/dc1.conf", "dc1.yaml")
+    run.update("10:00:00 - INFO - Done 40%")
+    run.update("10:00:01 - INFO - Round 3 done in 1m 00s, recovered 10GB, throughput 1MB/s, ETA 2h 05m")
+    assert (run.done, run.eta, run.last_error) == (40, "2h 05m", None)
+    assert run.last_message.startswith("Round 3 done")
+
+    run.update("10:00:02 - ERROR - osd osd.1 has wrong weight")
+    run.update("")
+    assert run.last_error == "osd osd.1 has wrong weight"
+    run.update("Traceback (most recent call last):")
+    assert run.last_error == "Traceback (most recent call last):"
+
+
+def test_load_fleet(tmp_path):
+    fleet_f = tmp_path / "fleet.yaml"
+    fleet_f.write_text("clusters:\n"
+                       "  - {name: dc1, conf: /etc/ceph/dc1.conf, config: dc1.yaml, args: [-b]}\n"
+                       "  - {name: dc2, conf: /etc/ceph/dc2.conf, config: dc2.yaml, journal: dc2.journal}\n")
+    runs = rebalance_fleet.load_fleet(str(fleet_f))
+    assert [run.name for run in runs] == ["dc1", "dc2"]
+    assert runs[0].cmd() == [sys.executable, rebalance_fleet.REBALANCE, "-b", "dc1.yaml"]
+    assert runs[1].cmd() == [sys.executable, rebalance_fleet.REBALANCE, "-J", "dc2.journal", "dc2.yaml"]
+
+
+def test_run_fleet(tmp_path, monkeypatch):
+    script = tmp_path / "rebalance.py"
+    script.write_text(FAKE_REBALANCE)
+    monkeypatch.setattr(rebalance_fleet, "REBALANCE", str(script))
+
+    good = tmp_path / "good.yaml"
+    good.write_text("10:00:01 - INFO - Done 50%\n10:00:02 - INFO - Round 1 done, ETA 0m 30s\n")
+    bad = tmp_path / "bad.yaml"
+    bad.write_text("10:00:01 - INFO - Done 30%\n10:00:02 - ERROR - Fail to find node\n"
+                   "10:00:03 - INFO - Round 1 done, ETA 5m 00s\nexit 2\n")
+
+    runs = [rebalance_fleet.ClusterRun("dc1", "/etc/ceph/dc1.conf", str(good), args=["-b"]),
+            rebalance_fleet.ClusterRun("dc2", "/etc/ceph/dc2.conf", str(bad), journal="dc2.journal")]
+    failed = rebalance_fleet.run_fleet(runs, show_interval=0.05)
+
+    assert failed == [runs[1]]
+    assert (runs[0].state(), runs[0].done, runs[0].eta) == ("done", 100, None)
+    assert (runs[1].state(), runs[1].done, runs[1].eta) == ("failed(2)", 30, "5m 00s")
+    assert runs[1].last_error == "Fail to find node"
+
+    fd = io.StringIO()
+    rebalance_fleet.show_progress(runs, fd)
+    table = fd.getvalue().splitlines()
+    assert table[0].split() == ["cluster", "state", "done", "ETA", "last", "message"]
+    assert table[1].split() == ["dc1", "done", "100%", "-", "Round", "1", "done,", "ETA", "0m", "30s"]
+    assert table[2].split() == ["dc2", "failed(2)", "30%", "5m", "00s", "Fail", "to", "find", "node"]
+
+
+def test_cluster_conf_and_options_are_passed(tmp_path, monkeypatch):
+    script = tmp_path / "rebalance.py"
+    script.write_text(FAKE_REBALANCE)
+    monkeypatch.setattr(rebalance_fleet, "REBALANCE", str(script))
+    config = tmp_path / "empty.yaml"
+    config.write_text("")
+
+    run = rebalance_fleet.ClusterRun("dc1", "/etc/ceph/dc1.conf", str(config), journal="dc1.journal", args=["-b"])
+    assert rebalance_fleet.run_fleet([run], show_interval=0.05) == []
+    assert run.last_message == "conf /etc/ceph/dc1.conf args -b -J dc1.journal"
+
+
+def test_progress_is_shown_while_other_runs_continue(tmp_path, monkeypatch, capsys):
+    script = tmp_path / "rebalance.py"
+    script.write_text(FAKE_REBALANCE)
+    monkeypatch.setattr(rebalance_fleet, "REBALANCE", str(script))
+    fast = tmp_path / "fast.yaml"
+    fast.write_text("10:00:01 - INFO - Done 50%\n")
+    slow = tmp_path / "slow.yaml"
+    slow.write_text("10:00:01 - INFO - Done 20%\nsleep 1\n10:00:02 - INFO - Done 70%\n")
+
+    runs = [rebalance_fleet.ClusterRun("dc1", "/etc/ceph/dc1.conf", str(fast)),
+            rebalance_fleet.ClusterRun("dc2", "/etc/ceph/dc2.conf", str(slow))]
+    assert rebalance_fleet.run_fleet(runs, show_interval=0.1) == []
+
+    tables = [table.splitlines() for table in capsys.readouterr().out.split("\n\n") if table.strip()]
+    states = [(table[1].split()[1], table[2].split()[1:3]) for table in tables]
+    # dc1 finished, while dc2 was still running
+    assert ("done", ["running", "20%"]) in states
+    assert states[-1] == ("done", ["done", "100%"])
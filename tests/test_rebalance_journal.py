@@ -0,0 +1,135 @@
+"""
+Progress journal: recovered bytes per round from pg stats counters, ETA, resume.
+"""
+
+import rebalance
+import rebalance_journal
+
+
+class CountersStatus(object):
+    "Cumulative num_bytes_recovered, which grows only when test recovers data"
+    def __init__(self):
+        self.recovered = 1000
+
+    def pg_stats_sum(self):
+        return {'pg_map': {'pg_stats_sum': {'stat_sum': {'num_bytes_recovered': self.recovered}}}}
+
+
+class FakeTracker(object):
+    "Every wait recovers next amount of bytes"
+    def __init__(self, status, recovered_per_wait):
+        self.status = status
+        self.recovered_per_wait = list(recovered_per_wait)
+
+    def wait_complete(self, any_updates, ready=None):
+        if any_updates:
+            self.status.recovered += self.recovered_per_wait.pop(0)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 50.0
+        return self.now
+
+
+def reweight_config(count, step=0.1):
+    config = rebalance.Config()
+    config.max_nodes_per_round = 1
+    config.max_weight_change = 0.5
+    config.max_reweight_change = step
+    config.min_weight_diff = 0.01
+    config.min_reweight_diff = 0.01
+    config.reweight_nodes = [(rebalance.FakedNode(name="osd.{0}".format(idx), weight=1.0), 0.9)
+                             for idx in range(count)]
+    config.total_reweight_change = 0.1 * count
+    return config
+
+
+def test_round_bytes_from_recovered_counters(tmp_path, monkeypatch):
+    monkeypatch.setattr(rebalance, "request_reweight_update", lambda node, weight: None)
+    status = CountersStatus()
+    tracker = FakeTracker(status, [300, 500, 200])
+    journal = rebalance_journal.ProgressJournal(str(tmp_path / "journal"), clock=Clock())
+    config = reweight_config(3)
+    journal.start_plan("hash", config, estimated_bytes=2000)
+
+    rebalance.run_rounds(config, tracker, journal=journal, meter=rebalance_journal.RecoveryMeter(status))
+
+    assert [record['recovered_bytes'] for record in journal.rounds] == [300, 500, 200]
+    assert journal.recovered_bytes() == 1000
+    # each round took 50 seconds
+    assert journal.throughput() == 1000 / 150.0
+    assert journal.eta(0) == 1000 / journal.throughput()
+
+    reloaded = rebalance_journal.ProgressJournal(str(tmp_path / "journal"))
+    assert reloaded.can_resume("hash")
+    assert reloaded.recovered_bytes() == 1000
+
+
+def test_meter_without_counters_reports_zero():
+    class BrokenStatus(object):
+        def pg_stats_sum(self):
+            raise RuntimeError("no mgr")
+
+    meter = rebalance_journal.RecoveryMeter(BrokenStatus())
+    meter.start_round()
+    assert meter.finish_round() == 0
+
+
+def test_resume_only_same_cluster_and_untouched_weights(tmp_path):
+    path = str(tmp_path / "journal")
+    config = reweight_config(2)
+    rebalance_journal.ProgressJournal(path).start_plan("hash", config, fsid="fsid-1", epoch=100)
+
+    journal = rebalance_journal.ProgressJournal(path)
+    assert journal.can_resume("hash", config, fsid="fsid-1", epoch=120)
+    assert not journal.can_resume("other-hash", config, fsid="fsid-1", epoch=120)
+    assert not journal.can_resume("hash", config, fsid="fsid-2", epoch=120)
+    assert not journal.can_resume("hash", config, fsid="fsid-1", epoch=90)
+
+    # previous run moved osd.0 half way to target - plan continues
+    config.reweight_nodes[0][0].weight = 0.95
+    assert journal.can_resume("hash", config, fsid="fsid-1", epoch=120)
+
+    # someone else changed osd.1 out of [start, target] range
+    config.reweight_nodes[1][0].weight = 0.5
+    assert journal.changed_outside(config) == ["osd.1"]
+    assert not journal.can_resume("hash", config, fsid="fsid-1", epoch=120)
+
+
+def test_broken_record_skips_only_its_line(tmp_path, monkeypatch):
+    monkeypatch.setattr(rebalance, "request_reweight_update", lambda node, weight: None)
+    path = str(tmp_path / "journal")
+    status = CountersStatus()
+    journal = rebalance_journal.ProgressJournal(path, clock=Clock())
+    config = reweight_config(2)
+    journal.start_plan("hash", config, fsid="fsid-1", epoch=100)
+    rebalance.run_rounds(config, FakeTracker(status, [300, 500]), journal=journal,
+                         meter=rebalance_journal.RecoveryMeter(status))
+
+    # run was killed while writing next round record
+    with open(path, "a") as fd:
+        fd.write('{"type": "round", "round": 3, "sta')
+
+    reloaded = rebalance_journal.ProgressJournal(path)
+    assert reloaded.plan['fsid'] == "fsid-1"
+    assert [record['round'] for record in reloaded.rounds] == [1, 2]
+    assert reloaded.recovered_bytes() == 800
+
+
+def test_plan_keeps_weight_pairs(tmp_path):
+    path = str(tmp_path / "journal")
+    config = reweight_config(0)
+    config.rebalance_nodes = [(rebalance.FakedNode(name="osd.{0}".format(idx), weight=1.0), 1.5 - idx)
+                              for idx in range(2)]
+    config.weight_pairs = {"osd.0": "osd.1", "osd.1": "osd.0"}
+    rebalance_journal.ProgressJournal(path).start_plan("hash", config)
+
+    config.rebalance_nodes.reverse()
+    config.weight_pairs = {}
+    rebalance_journal.ProgressJournal(path).restore_order(config)
+    assert [node.name for node, _ in config.rebalance_nodes] == ["osd.0", "osd.1"]
+    assert config.weight_pairs == {"osd.0": "osd.1", "osd.1": "osd.0"}
@@ -0,0 +1,130 @@
+"""
+Pipeline gate and adaptive scheduler over scripted cluster status.
+"""
+
+import rebalance
+import rebalance_tracker
+import rebalance_scheduler
+
+
+def cluster_status(states, misplaced_ratio, bytes_used=1000000):
+    return {'pgmap': {'pgs_by_state': [{'state_name': name, 'count': num} for name, num in states.items()],
+                      'misplaced_ratio': misplaced_ratio,
+                      'bytes_used': bytes_used}}
+
+
+class ScriptedStatus(object):
+    "Moves to next status on every pg_stat request, last one is repeated"
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.current = None
+        self.requests = 0
+
+    def pg_stat(self):
+        self.requests += 1
+        self.current = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        return self.current
+
+    def cluster_status(self):
+        return self.current
+
+    def close(self):
+        pass
+
+
+def test_gate_waits_for_round_misplacement():
+    before = cluster_status({'active+clean': 100}, 0.0)
+    status = ScriptedStatus(
+        before,
+        # new map is peering, misplaced counters still show nothing
+        cluster_status({'active+clean': 80, 'peering': 20}, 0.0),
+        cluster_status({'active+clean': 80, 'remapped+peering': 20}, 0.0),
+        # round became visible
+        cluster_status({'active+clean': 80, 'active+remapped+backfilling': 20}, 0.05),
+        cluster_status({'active+clean': 95, 'active+remapped+backfilling': 5}, 0.005))
+
+    gate = rebalance_scheduler.PipelineGate({'max_misplaced_ratio': 0.01})
+    status.pg_stat()
+    gate.start_round(status)
+
+    tracker = rebalance_tracker.RebalanceTracker(rebalance_tracker.LocalChannel(), status, min_interval=0.001,
+                                                 max_interval=0.001, settle_time=0)
+    tracker.wait_complete(True, ready=gate.ready)
+    assert status.requests == 5
+    assert tracker.last_states == {'active+clean': 95, 'active+remapped+backfilling': 5}
+
+
+def test_gate_opens_without_peering():
+    gate = rebalance_scheduler.PipelineGate({'max_misplaced_ratio': 0.01})
+    status = ScriptedStatus(cluster_status({'active+clean': 100}, 0.0))
+    status.pg_stat()
+    gate.start_round(status)
+    # round moved nothing, no PGs peer
+    assert gate.ready(status)
+
+
+def test_gate_opens_on_misplaced_growth_while_peering():
+    gate = rebalance_scheduler.PipelineGate({'max_misplaced_ratio': 0.01})
+    status = ScriptedStatus(cluster_status({'active+clean': 100}, 0.001),
+                            cluster_status({'active+clean': 90, 'peering': 10}, 0.002))
+    status.pg_stat()
+    gate.start_round(status)
+    status.pg_stat()
+    assert gate.ready(status)
+
+
+def test_gate_caps_inflight_with_previous_round_size():
+    gate = rebalance_scheduler.PipelineGate({'max_misplaced_ratio': 0.5, 'max_inflight': 1500})
+    status = ScriptedStatus(cluster_status({'active+clean': 100}, 0.0, bytes_used=10000),
+                            cluster_status({'active+remapped+backfilling': 10}, 0.1, bytes_used=10000),
+                            cluster_status({'active+remapped+backfilling': 5}, 0.09, bytes_used=10000),
+                            cluster_status({'active+remapped+backfilling': 1}, 0.04, bytes_used=10000))
+    status.pg_stat()
+    gate.start_round(status)
+    status.pg_stat()
+    assert gate.ready(status)
+
+    # previous round added 1000 bytes, so next one may start only with 500 bytes in flight
+    gate.start_round(status)
+    status.pg_stat()
+    assert not gate.ready(status)
+    status.pg_stat()
+    assert gate.ready(status)
+
+
+class PerfStatus(object):
+    def __init__(self, latencies):
+        self.latencies = latencies
+
+    def cluster_status(self):
+        return {'pgmap': {'recovering_bytes_per_sec': 0}}
+
+    def osd_perf(self):
+        return {'osd_perf_infos': [{'id': osd_id, 'perf_stats': {'commit_latency_ms': lat, 'apply_latency_ms': 0}}
+                                   for osd_id, lat in enumerate(self.latencies)]}
+
+
+def scheduler_config():
+    config = rebalance.Config()
+    config.max_nodes_per_round = 4
+    config.max_weight_change = 0.4
+    config.max_reweight_change = 0.1
+    return config
+
+
+def test_scheduler_latency_percentile_is_configurable():
+    # one slow OSD out of ten
+    status = PerfStatus([10] * 9 + [200])
+    config = scheduler_config()
+    scheduler = rebalance_scheduler.AdaptiveScheduler({'max_latency_ms': 50, 'latency_percentile': 0.5}, config)
+    scheduler.sample(status)
+    scheduler.adjust(config)
+    assert config.max_nodes_per_round == 5
+
+    config = scheduler_config()
+    scheduler = rebalance_scheduler.AdaptiveScheduler({'max_latency_ms': 50, 'latency_percentile': 0.95}, config)
+    scheduler.sample(status)
+    scheduler.adjust(config)
+    assert config.max_nodes_per_round == 2
+    assert config.max_weight_change == 0.2
+    assert abs(config.max_reweight_change - 0.05) < 1e-9
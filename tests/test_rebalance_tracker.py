@@ -0,0 +1,30 @@
+"""
+Rebalance tracker over in-process event channel.
+"""
+
+import rebalance_tracker
+
+
+class FakeStatus(object):
+    "Returns next of states_list on every request, last one is repeated"
+    def __init__(self, *states_list):
+        self.states_list = list(states_list)
+        self.states = None
+
+    def pg_stat(self):
+        self.states = self.states_list.pop(0) if len(self.states_list) > 1 else self.states_list[0]
+        return {'num_pg_by_state': [{'name': name, 'num': num} for name, num in self.states.items()]}
+
+    def close(self):
+        pass
+
+
+def test_complete_pgmap_line_is_checked():
+    status = FakeStatus({'active+clean': 10, 'peering': 2}, {'active+clean': 12})
+    checked = []
+    channel = rebalance_tracker.LocalChannel()
+    tracker = rebalance_tracker.RebalanceTracker(channel, status, min_interval=0.01, settle_time=0,
+                                                 on_check=lambda status: checked.append(dict(status.states)))
+    channel.push("pgmap v10: 12 pgs: 12 active+clean; 1 GiB data")
+    tracker.wait(any_updates=False)
+    assert checked == [{'active+clean': 10, 'peering': 2}, {'active+clean': 12}]
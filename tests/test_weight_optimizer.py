@@ -0,0 +1,76 @@
+"""
+Weight optimizer: incremental evaluation against full remapping.
+"""
+
+import os
+import json
+
+import numpy
+
+import crush_mapper
+import weight_optimizer
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def load_map():
+    with open(os.path.join(DATA_DIR, "osdmap.json")) as fd:
+        data = json.load(fd)
+    return crush_mapper.load_crush(data['crush']), crush_mapper.load_osdmap(data['osd_dump'])
+
+
+def make_optimizer():
+    crush, osdmap = load_map()
+    pg_sizes = {pool.pid: numpy.full(pool.pg_num, 100, dtype=numpy.int64) for pool in osdmap.pools}
+    return weight_optimizer.WeightOptimizer(crush, osdmap, pg_sizes, metric='bytes')
+
+
+def test_step_matches_full_remap():
+    # map has upmaps, which move PGs off OSDs, selected by crush
+    optimizer = make_optimizer()
+    for _ in range(4):
+        if optimizer.step() is None:
+            break
+        moved_bytes, load = optimizer.moved_bytes, optimizer.load.copy()
+        assert optimizer.check() == moved_bytes
+        assert numpy.allclose(optimizer.load, load)
+    assert optimizer.history
+
+
+def test_rollback_restores_map():
+    optimizer = make_optimizer()
+    for _ in range(2):
+        optimizer.step()
+    while optimizer.history:
+        optimizer.rollback()
+    assert optimizer.check() == 0
+    assert optimizer.changes() == ({}, {})
+
+
+def test_optimize_weights_keeps_max_move(monkeypatch):
+    monkeypatch.setattr(crush_mapper, "load_osdmap_file", lambda osd_map_f: load_map())
+    _, osdmap = load_map()
+    pg_sizes = {pool.pid: numpy.full(pool.pg_num, 100, dtype=numpy.int64) for pool in osdmap.pools}
+    optimizer = weight_optimizer.optimize_weights("osdmap.bin", pg_sizes, metric='bytes', max_move=1000)
+    assert 0 < optimizer.moved_bytes <= 1000
+
+
+def test_increase_matches_full_remap():
+    optimizer = make_optimizer()
+    optimizer.allow_increase = True
+    usage, active = optimizer.usage(optimizer.load)
+    mean_usage = usage[active].mean()
+    osd_id = min(numpy.nonzero(active)[0].tolist(), key=lambda idx: usage[idx])
+
+    rechange = optimizer.propose(osd_id, 'reweight', usage, mean_usage)
+    assert rechange is None or rechange.old < rechange.new <= crush_mapper.WEIGHT_ONE
+
+    change = optimizer.propose(osd_id, 'weight', usage, mean_usage)
+    assert change.new > change.old
+    optimizer.evaluate(change)
+    optimizer.commit(change)
+    moved_bytes, load = optimizer.moved_bytes, optimizer.load.copy()
+    assert moved_bytes > 0
+    assert optimizer.check() == moved_bytes
+    assert numpy.allclose(optimizer.load, load)
@@ -0,0 +1,329 @@
+"""
+Search for crush weights and/or reweights, which make PG count or data size per OSD even.
+
+Greedy search: on every iteration most loaded OSDs are tried with lowered weight or
+reweight and the change, which reduces spread of usage the most, is kept. Weight decrease
+can remap only PGs, which have affected OSDs in their crush (before upmap) set, so such
+candidate is evaluated by recomputing just these PGs with crush_mapper. With allow_increase
+least loaded OSDs are also tried with raised weight or reweight (reweight up to 1.0). Raised
+weight can attract any PG of the pool, so every increase candidate remaps whole pools and
+search becomes much slower.
+"""
+
+from __future__ import print_function
+
+import logging
+
+import numpy
+import yaml
+
+import crush_mapper
+from crush_mapper import NO_OSD, WEIGHT_ONE
+
+
+logger = logging.getLogger("remap.optimizer")
+
+
+MODES = ('weight', 'reweight')
+METRICS = ('pgs', 'bytes')
+
+
+def new_slots(orig, mapping):
+    "Number of OSDs in every row of mapping, which are not in the same row of orig"
+    present = (mapping[:, :, None] == orig[:, None, :]).any(axis=2)
+    return ((mapping != NO_OSD) & ~present).sum(axis=1)
+
+
+class PoolState(object):
+    "raw - crush result before upmaps, mapping - up sets"
+    def __init__(self, info, raw, sizes, osdmap):
+        self.info = info
+        self.raw = raw
+        self.orig = crush_mapper.raw_to_up(osdmap, info, raw)[0]
+        self.mapping = self.orig.copy()
+        self.sizes = sizes
+        self.moved = numpy.zeros(len(raw), dtype=numpy.int64)
+
+
+class Change(object):
+    "Candidate weight change and its result"
+    def __init__(self, osd_id, mode, old, new):
+        self.osd_id = osd_id
+        self.mode = mode
+        self.old = old
+        self.new = new
+        self.rows = {}
+        self.load = None
+        self.moved_bytes = None
+        self.score = None
+
+
+class WeightOptimizer(object):
+    """
+    crush, osdmap - crush_mapper objects, changed in place
+    pg_sizes - {pool_id: array of PG sizes}
+    """
+    def __init__(self, crush, osdmap, pg_sizes, metric='pgs', modes=MODES, max_step=0.05,
+                 min_weight_diff=0.01, min_reweight_diff=0.01, candidates=8, allow_increase=False):
+        self.crush = crush
+        self.osdmap = osdmap
+        self.metric = metric
+        self.modes = modes
+        self.max_step = max_step
+        self.allow_increase = allow_increase
+        self.min_diff = {'weight': int(min_weight_diff * WEIGHT_ONE),
+                         'reweight': int(min_reweight_diff * WEIGHT_ONE)}
+        self.candidates = candidates
+
+        self.orig_weights = {}
+        self.orig_reweights = osdmap.weights.copy()
+        self.capacity = numpy.zeros(len(osdmap.weights), dtype=numpy.float64)
+        for osd_id in range(len(osdmap.weights)):
+            weight = crush.item_weight(osd_id)
+            if weight is not None:
+                self.orig_weights[osd_id] = weight
+                self.capacity[osd_id] = weight
+
+        self.pools = []
+        for pool in osdmap.pools:
+            sizes = numpy.zeros(pool.pg_num, dtype=numpy.int64)
+            pool_sizes = pg_sizes.get(pool.pid, sizes)[:pool.pg_num]
+            sizes[:len(pool_sizes)] = pool_sizes
+            self.pools.append(PoolState(pool, crush_mapper.map_pool_raw(crush, osdmap, pool), sizes, osdmap))
+
+        # committed changes, in order
+        self.history = []
+        self.load = self.full_load()
+        self.moved_bytes = 0
+        self.score = self.calc_score(self.load)
+        self.start_score = self.score
+
+    def slot_weights(self, pool, rows=None):
+        sizes = pool.sizes if rows is None else pool.sizes[rows]
+        if self.metric == 'bytes':
+            return sizes.astype(numpy.float64)
+        return numpy.ones(len(sizes), dtype=numpy.float64)
+
+    def rows_load(self, mapping, weights):
+        used = mapping != NO_OSD
+        slot_weights = numpy.broadcast_to(weights[:, None], mapping.shape)[used]
+        return numpy.bincount(mapping[used], weights=slot_weights, minlength=len(self.capacity))
+
+    def full_load(self):
+        load = numpy.zeros(len(self.capacity), dtype=numpy.float64)
+        for pool in self.pools:
+            load += self.rows_load(pool.mapping, self.slot_weights(pool))
+        return load
+
+    def active_osds(self):
+        return (self.capacity > 0) & (self.osdmap.weights > 0) & self.osdmap.up & self.osdmap.exists
+
+    def usage(self, load):
+        "load per unit of original crush weight"
+        active = self.active_osds()
+        res = numpy.zeros(len(load), dtype=numpy.float64)
+        res[active] = load[active] / self.capacity[active]
+        return res, active
+
+    def calc_score(self, load):
+        "Relative standard deviation of usage over active OSDs"
+        usage, active = self.usage(load)
+        if not active.any() or usage[active].mean() == 0:
+            return 0.0
+        return float(usage[active].std() / usage[active].mean())
+
+    def current_value(self, osd_id, mode):
+        if mode == 'reweight':
+            return int(self.osdmap.weights[osd_id])
+        return self.crush.item_weight(osd_id)
+
+    def set_value(self, osd_id, mode, value):
+        "Set weight/reweight, returns ids of OSDs, which PG can be remapped by this change"
+        if mode == 'reweight':
+            self.osdmap.weights[osd_id] = value
+            return [osd_id]
+
+        changed = self.crush.set_item_weight(osd_id, value)
+        # items, which are not in any bucket (roots), never compete in straw2 draw
+        affected = set()
+        for item in changed:
+            if self.crush.parents(item):
+                affected.update(self.crush.leaves(item))
+        return sorted(affected)
+
+    def propose(self, osd_id, mode, usage, mean_usage):
+        "Change, which moves usage of OSD toward mean by at most max_step of its value, None if too small"
+        curr = self.current_value(osd_id, mode)
+        if not curr:
+            return None
+        if usage[osd_id] > mean_usage:
+            new = int(curr * max(mean_usage / usage[osd_id], 1.0 - self.max_step))
+        else:
+            ratio = 1.0 + self.max_step
+            if usage[osd_id] > 0:
+                ratio = min(mean_usage / usage[osd_id], ratio)
+            new = int(curr * ratio)
+            if mode == 'reweight':
+                new = min(new, WEIGHT_ONE)
+        if abs(new - curr) < self.min_diff[mode]:
+            return None
+        return Change(osd_id, mode, curr, new)
+
+    def evaluate(self, change):
+        "Fill change result, map and state are restored afterwards"
+        affected = self.set_value(change.osd_id, change.mode, change.new)
+        try:
+            load = self.load.copy()
+            moved_bytes = self.moved_bytes
+            for pool in self.pools:
+                if change.new > change.old:
+                    rows = numpy.arange(len(pool.raw))
+                else:
+                    # upmap can move PG off affected OSD, while its crush choice still depends on it
+                    rows = numpy.nonzero(numpy.isin(pool.raw, affected).any(axis=1))[0]
+                if not rows.size:
+                    continue
+                new_raw = crush_mapper.map_pool_raw(self.crush, self.osdmap, pool.info, rows)
+                new_rows = crush_mapper.raw_to_up(self.osdmap, pool.info, new_raw, rows)[0]
+                weights = self.slot_weights(pool, rows)
+                load -= self.rows_load(pool.mapping[rows], weights)
+                load += self.rows_load(new_rows, weights)
+                moved = new_slots(pool.orig[rows], new_rows)
+                moved_bytes += int(((moved - pool.moved[rows]) * pool.sizes[rows]).sum())
+                change.rows[pool.info.pid] = (rows, new_raw, new_rows, moved)
+        finally:
+            self.set_value(change.osd_id, change.mode, change.old)
+
+        change.load = load
+        change.moved_bytes = moved_bytes
+        change.score = self.calc_score(load)
+        return change
+
+    def commit(self, change):
+        self.set_value(change.osd_id, change.mode, change.new)
+        for pool in self.pools:
+            if pool.info.pid in change.rows:
+                rows, new_raw, new_rows, moved = change.rows[pool.info.pid]
+                pool.raw[rows] = new_raw
+                pool.mapping[rows] = new_rows
+                pool.moved[rows] = moved
+        self.load = change.load
+        self.moved_bytes = change.moved_bytes
+        self.score = change.score
+        self.history.append(change)
+
+    def rollback(self):
+        "Undo last committed change and return it, call check() afterwards to recalculate mapping"
+        change = self.history.pop()
+        self.set_value(change.osd_id, change.mode, change.old)
+        return change
+
+    def step(self, max_move=None):
+        "Make one best change, returns it or None if no change improves distribution"
+        usage, active = self.usage(self.load)
+        if not active.any():
+            return None
+        mean_usage = usage[active].mean()
+        order = numpy.argsort(-usage)
+        candidates = [osd_id for osd_id in order[:self.candidates].tolist()
+                      if active[osd_id] and usage[osd_id] > mean_usage]
+        if self.allow_increase:
+            candidates += [osd_id for osd_id in order[::-1].tolist()
+                           if active[osd_id] and usage[osd_id] < mean_usage][:self.candidates]
+
+        best = None
+        for osd_id in candidates:
+            for mode in self.modes:
+                change = self.propose(osd_id, mode, usage, mean_usage)
+                if change is None:
+                    continue
+                self.evaluate(change)
+                if max_move is not None and change.moved_bytes > max_move:
+                    continue
+                if change.score < self.score and (best is None or change.score < best.score):
+                    best = change
+
+        if best is not None:
+            logger.debug("%s osd.%s %.4f => %.4f, score %.4f => %.4f", best.mode, best.osd_id,
+                         float(best.old) / WEIGHT_ONE, float(best.new) / WEIGHT_ONE, self.score, best.score)
+            self.commit(best)
+        return best
+
+    def optimize(self, max_move=None, max_iterations=100):
+        for _ in range(max_iterations):
+            if self.step(max_move) is None:
+                break
+
+    def check(self):
+        "Recalculate mapping of all PGs for current weights, returns moved bytes"
+        moved_bytes = 0
+        for pool in self.pools:
+            pool.raw = crush_mapper.map_pool_raw(self.crush, self.osdmap, pool.info)
+            pool.mapping = crush_mapper.raw_to_up(self.osdmap, pool.info, pool.raw)[0]
+            pool.moved = new_slots(pool.orig, pool.mapping)
+            moved_bytes += int((pool.moved * pool.sizes).sum())
+        self.load = self.full_load()
+        self.moved_bytes = moved_bytes
+        self.score = self.calc_score(self.load)
+        return moved_bytes
+
+    def changes(self):
+        "Returns ({osd_id: (old, new) weight}, {osd_id: (old, new) reweight}), as floats"
+        weights = {}
+        for osd_id, orig in self.orig_weights.items():
+            curr = self.crush.item_weight(osd_id)
+            if curr != orig:
+                weights[osd_id] = (float(orig) / WEIGHT_ONE, float(curr) / WEIGHT_ONE)
+
+        reweights = {}
+        for osd_id in numpy.nonzero(self.osdmap.weights != self.orig_reweights)[0].tolist():
+            reweights[osd_id] = (float(self.orig_reweights[osd_id]) / WEIGHT_ONE,
+                                 float(self.osdmap.weights[osd_id]) / WEIGHT_ONE)
+        return weights, reweights
+
+    def rebalance_config(self, **params):
+        "rebalance.py config dict for found changes, params are added to config as is"
+        weights, reweights = self.changes()
+        osds = []
+        for osd_id, (_, weight) in sorted(weights.items()):
+            node = {'osd': self.osd_name(osd_id)}
+            node.update(self.crush.path(osd_id))
+            node['weight'] = round(weight, 4)
+            osds.append(node)
+
+        for osd_id, (_, reweight) in sorted(reweights.items()):
+            osds.append({'osd': self.osd_name(osd_id), 'reweight': round(reweight, 4)})
+
+        config = dict(params)
+        config['osds'] = osds
+        return config
+
+    def osd_name(self, osd_id):
+        return self.crush.device_names.get(osd_id, "osd.{0}".format(osd_id))
+
+
+def optimize_weights(osd_map_f, pg_sizes, metric='pgs', modes=MODES, max_move=None, max_step=0.05,
+                     max_iterations=100, min_weight_diff=0.01, min_reweight_diff=0.01, allow_increase=False):
+    """
+    Returns optimizer after search. Mapping, moved data and score of found weights are recalculated
+    by remapping all PGs, and last changes are rolled back, while recalculated moved data is above max_move.
+    Moved data is counted as PG data size for every new OSD in PG up set, backfill and recovery overhead
+    isn't accounted
+    """
+    crush, osdmap = crush_mapper.load_osdmap_file(osd_map_f)
+    optimizer = WeightOptimizer(crush, osdmap, pg_sizes, metric=metric, modes=modes, max_step=max_step,
+                                min_weight_diff=min_weight_diff, min_reweight_diff=min_reweight_diff,
+                                allow_increase=allow_increase)
+    optimizer.optimize(max_move, max_iterations)
+    moved_bytes = optimizer.check()
+    while max_move is not None and moved_bytes > max_move and optimizer.history:
+        change = optimizer.rollback()
+        logger.debug("Moved data %s is above limit %s, rollback %s osd.%s %.4f => %.4f", moved_bytes, max_move,
+                     change.mode, change.osd_id, float(change.old) / WEIGHT_ONE, float(change.new) / WEIGHT_ONE)
+        moved_bytes = optimizer.check()
+    logger.info("Usage spread %.4f => %.4f", optimizer.start_score, optimizer.score)
+    return optimizer
+
+
+def dump_config(config, fd):
+    yaml.safe_dump(config, fd, default_flow_style=False)